@@ -0,0 +1,242 @@
+"""
+Batched evaluation of the genomic file ACL rules.
+
+The ACL of a genomic file only depends on a few small facts: whether it and
+all of its contributing biospecimens are visible, its controlled_access
+class (False, null, or anything else), and the set of consent codes of its
+biospecimens. Biospecimens are first reduced to a column of small integer
+consent codes (or HIDDEN), so each genomic file's facts fold into an integer
+bitmask over its links. The rules are then evaluated once per distinct
+combination of facts, and every genomic file with that combination shares
+the resulting ACL. ACLs that already match the genomic file's current value
+are not patched at all. The rule behind each decision (see decisions) can be
+recorded along the way.
+
+The rules themselves are documented in sample_status, where
+ConsentProcessor.evaluate_rules(reference=True) still evaluates them one
+genomic file at a time.
+"""
+
+import json
+
+from kf_update_dbgap_consent.alerts import (
+    INCONSISTENT_CODES,
+    NULL_ACCESS,
+    InconsistentCodes,
+    NullAccess,
+)
+from kf_update_dbgap_consent.decisions import (
+    GF_CONSENT,
+    GF_HIDDEN,
+    GF_HIDDEN_SPECIMEN,
+    GF_INCONSISTENT_CODES,
+    GF_NULL_ACCESS,
+    GF_OPEN,
+)
+
+HIDDEN = -1
+
+# controlled_access classes
+OPEN, NULL, CONTROLLED = 0, 1, 2
+
+
+def _access_class(controlled_access):
+    if controlled_access is False:
+        return OPEN
+    if controlled_access is None:
+        return NULL
+    return CONTROLLED
+
+
+class AclEngine:
+    """
+    Evaluates the ACL rules for genomic files against a fixed table of
+    biospecimen consent codes. Decisions are memoized across calls, so
+    genomic files can be evaluated a chunk at a time.
+
+    :param specimen_codes: {biospecimen kf_id: dbgap_consent_code}
+    :param hidden_specimens: biospecimens that are or will be hidden
+    """
+
+    def __init__(self, study_id, study_phs, specimen_codes, hidden_specimens):
+        self.default_acl = {study_id, f"{study_phs}.c999"}
+        self.specimen_codes = specimen_codes
+
+        # biospecimen column of small integer codes
+        self.codes = []
+        self.code_ids = {}
+        self.specimens = {
+            bsid: HIDDEN if bsid in hidden_specimens else self._code_id(code)
+            for bsid, code in specimen_codes.items()
+        }
+        # biospecimens from outside the study have no code and aren't hidden
+        self.unknown = self._code_id(None)
+        self.decisions = {}
+
+    def _code_id(self, code):
+        if code not in self.code_ids:
+            self.code_ids[code] = len(self.codes)
+            self.codes.append(code)
+        return self.code_ids[code]
+
+    def _decide(self, visible, access, mask):
+        """
+        :returns: (sorted ACL or None, the same as a tuple, alert type, rule,
+            the ACL as JSON)
+        """
+        alert = None
+        if visible:
+            if access == OPEN:
+                acl, rule = ["*"], GF_OPEN
+            elif access == NULL:
+                return None, None, NULL_ACCESS, GF_NULL_ACCESS, None
+            elif mask and not mask & (mask - 1):
+                acl = sorted(
+                    self.default_acl | {self.codes[mask.bit_length() - 1]}
+                )
+                rule = GF_CONSENT
+            else:
+                acl = sorted(self.default_acl)
+                alert, rule = INCONSISTENT_CODES, GF_INCONSISTENT_CODES
+        elif access == NULL:
+            acl, rule = [], GF_HIDDEN
+        else:
+            acl, rule = sorted(self.default_acl), GF_HIDDEN
+        return acl, tuple(acl), alert, rule, json.dumps(acl)
+
+    def evaluate(
+        self, entities, genomic_files, patches, alerts, decisions=None
+    ):
+        """
+        Add ACL patches and alerts for the given genomic files.
+
+        :param entities: StudyEntities holding the genomic files and their
+            biospecimen links
+        :param genomic_files: kf_ids of the genomic files to evaluate
+        :param patches: {endpoint: {kf_id: patch}} to add to
+        :param alerts: list of alerts to add to
+        :param decisions: optional list to add a decisions.DecisionIndex row
+            to for each genomic file
+        """
+        specimens = self.specimens
+        unknown = self.unknown
+        memo = self.decisions
+        gf_patches = patches["genomic-files"]
+        gf_table = entities.genomic_files
+        gf_specimens = entities.gf_specimens
+        for gfid in genomic_files:
+            bs_links = gf_specimens[gfid]
+            gf = gf_table[gfid]
+            visible = bool(gf.visible)
+            mask = 0
+            for bsid in bs_links:
+                code = specimens.get(bsid, unknown)
+                if code == HIDDEN:
+                    visible = False
+                    break
+                mask |= 1 << code
+            key = (
+                visible,
+                _access_class(gf.controlled_access),
+                mask if visible else 0,
+            )
+            decision = memo.get(key)
+            if decision is None:
+                decision = memo[key] = self._decide(*key)
+            acl, acl_tuple, alert, rule, acl_json = decision
+
+            if alert == NULL_ACCESS:
+                alerts.append(NullAccess(gfid))
+            elif alert == INCONSISTENT_CODES:
+                alerts.append(
+                    InconsistentCodes(
+                        gfid, {self.specimen_codes.get(k) for k in bs_links}
+                    )
+                )
+            if decisions is not None:
+                detail = None
+                if alert == INCONSISTENT_CODES:
+                    detail = json.dumps(alerts[-1].codes)
+                elif gf.visible and not visible:
+                    rule = GF_HIDDEN_SPECIMEN
+                    detail = min(
+                        k for k in bs_links if specimens.get(k) == HIDDEN
+                    )
+                decisions.append((gfid, rule, acl_json, detail))
+            # genomic files with the same decision share one (read-only) list
+            if acl is not None and gf.acl != acl_tuple:
+                gf_patches[gfid]["acl"] = acl
+
+    def evaluate_facts(self, rows, patches, alerts, decisions=None):
+        """
+        Add ACL patches and alerts for genomic files whose biospecimens were
+        already reduced to the facts the rules need (see db_rules).
+
+        :param rows: (kf_id, visible, controlled_access, acl, the smallest
+            hidden contributing biospecimen or None, the consent codes of the
+            contributing biospecimens) for each genomic file
+        :param patches: {endpoint: {kf_id: patch}} to add to
+        :param alerts: list of alerts to add to
+        :param decisions: optional list to add a decisions.DecisionIndex row
+            to for each genomic file
+        :returns: the number of rows
+        """
+        memo = self.decisions
+        gf_patches = patches["genomic-files"]
+        n = 0
+        for gfid, gf_visible, controlled_access, acl, hidden_by, codes in rows:
+            n += 1
+            visible = bool(gf_visible) and hidden_by is None
+            mask = 0
+            if visible:
+                for code in codes:
+                    mask |= 1 << self._code_id(code)
+            key = (visible, _access_class(controlled_access), mask)
+            decision = memo.get(key)
+            if decision is None:
+                decision = memo[key] = self._decide(*key)
+            new_acl, acl_tuple, alert, rule, acl_json = decision
+
+            if alert == NULL_ACCESS:
+                alerts.append(NullAccess(gfid))
+            elif alert == INCONSISTENT_CODES:
+                alerts.append(InconsistentCodes(gfid, codes))
+            if decisions is not None:
+                detail = None
+                if alert == INCONSISTENT_CODES:
+                    detail = json.dumps(alerts[-1].codes)
+                elif gf_visible and not visible:
+                    rule = GF_HIDDEN_SPECIMEN
+                    detail = hidden_by
+                decisions.append((gfid, rule, acl_json, detail))
+            if new_acl is not None and (
+                acl is None or tuple(sorted(acl)) != acl_tuple
+            ):
+                gf_patches[gfid]["acl"] = new_acl
+        return n
+
+
+def batched_acls(
+    study_id,
+    study_phs,
+    entities,
+    genomic_files,
+    specimen_codes,
+    hidden_specimens,
+    patches,
+    alerts,
+    decisions=None,
+):
+    """
+    Add ACL patches and alerts for the given genomic files.
+
+    :param genomic_files: kf_ids of the genomic files to evaluate
+    :param specimen_codes: {biospecimen kf_id: dbgap_consent_code}
+    :param hidden_specimens: biospecimens that are or will be hidden
+    :param patches: {endpoint: {kf_id: patch}} to add to
+    :param alerts: list of alerts to add to
+    :param decisions: optional list of decision rows to add to
+    """
+    AclEngine(study_id, study_phs, specimen_codes, hidden_specimens).evaluate(
+        entities, genomic_files, patches, alerts, decisions
+    )
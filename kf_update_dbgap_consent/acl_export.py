@@ -0,0 +1,210 @@
+"""
+Exports of the final ACL of every genomic file, for loading into indexd
+without reading the ACLs back from the dataservice.
+
+An export is NDJSON, gzip-compressed if its path ends in ".gz" (see
+plan.open_plan). It starts with a table of the distinct ACLs, sorted:
+
+    {"type": "acl", "id": 0, "acl": ["SD_12345678", "phs001138.c999"]}
+
+followed by one line per genomic file, sorted by kf_id with each kf_id
+appearing once:
+
+    {"type": "gf", "kf_id": ..., "latest_did": ..., "study_id": ...,
+     "acl": <id in the ACL table, or null if the file has no ACL>}
+
+A genomic file's final ACL is the one the rules patch it with, or its
+current ACL if it isn't patched, so every genomic file of a study is
+exported and not only changed ones. Sorted exports, e.g. from separate
+runs, are merged into one with merge_exports without being loaded into
+memory, and an AclExport does the same with the sorted run it writes for
+each study (or streamed chunk of one).
+"""
+
+import heapq
+import json
+import os
+import shutil
+import tempfile
+import threading
+from itertools import chain, groupby
+
+from kf_update_dbgap_consent.plan import open_plan
+
+
+def final_acls(genomic_files, gf_patches):
+    """
+    :param genomic_files: {kf_id: entities.GenomicFile}
+    :param gf_patches: {kf_id: patch} of the genomic files
+    :yields: (kf_id, latest_did, final ACL) for every genomic file
+    """
+    for gfid, gf in genomic_files.items():
+        patch = gf_patches.get(gfid)
+        if patch and "acl" in patch:
+            yield gfid, gf.latest_did, patch["acl"]
+        else:
+            yield gfid, gf.latest_did, gf.acl
+
+
+def write_export(path, study_id, rows):
+    """
+    Write one study's (kf_id, latest_did, acl) rows as a sorted export
+
+    :returns: the number of genomic files written
+    """
+    rows = sorted(rows, key=lambda row: row[0])
+    acls = sorted({tuple(sorted(acl)) for _, _, acl in rows if acl is not None})
+    acl_ids = {acl: i for i, acl in enumerate(acls)}
+    with open_plan(path, "w") as f:
+        for acl, i in acl_ids.items():
+            _write(f, {"type": "acl", "id": i, "acl": list(acl)})
+        for gfid, did, acl in rows:
+            _write(
+                f,
+                {
+                    "type": "gf",
+                    "kf_id": gfid,
+                    "latest_did": did,
+                    "study_id": study_id,
+                    "acl": None if acl is None else acl_ids[tuple(sorted(acl))],
+                },
+            )
+    return len(rows)
+
+
+def _write(f, record):
+    f.write(json.dumps(record, sort_keys=True))
+    f.write("\n")
+
+
+def _read(f):
+    """
+    Read an export's ACL table, leaving f at its first genomic file
+
+    :returns: ({id: ACL tuple}, first genomic file record or None)
+    """
+    table = {}
+    for line in f:
+        record = json.loads(line)
+        if record["type"] != "acl":
+            return table, record
+        table[record["id"]] = tuple(record["acl"])
+    return table, None
+
+
+def _records(f, first, ids):
+    """
+    :param ids: {ID in f's ACL table: ID in the merged ACL table}
+    :yields: f's genomic file records with merged ACL IDs
+    """
+    if first is None:
+        return
+    for record in chain([first], map(json.loads, f)):
+        if record["acl"] is not None:
+            record["acl"] = ids[record["acl"]]
+        yield record
+
+
+def merge_exports(inputs, path):
+    """
+    Merge sorted exports into one, keeping the first input's record for a
+    genomic file that appears in more than one.
+
+    :returns: (number of genomic files written, number of them whose ACLs
+        differed between inputs)
+    """
+    files = [open_plan(p) for p in inputs]
+    try:
+        tables = [_read(f) for f in files]
+        acls = sorted({acl for table, _ in tables for acl in table.values()})
+        acl_ids = {acl: i for i, acl in enumerate(acls)}
+        streams = [
+            _records(f, first, {i: acl_ids[acl] for i, acl in table.items()})
+            for f, (table, first) in zip(files, tables)
+        ]
+        written = conflicts = 0
+        with open_plan(path, "w") as out:
+            for acl, i in acl_ids.items():
+                _write(out, {"type": "acl", "id": i, "acl": list(acl)})
+            for _, records in groupby(
+                heapq.merge(*streams, key=lambda r: r["kf_id"]),
+                key=lambda r: r["kf_id"],
+            ):
+                record = next(records)
+                if any(r["acl"] != record["acl"] for r in records):
+                    conflicts += 1
+                _write(out, record)
+                written += 1
+    finally:
+        for f in files:
+            f.close()
+    return written, conflicts
+
+
+class AclExport:
+    """
+    Collects the final genomic file ACLs of a run's studies as sorted runs
+    in a temporary directory, and merges them into one export at path when
+    closed. Studies that failed should be discarded first, so that the
+    export only holds complete studies. Nothing is written if the run
+    raises. Safe to share between threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dir = tempfile.mkdtemp(prefix="dbgapconsent-acls-")
+        # [(study_id, run path), ...]
+        self.runs = []
+        self.n_runs = 0
+        self.discarded = set()
+        self._lock = threading.Lock()
+
+    def add(self, study_id, rows):
+        """
+        Add (kf_id, latest_did, acl) rows of a study's genomic files
+        """
+        with self._lock:
+            run = os.path.join(self.dir, f"{self.n_runs}.ndjson")
+            self.n_runs += 1
+            self.runs.append((study_id, run))
+        write_export(run, study_id, rows)
+
+    def discard(self, study_id):
+        """
+        Drop everything added for a study, e.g. one that failed part way
+        """
+        with self._lock:
+            runs = [run for s, run in self.runs if s == study_id]
+            self.runs = [(s, run) for s, run in self.runs if s != study_id]
+            self.discarded.add(study_id)
+        for run in runs:
+            os.remove(run)
+
+    def close(self):
+        try:
+            written, conflicts = merge_exports(
+                [run for _, run in self.runs], self.path
+            )
+            print(f"Exported the ACLs of {written} genomic files")
+            if conflicts:
+                print(
+                    f"WARNING: {conflicts} genomic files got different ACLs"
+                    " in different studies, kept the first"
+                )
+            if self.discarded:
+                print(
+                    "WARNING: Left the genomic files of failed studies out of"
+                    f" the ACL export: {sorted(self.discarded)}"
+                )
+        finally:
+            shutil.rmtree(self.dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            print(f"WARNING: The run failed, not writing {self.path}")
@@ -0,0 +1,177 @@
+"""
+Structured alerts raised by the consent rules.
+
+The rules add typed alert records to a list instead of printing messages.
+str() of an alert is still the message it used to print. Once a study (or a
+streamed chunk of one) is done, its alerts are handed to an AlertLog. The
+log counts them by type and prints only the first console_limit of a run.
+It can also write every alert to an NDJSON or CSV file, so a study with
+hundreds of thousands of alerts doesn't flood, or slow down, the console.
+"""
+
+import csv
+import json
+import threading
+from collections import Counter
+
+from kf_update_dbgap_consent.defaults import DEFAULT_ALERT_CONSOLE_LIMIT
+
+# alert types
+MISSING_SAMPLE = "missing_sample"
+NULL_ACCESS = "null_access"
+INCONSISTENT_CODES = "inconsistent_codes"
+
+FIELDS = ["type", "study_id", "kf_id", "sample_id", "codes"]
+
+
+class Alert:
+    type = None
+    __slots__ = ("kf_id", "sample_id", "codes")
+
+    def __init__(self, kf_id=None, sample_id=None, codes=None):
+        self.kf_id = kf_id
+        self.sample_id = sample_id
+        self.codes = codes
+
+    def _key(self):
+        return (self.type, self.kf_id, self.sample_id, self.codes)
+
+    def __eq__(self, other):
+        return isinstance(other, Alert) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return f"{type(self).__name__}({str(self)!r})"
+
+    def to_dict(self, study_id=None):
+        return {
+            "type": self.type,
+            "study_id": study_id,
+            "kf_id": self.kf_id,
+            "sample_id": self.sample_id,
+            "codes": None if self.codes is None else list(self.codes),
+        }
+
+
+class MissingSample(Alert):
+    """
+    A Loaded dbGaP sample with no matching biospecimen
+    """
+
+    type = MISSING_SAMPLE
+    __slots__ = ()
+
+    def __init__(self, sample_id):
+        super().__init__(sample_id=sample_id)
+
+    def __str__(self):
+        return (
+            f"ALERT: sample {self.sample_id} from dbGaP not found in"
+            " dataservice"
+        )
+
+
+class NullAccess(Alert):
+    """
+    A visible genomic file with controlled_access null
+    """
+
+    type = NULL_ACCESS
+    __slots__ = ()
+
+    def __init__(self, kf_id):
+        super().__init__(kf_id=kf_id)
+
+    def __str__(self):
+        return (
+            f"ALERT: GF {self.kf_id} is visible but has controlled_access"
+            " set to null instead of True/False."
+        )
+
+
+class InconsistentCodes(Alert):
+    """
+    A visible genomic file whose biospecimens have different consent codes
+    """
+
+    type = INCONSISTENT_CODES
+    __slots__ = ()
+
+    def __init__(self, kf_id, codes):
+        super().__init__(kf_id=kf_id, codes=tuple(sorted(codes, key=str)))
+
+    def __str__(self):
+        return (
+            f"ALERT: GF {self.kf_id} has inconsistent sample access"
+            f" codes {set(self.codes)}"
+        )
+
+
+class AlertLog:
+    """
+    Collects the alerts of a run. Safe to share between threads.
+
+    :param path: optional file to write every alert to, as CSV if it ends in
+        .csv and NDJSON otherwise
+    :param console_limit: how many alerts of the run to print
+    """
+
+    def __init__(self, path=None, console_limit=DEFAULT_ALERT_CONSOLE_LIMIT):
+        self.path = path
+        self.console_limit = console_limit
+        self.counts = Counter()
+        self.printed = 0
+        self.file = None
+        self.writer = None
+        if path:
+            self.file = open(path, "w", newline="")
+            if path.endswith(".csv"):
+                self.writer = csv.writer(self.file)
+                self.writer.writerow(FIELDS)
+        self._lock = threading.Lock()
+
+    def add(self, study_id, alerts):
+        with self._lock:
+            for alert in alerts:
+                self.counts[alert.type] += 1
+                if self.printed < self.console_limit:
+                    print(alert)
+                    self.printed += 1
+                if self.writer:
+                    row = alert.to_dict(study_id)
+                    if row["codes"] is not None:
+                        row["codes"] = " ".join(map(str, row["codes"]))
+                    self.writer.writerow([row[k] for k in FIELDS])
+                elif self.file:
+                    self.file.write(json.dumps(alert.to_dict(study_id)))
+                    self.file.write("\n")
+
+    def summary(self):
+        total = sum(self.counts.values())
+        if not total:
+            return "No alerts"
+        counts = ", ".join(f"{n} {t}" for t, n in sorted(self.counts.items()))
+        text = f"{total} alerts: {counts}"
+        if total > self.printed:
+            text += f" ({total - self.printed} not printed"
+            text += f", see {self.path})" if self.path else ")"
+        return text
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def count_alerts(alerts):
+    """
+    :returns: {alert type: count}
+    """
+    return dict(Counter(a.type for a in alerts))
@@ -1,21 +1,34 @@
 #!/usr/bin/env python
 import argparse
+import sys
+import time
 from argparse import RawTextHelpFormatter
+from collections import defaultdict
+from contextlib import nullcontext
 from pprint import pprint
 
-from kf_utils.dataservice.patch import send_patches
-from kf_update_dbgap_consent.sample_status import ConsentProcessor
+# Only defaults are imported up front. Everything else (the HTTP client, the
+# database drivers, the dataservice scraper, the patch sender, XML parsing) is
+# imported by the command that needs it, once its arguments are parsed, so
+# that --help and argument errors are instant and each run loads only the
+# paths it takes.
+from kf_update_dbgap_consent.defaults import (
+    DEFAULT_ALERT_CONSOLE_LIMIT,
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_ENTITY_CACHE_SIZE,
+    DEFAULT_ENTITY_TTL,
+    DEFAULT_INTERVAL,
+    DEFAULT_PATCH_WORKERS,
+    DEFAULT_PORT,
+    DEFAULT_SAMPLE_CACHE_SIZE,
+    DEFAULT_SCRAPE_WORKERS,
+    DEFAULT_WORKERS,
+)
 
 SERVER_DEFAULT = "http://localhost:5000"
 
 
-def cli():
-    parser = argparse.ArgumentParser(
-        formatter_class=RawTextHelpFormatter, allow_abbrev=False
-    )
-    parser.add_argument(
-        "study", help="Which study to target\n - e.g. SD_1234567"
-    )
+def _add_server_arguments(parser):
     parser.add_argument(
         "--server",
         default=SERVER_DEFAULT,
@@ -32,10 +45,88 @@ def cli():
         ),
     )
     parser.add_argument(
-        "--dry_run",
+        "--pool_size",
+        type=int,
+        help=(
+            "How many keep-alive connections to hold open to each server\n"
+            " - Defaults to enough for every worker"
+        ),
+    )
+
+
+def _add_study_arguments(parser):
+    parser.add_argument(
+        "study",
+        nargs="*",
+        help="Which study or studies to target\n - e.g. SD_1234567",
+    )
+    parser.add_argument(
+        "--all_studies",
         action="store_true",
         default=False,
-        help="Collect patches but don't apply them",
+        help="Target every study in the dataservice governed by dbGaP",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=(
+            "How many studies to process at once\n"
+            f" - Defaults to {DEFAULT_WORKERS}"
+        ),
+    )
+    parser.add_argument(
+        "--summary_file",
+        help="Optional path to write a combined JSON summary of all studies",
+    )
+    parser.add_argument(
+        "--alerts_file",
+        help=(
+            "Optional path to write every alert to, as CSV if it ends in .csv\n"
+            "and NDJSON otherwise"
+        ),
+    )
+    parser.add_argument(
+        "--alert_console_limit",
+        type=int,
+        default=DEFAULT_ALERT_CONSOLE_LIMIT,
+        help=(
+            "How many alerts to print before only counting them\n"
+            f" - Defaults to {DEFAULT_ALERT_CONSOLE_LIMIT}"
+        ),
+    )
+    _add_server_arguments(parser)
+    parser.add_argument(
+        "--scrape_workers",
+        type=int,
+        default=DEFAULT_SCRAPE_WORKERS,
+        help=(
+            "How many pages to fetch at once when scraping a study from the\n"
+            f"dataservice\n - Defaults to {DEFAULT_SCRAPE_WORKERS}"
+        ),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help=(
+            "Optional directory for caching parsed dbGaP sample status files.\n"
+            " - A released accession is only downloaded and parsed once"
+        ),
+    )
+    parser.add_argument(
+        "--state_dir",
+        help=(
+            "Optional directory for recording the dbGaP samples used by each\n"
+            "study's last applied run. Required by --delta."
+        ),
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        default=False,
+        help=(
+            "Only recompute consent for samples that changed in dbGaP since\n"
+            "the last applied run recorded in --state_dir"
+        ),
     )
     parser.add_argument(
         "--match_aliquot",
@@ -46,21 +137,968 @@ def cli():
             " - Defaults to match on `external_sample_id`"
         ),
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        default=False,
+        help=(
+            "Spool each study to a temporary file and compute its patches in\n"
+            "chunks of genomic files, handling each chunk as it's done.\n"
+            " - Memory use depends on --chunk_size instead of study size\n"
+            " - When applying, a study's chunks are spooled to a temporary\n"
+            "   file and applied once the whole study is done"
+        ),
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=(
+            "How many genomic files to evaluate at once with --stream\n"
+            f" - Defaults to {DEFAULT_CHUNK_SIZE}"
+        ),
+    )
+    parser.add_argument(
+        "--snapshot_dir",
+        help=(
+            "Optional directory for keeping a snapshot of each study's rows\n"
+            "from the --db_url database. Later runs only read the rows\n"
+            "modified since."
+        ),
+    )
+    parser.add_argument(
+        "--full_refresh",
+        action="store_true",
+        default=False,
+        help="Read every row again when refreshing --snapshot_dir snapshots",
+    )
+    parser.add_argument(
+        "--rules_in_db",
+        action="store_true",
+        default=False,
+        help=(
+            "Evaluate the rules inside the --db_url database with set-based\n"
+            "queries, and only read the entities that need changes.\n"
+            " - Can't be combined with --delta or --stream"
+        ),
+    )
+    parser.add_argument(
+        "--acl_export",
+        help=(
+            "Optional path to write the final ACL of every genomic file of\n"
+            "the studies to, as NDJSON sorted by kf_id, gzipped if it ends\n"
+            "in .gz\n"
+            " - Merge exports with dbgapconsent-merge-acls\n"
+            " - Can't be combined with --delta"
+        ),
+    )
+
+
+def _add_apply_arguments(parser):
+    parser.add_argument(
+        "--apply_via_db",
+        action="store_true",
+        default=False,
+        help=(
+            "Write patches directly to the --db_url database with bulk\n"
+            "UPDATEs instead of sending them through the dataservice API.\n"
+            " - This bypasses the API's genomic file sync to indexd"
+        ),
+    )
+    parser.add_argument(
+        "--patch_workers",
+        type=int,
+        default=DEFAULT_PATCH_WORKERS,
+        help=(
+            "How many patches to send to the dataservice at once\n"
+            f" - Defaults to {DEFAULT_PATCH_WORKERS}"
+        ),
+    )
+    parser.add_argument(
+        "--journal",
+        help=(
+            "Optional file recording every applied patch. Rerunning with the\n"
+            "same journal skips patches that were already applied."
+        ),
+    )
+
+
+def _add_metrics_arguments(parser):
+    parser.add_argument(
+        "--metrics_file",
+        help=(
+            "Optional path to write a JSON report of phase timings, request\n"
+            "latencies, database query times, counters, and peak memory"
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="Print a summary of the metrics report at the end of the run",
+    )
+
+
+def _check_study_arguments(parser, args, session):
+    if args.all_studies and args.study:
+        parser.error("Specify either studies or --all_studies, not both")
+    if not (args.study or args.all_studies):
+        parser.error("Specify at least one study or --all_studies")
+    if args.delta and not args.state_dir:
+        parser.error("--delta requires --state_dir")
+    if args.delta and args.stream:
+        parser.error("--delta can't be combined with --stream")
+    if args.rules_in_db and (args.delta or args.stream):
+        parser.error("--rules_in_db can't be combined with --delta or --stream")
+    # delta runs skip studies whose samples didn't change
+    if args.acl_export and args.delta:
+        parser.error("--acl_export can't be combined with --delta")
+    # only scrape the studies once the arguments are known to be good
+    if not args.all_studies:
+        return args.study
+    from kf_update_dbgap_consent.batch import find_dbgap_studies
+
+    study_ids = find_dbgap_studies(args.server, session)
+    if not study_ids:
+        parser.error(f"No studies governed by dbGaP found in {args.server}")
+    return study_ids
+
+
+def _decision_index(path):
+    if not path:
+        return nullcontext()
+    from kf_update_dbgap_consent.decisions import DecisionIndex
+
+    return DecisionIndex(path)
+
+
+def _acl_export(path):
+    if not path:
+        return nullcontext()
+    from kf_update_dbgap_consent.acl_export import AclExport
+
+    return AclExport(path)
+
+
+def _discard_failed(acl_export, results):
+    if acl_export:
+        for study_id, result in results.items():
+            if result["error"]:
+                acl_export.discard(study_id)
+
+
+def _alert_log(args):
+    from kf_update_dbgap_consent.alerts import AlertLog
+
+    return AlertLog(args.alerts_file, args.alert_console_limit)
+
+
+def _processor(parser, args, metrics):
+    from kf_update_dbgap_consent.client import pool_size_for
+    from kf_update_dbgap_consent.sample_status import ConsentProcessor
+
+    if args.snapshot_dir and not args.db_url:
+        parser.error("--snapshot_dir requires --db_url")
+    if args.rules_in_db and not args.db_url:
+        parser.error("--rules_in_db requires --db_url")
+    return ConsentProcessor(
+        args.server,
+        args.db_url,
+        cache_dir=args.cache_dir,
+        state_dir=args.state_dir,
+        metrics=metrics,
+        scrape_workers=args.scrape_workers,
+        pool_size=args.pool_size
+        or pool_size_for(
+            # each study's scrape, and its study lookup alongside
+            args.workers * (args.scrape_workers + 1),
+            getattr(args, "patch_workers", 0),
+        ),
+        snapshot_dir=args.snapshot_dir,
+        full_refresh=args.full_refresh,
+        rules_in_db=args.rules_in_db,
+    )
+
+
+def _process(args, processor, study_ids, on_result=None):
+    from kf_update_dbgap_consent.batch import process_studies
+
+    return process_studies(
+        processor,
+        study_ids,
+        workers=args.workers,
+        on_result=on_result,
+        match_aliquot=args.match_aliquot,
+        delta=args.delta,
+    )
+
+
+def _stream(args, processor, study_ids, on_chunk, on_result=None):
+    from kf_update_dbgap_consent.batch import stream_studies
+
+    return stream_studies(
+        processor,
+        study_ids,
+        on_chunk,
+        workers=args.workers,
+        on_result=on_result,
+        match_aliquot=args.match_aliquot,
+        chunk_size=args.chunk_size,
+    )
+
+
+def _write_summary(args, results):
+    if args.summary_file:
+        from kf_update_dbgap_consent.batch import write_summary
+
+        write_summary(args.summary_file, results)
+
+
+def _report(args, metrics):
+    if args.metrics_file:
+        metrics.write(args.metrics_file)
+    if args.profile:
+        print(metrics.summary())
+
+
+def _applier(args, session, metrics):
+    from kf_update_dbgap_consent.apply import PatchApplier
+
+    return PatchApplier(
+        args.server,
+        workers=args.patch_workers,
+        journal_path=args.journal,
+        session=session,
+        metrics=metrics,
+    )
+
+
+def _print_applied(applied, what="patches"):
+    print(
+        f"Applied {applied['applied']} {what}, skipped"
+        f" {applied['skipped']} already applied,"
+        f" {len(applied['failed'])} failed"
+    )
+
+
+def _apply_via_db(args, applier, records, metrics):
+    """
+    Write patches to the --db_url database, except for the fields the
+    dataservice keeps in indexd (genomic file ACLs), which are sent through
+    the API so that they reach indexd.
+
+    :param records: called for a new stream of (endpoint, kf_id, patch)
+    :returns: the PatchApplier result of the patches sent through the API
+    """
+    from kf_update_dbgap_consent.db import (
+        apply_records_to_db,
+        db_records,
+        indexd_records,
+    )
+
+    updated = apply_records_to_db(
+        args.db_url, db_records(records()), metrics=metrics
+    )
+    print(f"Updated {sum(updated.values())} rows: {updated}")
+    applied = applier.apply_records(indexd_records(records()))
+    _print_applied(applied, "indexd patches through the API")
+    return applied
+
+
+def _process_and_apply(args, processor, study_ids, metrics):
+    def forget_samples(study_id, result):
+        # the samples are only kept to save the state of applied studies
+        if not args.state_dir or args.dry_run or result["error"]:
+            processor.used_samples.pop(study_id, None)
+
+    results = _process(args, processor, study_ids, forget_samples)
+
+    all_patches = defaultdict(dict)
+    for result in results.values():
+        for endpoint, endpoint_patches in result["patches"].items():
+            all_patches[endpoint].update(endpoint_patches)
+
+    if args.dry_run:
+        pprint(
+            {
+                kfid: patch
+                for endpoint_patches in all_patches.values()
+                for kfid, patch in endpoint_patches.items()
+            }
+        )
+        return results
+
+    from kf_update_dbgap_consent.apply import iter_patches
+
+    applier = _applier(args, processor.session, metrics)
+    if args.apply_via_db:
+        applied = _apply_via_db(
+            args, applier, lambda: iter_patches(all_patches), metrics
+        )
+    else:
+        applied = applier.apply(all_patches)
+        _print_applied(applied)
+    for study_id, result in results.items():
+        if any(
+            kfid in applied["failed"]
+            for endpoint_patches in result["patches"].values()
+            for kfid in endpoint_patches
+        ):
+            result["error"] = "Some patches failed to apply"
+        elif args.state_dir and not result["error"]:
+            processor.save_state(study_id)
+        processor.used_samples.pop(study_id, None)
+    return results
+
+
+def _stream_and_apply(args, processor, study_ids, metrics):
+    if args.dry_run:
+
+        def print_chunk(study_id, patches, alerts):
+            pprint(
+                {
+                    kfid: patch
+                    for endpoint_patches in patches.values()
+                    for kfid, patch in endpoint_patches.items()
+                }
+            )
+
+        results = _stream(args, processor, study_ids, print_chunk)
+        for study_id in results:
+            processor.used_samples.pop(study_id, None)
+        return results
+
+    import os
+    import tempfile
+
+    from kf_update_dbgap_consent.plan import (
+        PlanWriter,
+        patch_records,
+        read_plan,
+    )
+
+    applier = _applier(args, processor.session, metrics)
+    # each study's chunks are spooled to a temporary plan and only applied
+    # once the whole study is done, so a study that fails partway changes
+    # nothing
+    spools = {}
+
+    def spool(study_id, patches, alerts):
+        if study_id not in spools:
+            fd, path = tempfile.mkstemp(
+                prefix=f"dbgapconsent-{study_id}-", suffix=".ndjson"
+            )
+            os.close(fd)
+            spools[study_id] = (path, PlanWriter(path))
+        spools[study_id][1].write_patches(study_id, patches)
+
+    def apply(study_id, result):
+        if study_id not in spools:
+            return
+        path, writer = spools.pop(study_id)
+        writer.close()
+        try:
+            if result["error"]:
+                return
+            if args.apply_via_db:
+                applied = _apply_via_db(
+                    args,
+                    applier,
+                    lambda: patch_records(read_plan(path)),
+                    metrics,
+                )
+            else:
+                applied = applier.apply_records(patch_records(read_plan(path)))
+                _print_applied(applied)
+            if applied["failed"]:
+                result["error"] = (
+                    f"{len(applied['failed'])} patches failed to apply"
+                )
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            os.remove(path)
+        if result["error"]:
+            print(f"ERROR: {study_id} failed: {result['error']}")
+
+    results = _stream(args, processor, study_ids, spool, apply)
+    for study_id, result in results.items():
+        if args.state_dir and not result["error"]:
+            processor.save_state(study_id)
+        processor.used_samples.pop(study_id, None)
+    return results
+
+
+def cli():
+    parser = argparse.ArgumentParser(
+        formatter_class=RawTextHelpFormatter, allow_abbrev=False
+    )
+    _add_study_arguments(parser)
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        default=False,
+        help="Collect patches but don't apply them",
+    )
+    parser.add_argument(
+        "--decisions",
+        help=(
+            "Optional path to write an index of the rule behind every\n"
+            "biospecimen and genomic file result to\n"
+            " - Look results up with dbgapconsent-explain"
+        ),
+    )
+    _add_apply_arguments(parser)
+    _add_metrics_arguments(parser)
     args = parser.parse_args()
     print(f"Args: {args.__dict__}")
+    from kf_update_dbgap_consent.metrics import Metrics
 
-    patches, alerts = ConsentProcessor(
-        args.server, args.db_url
-    ).get_patches_for_study(args.study, match_aliquot=args.match_aliquot)
+    metrics = Metrics()
+    if args.apply_via_db and not args.db_url:
+        parser.error("--apply_via_db requires --db_url")
+    processor = _processor(parser, args, metrics)
+    study_ids = _check_study_arguments(parser, args, processor.session)
+    with _decision_index(args.decisions) as decisions, _alert_log(
+        args
+    ) as alert_log, _acl_export(args.acl_export) as acl_export:
+        processor.decisions = decisions
+        processor.alert_log = alert_log
+        processor.acl_export = acl_export
+        if args.stream:
+            results = _stream_and_apply(args, processor, study_ids, metrics)
+        else:
+            results = _process_and_apply(args, processor, study_ids, metrics)
+        _discard_failed(acl_export, results)
 
-    all_patches = {}
-    for endpoint_patches in patches.values():
-        all_patches.update(endpoint_patches)
+    print(alert_log.summary())
+    _write_summary(args, results)
+    _report(args, metrics)
 
-    if args.dry_run:
-        pprint(all_patches)
+    failed = [k for k, v in results.items() if v["error"]]
+    if failed:
+        sys.exit(f"Failed studies: {failed}")
+
+
+def plan_cli():
+    """
+    Compute patches and write them to a plan file without applying them
+    """
+    parser = argparse.ArgumentParser(
+        description=plan_cli.__doc__.strip(),
+        formatter_class=RawTextHelpFormatter,
+        allow_abbrev=False,
+    )
+    _add_study_arguments(parser)
+    parser.add_argument(
+        "--plan",
+        required=True,
+        help=(
+            "Path of the NDJSON plan file to write, gzipped if it ends in .gz\n"
+            " - Apply it later with dbgapconsent-apply"
+        ),
+    )
+    parser.add_argument(
+        "--decisions",
+        help=(
+            "Path to write an index of the rule behind every biospecimen and\n"
+            "genomic file result to\n"
+            " - Defaults to <plan>.decisions.sqlite next to the plan\n"
+            " - Look results up with dbgapconsent-explain"
+        ),
+    )
+    _add_metrics_arguments(parser)
+    args = parser.parse_args()
+    print(f"Args: {args.__dict__}")
+    from kf_update_dbgap_consent.decisions import DecisionIndex, decisions_path
+    from kf_update_dbgap_consent.metrics import Metrics
+    from kf_update_dbgap_consent.plan import PlanWriter
+
+    metrics = Metrics()
+    processor = _processor(parser, args, metrics)
+    study_ids = _check_study_arguments(parser, args, processor.session)
+    decisions_file = args.decisions or decisions_path(args.plan)
+    with DecisionIndex(decisions_file) as decisions, _alert_log(
+        args
+    ) as alert_log, PlanWriter(args.plan) as writer, _acl_export(
+        args.acl_export
+    ) as acl_export:
+        processor.decisions = decisions
+        processor.alert_log = alert_log
+        processor.acl_export = acl_export
+
+        def write(study_id, result):
+            accession, _, match_aliquot = processor.used_samples.pop(
+                study_id, (None, None, args.match_aliquot)
+            )
+            writer.write_study(study_id, result, accession, match_aliquot)
+
+        if args.stream:
+
+            def write_chunk(study_id, patches, alerts):
+                accession = processor.used_samples[study_id][0]
+                writer.write_patches(study_id, patches, accession)
+
+            results = _stream(args, processor, study_ids, write_chunk, write)
+        else:
+            results = _process(args, processor, study_ids, write)
+        _discard_failed(acl_export, results)
+
+    print(alert_log.summary())
+    print(f"Wrote plan to {args.plan} and decisions to {decisions_file}")
+    _write_summary(args, results)
+    _report(args, metrics)
+
+    failed = [k for k, v in results.items() if v["error"]]
+    if failed:
+        sys.exit(f"Failed studies: {failed}")
+
+
+def apply_cli():
+    """
+    Apply a plan file written by dbgapconsent-plan
+    """
+    parser = argparse.ArgumentParser(
+        description=apply_cli.__doc__.strip(),
+        formatter_class=RawTextHelpFormatter,
+        allow_abbrev=False,
+    )
+    parser.add_argument("plan", help="Path of the plan file to apply")
+    _add_server_arguments(parser)
+    _add_apply_arguments(parser)
+    parser.add_argument(
+        "--state_dir",
+        help=(
+            "Optional directory for recording the dbGaP samples used by each\n"
+            "applied study, for later --delta runs. Requires --cache_dir."
+        ),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help=(
+            "The sample status cache directory the plan was computed with,\n"
+            "used to look up the samples recorded in --state_dir"
+        ),
+    )
+    _add_metrics_arguments(parser)
+    args = parser.parse_args()
+    print(f"Args: {args.__dict__}")
+
+    if args.apply_via_db and not args.db_url:
+        parser.error("--apply_via_db requires --db_url")
+    if args.state_dir and not args.cache_dir:
+        parser.error("--state_dir requires --cache_dir")
+    from kf_update_dbgap_consent.client import HttpClient, pool_size_for
+    from kf_update_dbgap_consent.metrics import Metrics
+    from kf_update_dbgap_consent.plan import (
+        complete_studies,
+        patch_records,
+        read_plan,
+        read_studies,
+    )
+
+    metrics = Metrics()
+    # a failed study's plan can hold some of its patches (e.g. with
+    # --stream), which must not be applied without the rest
+    studies = read_studies(args.plan)
+    complete = complete_studies(studies)
+    for study_id in sorted(set(studies) - complete):
+        print(
+            f"WARNING: {study_id} failed while planning, not applying its"
+            f" patches: {studies[study_id]['error']}"
+        )
+    applier = _applier(
+        args,
+        HttpClient(
+            pool_size=args.pool_size or pool_size_for(args.patch_workers)
+        ),
+        metrics,
+    )
+    if args.apply_via_db:
+        applied = _apply_via_db(
+            args,
+            applier,
+            lambda: patch_records(read_plan(args.plan), study_ids=complete),
+            metrics,
+        )
     else:
-        send_patches(args.server, all_patches)
+        applied = applier.apply_records(
+            patch_records(read_plan(args.plan), study_ids=complete)
+        )
+        _print_applied(applied)
+    failed_kfids = set(applied["failed"])
+
+    # studies with patches that failed to apply or weren't applied, including
+    # those whose planning was cut off before their study record
+    failed = {
+        r["study_id"]
+        for r in read_plan(args.plan)
+        if r["type"] == "patch"
+        and (r["kf_id"] in failed_kfids or r["study_id"] not in complete)
+    }
+    failed.update(set(studies) - complete)
+    if args.state_dir:
+        from kf_update_dbgap_consent.dbgap import SampleStatusCache
+        from kf_update_dbgap_consent.delta import ConsentState
+
+        state = ConsentState(args.state_dir)
+        cache = SampleStatusCache(args.cache_dir)
+        for study_id, study in studies.items():
+            if study_id in failed or not study["accession"]:
+                continue
+            samples = cache.get(study["accession"])
+            if samples is None:
+                print(
+                    f"WARNING: {study['accession']} is not in {args.cache_dir},"
+                    f" not recording state for {study_id}"
+                )
+                continue
+            state.save(
+                study_id, study["accession"], samples, study["match_aliquot"]
+            )
+    _report(args, metrics)
+
+    if failed:
+        sys.exit(f"Failed studies: {sorted(failed)}")
+
+
+def explain_cli():
+    """
+    Explain why biospecimens and genomic files got their consent fields,
+    visibility, and ACLs, from the decisions recorded by dbgapconsent-plan
+    or dbgapconsent --decisions
+    """
+    parser = argparse.ArgumentParser(
+        description=explain_cli.__doc__.strip(),
+        formatter_class=RawTextHelpFormatter,
+        allow_abbrev=False,
+    )
+    parser.add_argument("decisions", help="Path of the decisions file")
+    parser.add_argument(
+        "kf_id", nargs="+", help="Biospecimen or genomic file KF IDs"
+    )
+    args = parser.parse_args()
+    from kf_update_dbgap_consent.decisions import explain
+
+    missing = []
+    for kfid in args.kf_id:
+        e = explain(args.decisions, kfid)
+        if e is None:
+            missing.append(kfid)
+            continue
+        print(f"{kfid} ({e['endpoint']} of {e['study_id']}, {e['accession']})")
+        print(f"  rule: {e['rule']} - {e['description']}")
+        if e["acl"] is not None:
+            print(f"  acl: {e['acl']}")
+        if e["detail"]:
+            print(f"  detail: {e['detail']}")
+    if missing:
+        sys.exit(f"No decisions recorded for {missing}")
+
+
+def merge_acls_cli():
+    """
+    Merge ACL exports written by dbgapconsent --acl_export or
+    dbgapconsent-plan --acl_export, e.g. from separate runs, into one
+    """
+    parser = argparse.ArgumentParser(
+        description=merge_acls_cli.__doc__.strip(),
+        formatter_class=RawTextHelpFormatter,
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "output", help="Path of the merged export, gzipped if it ends in .gz"
+    )
+    parser.add_argument(
+        "exports",
+        nargs="+",
+        help=(
+            "Paths of the exports to merge\n"
+            " - A genomic file in more than one keeps its record from the\n"
+            "   first"
+        ),
+    )
+    args = parser.parse_args()
+    from kf_update_dbgap_consent.acl_export import merge_exports
+
+    written, conflicts = merge_exports(args.exports, args.output)
+    print(f"Wrote the ACLs of {written} genomic files to {args.output}")
+    if conflicts:
+        print(
+            f"WARNING: {conflicts} genomic files had different ACLs in"
+            " different exports, kept the first"
+        )
+
+
+def service_cli():
+    """
+    Run a long-lived consent service with a local HTTP API for submitting
+    studies, checking on jobs, and fetching their plans
+    """
+    parser = argparse.ArgumentParser(
+        description=service_cli.__doc__.strip(),
+        formatter_class=RawTextHelpFormatter,
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="Address to listen on\n - Defaults to 127.0.0.1",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"Port to listen on\n - Defaults to {DEFAULT_PORT}",
+    )
+    _add_server_arguments(parser)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=(
+            "How many jobs to run at once\n" f" - Defaults to {DEFAULT_WORKERS}"
+        ),
+    )
+    parser.add_argument(
+        "--patch_workers",
+        type=int,
+        default=DEFAULT_PATCH_WORKERS,
+        help=(
+            "How many patches to send to the dataservice at once\n"
+            f" - Defaults to {DEFAULT_PATCH_WORKERS}"
+        ),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help=(
+            "Optional directory backing the in-memory cache of parsed dbGaP\n"
+            "sample status files"
+        ),
+    )
+    parser.add_argument(
+        "--state_dir",
+        help=(
+            "Optional directory for recording the dbGaP samples used by each\n"
+            "applied job. Required by delta jobs."
+        ),
+    )
+    parser.add_argument(
+        "--plan_dir",
+        help=(
+            "Optional directory to keep job plans in\n"
+            " - Defaults to a temporary directory removed on exit"
+        ),
+    )
+    parser.add_argument(
+        "--sample_cache_size",
+        type=int,
+        default=DEFAULT_SAMPLE_CACHE_SIZE,
+        help=(
+            "How many dbGaP samples to keep parsed in memory\n"
+            f" - Defaults to {DEFAULT_SAMPLE_CACHE_SIZE}"
+        ),
+    )
+    parser.add_argument(
+        "--entity_cache_size",
+        type=int,
+        default=DEFAULT_ENTITY_CACHE_SIZE,
+        help=(
+            "How many study entities (biospecimens, genomic files, and links\n"
+            "between them) to keep indexed in memory\n"
+            f" - Defaults to {DEFAULT_ENTITY_CACHE_SIZE}"
+        ),
+    )
+    parser.add_argument(
+        "--entity_ttl",
+        type=float,
+        default=DEFAULT_ENTITY_TTL,
+        help=(
+            "Seconds before a study's cached entities are loaded again\n"
+            f" - Defaults to {DEFAULT_ENTITY_TTL}"
+        ),
+    )
+    args = parser.parse_args()
+    print(f"Args: {args.__dict__}")
+    from kf_update_dbgap_consent.service import ConsentService, make_server
+
+    service = ConsentService(
+        args.server,
+        args.db_url,
+        cache_dir=args.cache_dir,
+        state_dir=args.state_dir,
+        plan_dir=args.plan_dir,
+        workers=args.workers,
+        patch_workers=args.patch_workers,
+        sample_cache_size=args.sample_cache_size,
+        entity_cache_size=args.entity_cache_size,
+        entity_ttl=args.entity_ttl,
+        pool_size=args.pool_size,
+    )
+    server = make_server(service, args.host, args.port)
+    print(f"Listening on http://{args.host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
+
+
+def watch_cli():
+    """
+    Watch dbGaP for new sample status releases and queue consent runs only
+    for studies whose released version the dataservice doesn't have yet
+    """
+    parser = argparse.ArgumentParser(
+        description=watch_cli.__doc__.strip(),
+        formatter_class=RawTextHelpFormatter,
+        allow_abbrev=False,
+    )
+    parser.add_argument(
+        "study",
+        nargs="*",
+        help="Which study or studies to watch\n - e.g. SD_1234567",
+    )
+    parser.add_argument(
+        "--all_studies",
+        action="store_true",
+        default=False,
+        help=(
+            "Watch every study in the dataservice governed by dbGaP,\n"
+            "looking for new ones on every poll"
+        ),
+    )
+    parser.add_argument(
+        "--state_file",
+        required=True,
+        help="JSON file keeping what's known about each study between polls",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=DEFAULT_INTERVAL,
+        help=(
+            "About how many seconds between checks of each study\n"
+            f" - Defaults to {DEFAULT_INTERVAL}"
+        ),
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        default=False,
+        help="Check due studies once, wait for queued runs, and exit",
+    )
+    parser.add_argument(
+        "--service",
+        help=(
+            "URL of a running dbgapconsent-service to queue runs on\n"
+            " - By default runs are queued on a service in this process"
+        ),
+    )
+    parser.add_argument(
+        "--apply",
+        action="store_true",
+        default=False,
+        help="Apply the patches of queued runs instead of only planning them",
+    )
+    _add_server_arguments(parser)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=(
+            "How many queued runs to process at once in this process\n"
+            f" - Defaults to {DEFAULT_WORKERS}"
+        ),
+    )
+    parser.add_argument(
+        "--cache_dir",
+        help="Optional directory for caching parsed dbGaP sample status files",
+    )
+    parser.add_argument(
+        "--state_dir",
+        help=(
+            "Optional directory for recording the dbGaP samples used by each\n"
+            "applied run"
+        ),
+    )
+    args = parser.parse_args()
+    print(f"Args: {args.__dict__}")
+    if not (args.study or args.all_studies):
+        parser.error("Specify at least one study or --all_studies")
+    from kf_update_dbgap_consent.batch import find_dbgap_studies
+    from kf_update_dbgap_consent.watch import ReleaseWatcher
+
+    service = None
+    if args.service:
+        from kf_update_dbgap_consent.sample_status import ConsentProcessor
+
+        processor = ConsentProcessor(
+            args.server, args.db_url, pool_size=args.pool_size
+        )
+
+        def trigger(study_id, accession):
+            resp = processor.session.post(
+                f"{args.service.rstrip('/')}/jobs",
+                json={"study_id": study_id, "apply": args.apply},
+            )
+            if resp.status_code != 202:
+                raise Exception(
+                    f"Queueing {study_id} failed: {resp.status_code}"
+                    f" {resp.text}"
+                )
+            print(f"Queued {study_id} as job {resp.json()['job_id']}")
+
+    else:
+        from kf_update_dbgap_consent.service import ConsentService
+
+        service = ConsentService(
+            args.server,
+            args.db_url,
+            cache_dir=args.cache_dir,
+            state_dir=args.state_dir,
+            workers=args.workers,
+            pool_size=args.pool_size,
+        )
+        processor = service.processor
+
+        def trigger(study_id, accession):
+            job = service.submit(study_id, apply=args.apply)
+            print(f"Queued {study_id} as job {job.job_id}")
+
+    watcher = ReleaseWatcher(
+        args.server,
+        args.state_file,
+        trigger,
+        interval=args.interval,
+        processor=processor,
+    )
+    try:
+        while True:
+            if args.all_studies:
+                study_ids = find_dbgap_studies(args.server, processor.session)
+            else:
+                study_ids = args.study
+            triggered = watcher.poll(study_ids)
+            print(
+                f"Checked {len(study_ids)} studies, queued runs for"
+                f" {triggered or 'none'}"
+            )
+            if args.once:
+                break
+            time.sleep(max(1, watcher.next_due(study_ids) - time.time()))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if service:
+            service.shutdown()
+            for job in service.list_jobs():
+                print(
+                    f"Job {job.job_id} ({job.study_id}): {job.status}"
+                    + (f" - {job.error}" if job.error else "")
+                )
 
 
 if __name__ == "__main__":
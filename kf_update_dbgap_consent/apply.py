@@ -0,0 +1,294 @@
+"""
+Concurrent, resumable application of patches to the dataservice.
+
+Patches are sent endpoint by endpoint (so that e.g. biospecimens are patched
+before their genomic files) by a pool of workers. Concurrency backs off when
+the server answers with 429 or 5xx and recovers as requests succeed again.
+Every successful patch is appended to an optional journal so that an
+interrupted apply can be resumed without resending anything.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from kf_update_dbgap_consent.client import HttpClient
+from kf_update_dbgap_consent.defaults import DEFAULT_PATCH_WORKERS
+from kf_update_dbgap_consent.metrics import Metrics
+
+# Parents before children
+ENDPOINT_ORDER = [
+    "studies",
+    "participants",
+    "biospecimens",
+    "biospecimen-diagnoses",
+    "biospecimen-genomic-files",
+    "genomic-files",
+    "read-group-genomic-files",
+    "read-groups",
+    "sequencing-experiment-genomic-files",
+    "sequencing-experiments",
+]
+
+
+def _endpoint_rank(endpoint):
+    try:
+        return ENDPOINT_ORDER.index(endpoint)
+    except ValueError:
+        return len(ENDPOINT_ORDER)
+
+
+def ordered_endpoints(endpoints):
+    return sorted(endpoints, key=lambda e: (_endpoint_rank(e), e))
+
+
+def iter_patches(patches):
+    """
+    :yields: (endpoint, kf_id, patch) for {endpoint: {kf_id: patch}}, parent
+        endpoints first
+    """
+    for endpoint in ordered_endpoints(patches):
+        for kfid, patch in patches[endpoint].items():
+            yield endpoint, kfid, patch
+
+
+def patch_digest(patch):
+    return hashlib.sha1(
+        json.dumps(patch, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class PatchJournal:
+    """
+    Append-only record of applied patches.
+
+    Each line holds a kf_id and a digest of the patch body that was applied
+    to it, so a resumed apply only skips patches that are identical to ones
+    already sent.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.applied = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) == 2:
+                        self.applied.add(tuple(parts))
+        self._file = open(path, "a")
+        self._lock = threading.Lock()
+
+    def __contains__(self, item):
+        kfid, patch = item
+        return (kfid, patch_digest(patch)) in self.applied
+
+    def record(self, kfid, patch):
+        with self._lock:
+            self._file.write(f"{kfid} {patch_digest(patch)}\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class AdaptiveLimit:
+    """
+    Limits the number of requests in flight, halving the limit and pausing
+    everyone when the server signals overload, and growing it back by one
+    after each run of successes.
+    """
+
+    def __init__(self, maximum, backoff=1.0, max_backoff=60.0):
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.delay = backoff
+        self.paused_until = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while True:
+                wait = self.paused_until - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                elif self.in_flight >= self.limit:
+                    self.cond.wait()
+                else:
+                    self.in_flight += 1
+                    return
+
+    def release(self, overloaded=False, retry_after=None):
+        with self.cond:
+            self.in_flight -= 1
+            if overloaded:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+                pause = retry_after if retry_after is not None else self.delay
+                self.paused_until = max(
+                    self.paused_until, time.monotonic() + pause
+                )
+                self.delay = min(self.delay * 2, self.max_backoff)
+            else:
+                self.successes += 1
+                self.delay = self.backoff
+                if self.limit < self.maximum and self.successes >= self.limit:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+def _retry_after(resp):
+    try:
+        return float(resp.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class PatchApplier:
+    def __init__(
+        self,
+        api_url,
+        workers=DEFAULT_PATCH_WORKERS,
+        journal_path=None,
+        max_attempts=10,
+        backoff=1.0,
+        session=None,
+        metrics=None,
+    ):
+        self.api_url = api_url
+        self.workers = workers
+        self.journal_path = journal_path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        if session is None:
+            session = HttpClient(pool_size=workers)
+        self.metrics = metrics or Metrics()
+        self.session = self.metrics.instrument(session)
+
+    def _send(self, limit, endpoint, kfid, patch):
+        for _ in range(self.max_attempts):
+            limit.acquire()
+            overloaded = False
+            retry_after = None
+            try:
+                resp = self.session.patch(
+                    f"{self.api_url}/{endpoint}/{kfid}", json=patch
+                )
+                if resp.status_code == 429 or resp.status_code >= 500:
+                    overloaded = True
+                    retry_after = _retry_after(resp)
+                    continue
+                if resp.status_code not in {200, 201}:
+                    return f"{resp.status_code}: {resp.text}"
+                return None
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ):
+                overloaded = True
+            finally:
+                limit.release(overloaded, retry_after)
+        return f"Gave up after {self.max_attempts} attempts"
+
+    def _progress(self, progress):
+        rate = progress["done"] / max(
+            time.monotonic() - progress["start"], 1e-9
+        )
+        print(
+            f"  Patched {progress['done']} {progress['endpoint']}"
+            f" ({progress['skipped']} already done, {rate:.0f}/s)",
+            end="\r",
+        )
+
+    def apply(self, patches):
+        """
+        Send {endpoint: {kf_id: patch}} to the dataservice.
+
+        :returns: {"applied": int, "skipped": int, "failed": {kf_id: error}}
+        """
+        return self.apply_records(iter_patches(patches))
+
+    def apply_records(self, records):
+        """
+        Send a stream of (endpoint, kf_id, patch) to the dataservice in the
+        given order, without holding more than a bounded number of them in
+        memory. Each run of records for the same endpoint finishes before
+        the next one starts.
+
+        :returns: {"applied": int, "skipped": int, "failed": {kf_id: error}}
+        """
+        journal = PatchJournal(self.journal_path) if self.journal_path else None
+        limit = AdaptiveLimit(self.workers, backoff=self.backoff)
+        applied, skipped, failed = 0, 0, {}
+        lock = threading.Lock()
+
+        def send(endpoint, kfid, patch):
+            nonlocal applied
+            error = self._send(limit, endpoint, kfid, patch)
+            with lock:
+                if error:
+                    failed[kfid] = error
+                    print(f"ERROR: PATCH {endpoint}/{kfid} failed: {error}")
+                else:
+                    applied += 1
+                    if journal:
+                        journal.record(kfid, patch)
+
+        pending = deque()
+        progress = {"endpoint": None, "done": 0, "skipped": 0}
+
+        def finish_endpoint():
+            while pending:
+                pending.popleft().result()
+                progress["done"] += 1
+            if progress["endpoint"] and (
+                progress["done"] or progress["skipped"]
+            ):
+                self._progress(progress)
+                print()
+
+        try:
+            with self.metrics.phase("apply"), ThreadPoolExecutor(
+                max_workers=self.workers
+            ) as tpex:
+                for endpoint, kfid, patch in records:
+                    if endpoint != progress["endpoint"]:
+                        finish_endpoint()
+                        progress.update(
+                            endpoint=endpoint,
+                            done=0,
+                            skipped=0,
+                            start=time.monotonic(),
+                        )
+                    if journal and (kfid, patch) in journal:
+                        skipped += 1
+                        progress["skipped"] += 1
+                        continue
+                    pending.append(tpex.submit(send, endpoint, kfid, patch))
+                    # bound the number of queued futures
+                    while len(pending) > self.workers * 64 or (
+                        pending and pending[0].done()
+                    ):
+                        pending.popleft().result()
+                        progress["done"] += 1
+                        if progress["done"] % 1000 == 0:
+                            self._progress(progress)
+                finish_endpoint()
+        finally:
+            if journal:
+                journal.close()
+
+        self.metrics.count("patches.applied", applied)
+        self.metrics.count("patches.failed", len(failed))
+        return {"applied": applied, "skipped": skipped, "failed": failed}
@@ -0,0 +1,163 @@
+"""
+Run the consent processor over many studies in one process.
+
+A single ConsentProcessor (and therefore a single HTTP session) is shared by
+a bounded pool of worker threads, so a full refresh of every dbGaP-governed
+study doesn't pay per-study process startup and connection setup costs.
+"""
+
+import json
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from kf_update_dbgap_consent.alerts import count_alerts
+from kf_update_dbgap_consent.client import HttpClient
+from kf_update_dbgap_consent.defaults import DEFAULT_WORKERS
+from kf_update_dbgap_consent.scrape import Scraper
+
+
+def find_dbgap_studies(api_url, session=None):
+    """
+    Find the KF IDs of every dataservice study whose data access authority
+    is dbGaP.
+
+    :param session: optional HttpClient, e.g. a ConsentProcessor's session
+    """
+    study_ids = []
+
+    def handle(endpoint, s):
+        if (s.get("data_access_authority") or "").lower() == "dbgap":
+            study_ids.append(s["kf_id"])
+
+    Scraper(session or HttpClient(), api_url).scrape(["studies"], {}, handle)
+    return sorted(study_ids)
+
+
+def process_studies(
+    processor,
+    study_ids,
+    workers=DEFAULT_WORKERS,
+    on_result=None,
+    **patch_kwargs,
+):
+    """
+    Run processor.get_patches_for_study for each of the given studies on a
+    pool of worker threads.
+
+    Failures are captured per study instead of stopping the whole batch.
+
+    :param on_result: optional function called with (study_id, result) as
+        each study finishes, from the calling thread
+
+    :returns: {study_id: {"patches": ..., "alerts": [...], "error": str|None}}
+    """
+
+    def run(study_id):
+        patches, alerts = processor.get_patches_for_study(
+            study_id, **patch_kwargs
+        )
+        return {"patches": patches, "alerts": alerts, "error": None}
+
+    return _run_studies(run, study_ids, workers, on_result)
+
+
+def stream_studies(
+    processor,
+    study_ids,
+    on_chunk,
+    workers=DEFAULT_WORKERS,
+    on_result=None,
+    **patch_kwargs,
+):
+    """
+    Like process_studies, but with processor.stream_patches_for_study, so
+    that no study's patches are held in memory all at once.
+
+    :param on_chunk: function called with (study_id, patches, alerts) for
+        each chunk of a study as it's computed. It and on_result are never
+        called more than one at a time. Chunks of a study that fails partway
+        have already been passed to on_chunk.
+
+    :returns: {study_id: {"patches": {}, "patch_counts": {endpoint: int},
+        "alerts": [...], "error": str|None}}
+    """
+    lock = threading.Lock()
+
+    def run(study_id):
+        patch_counts = Counter()
+        alerts = []
+        for patches, chunk_alerts in processor.stream_patches_for_study(
+            study_id, **patch_kwargs
+        ):
+            with lock:
+                on_chunk(study_id, patches, chunk_alerts)
+            for endpoint, endpoint_patches in patches.items():
+                patch_counts[endpoint] += len(endpoint_patches)
+            alerts.extend(chunk_alerts)
+        return {
+            "patches": {},
+            "patch_counts": dict(patch_counts),
+            "alerts": alerts,
+            "error": None,
+        }
+
+    def finished(study_id, result):
+        with lock:
+            on_result(study_id, result)
+
+    return _run_studies(run, study_ids, workers, on_result and finished)
+
+
+def _run_studies(run, study_ids, workers, on_result):
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as tpex:
+        futures = {
+            tpex.submit(run, study_id): study_id for study_id in study_ids
+        }
+        for f in as_completed(futures):
+            study_id = futures[f]
+            try:
+                results[study_id] = f.result()
+            except Exception as e:
+                results[study_id] = {
+                    "patches": {},
+                    "alerts": [],
+                    "error": f"{type(e).__name__}: {e}",
+                }
+                print(f"ERROR: {study_id} failed: {results[study_id]['error']}")
+            if on_result:
+                on_result(study_id, results[study_id])
+    return {k: results[k] for k in sorted(results)}
+
+
+def summarize(results):
+    """
+    Reduce per-study results to a combined, JSON-serializable summary of
+    patch counts, alerts and their counts by type, and errors.
+    """
+    summary = {"studies": {}, "totals": Counter()}
+    for study_id, result in results.items():
+        patch_counts = result.get("patch_counts") or {
+            endpoint: len(entities)
+            for endpoint, entities in result["patches"].items()
+        }
+        summary["studies"][study_id] = {
+            "error": result["error"],
+            "patch_counts": patch_counts,
+            "alerts": [str(a) for a in result["alerts"]],
+            "alert_counts": count_alerts(result["alerts"]),
+        }
+        summary["totals"]["studies"] += 1
+        summary["totals"]["failed_studies"] += bool(result["error"])
+        summary["totals"]["alerts"] += len(result["alerts"])
+        for alert_type, n in count_alerts(result["alerts"]).items():
+            summary["totals"][f"alerts.{alert_type}"] += n
+        summary["totals"]["patches"] += sum(patch_counts.values())
+    summary["totals"] = dict(summary["totals"])
+    return summary
+
+
+def write_summary(path, results):
+    with open(path, "w") as f:
+        json.dump(summarize(results), f, indent=2, sort_keys=True)
@@ -0,0 +1,132 @@
+"""
+The HTTP client shared by all dataservice and dbGaP requests.
+
+A ConsentProcessor owns one HttpClient. Scraping, study and dbGaP lookups,
+the release watcher, and patch sending all go through it, so keep-alive
+connections are reused across studies and phases instead of every caller
+paying for its own TCP and TLS setup. It also applies one timeout and retry
+policy everywhere, limits the number of requests in flight to each host, and
+can briefly cache idempotent lookups like study metadata.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_SIZE = 32
+# (connect, read) seconds. dbGaP can take tens of seconds to respond.
+DEFAULT_TIMEOUT = (10, 300)
+DEFAULT_RETRIES = 5
+DEFAULT_BACKOFF = 0.5
+DEFAULT_CACHE_TTL = 60
+MAX_CACHE_ENTRIES = 1024
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def pool_size_for(*concurrencies):
+    """
+    :returns: how many connections per host to keep alive for callers that
+        make up to the given numbers of requests at once
+    """
+    return max(DEFAULT_POOL_SIZE, sum(concurrencies))
+
+
+class HttpClient(requests.Session):
+    """
+    A requests session with:
+
+    * a keep-alive pool of pool_size connections per host
+    * a default timeout
+    * retries with exponential backoff for connection errors and, for
+      idempotent methods, 429 and 5xx responses (PatchApplier does its own
+      adaptive backoff for patches)
+    * at most host_limit requests waiting on each host at once (streamed
+      response bodies aren't counted once their headers have arrived)
+    * cached_get for short-lived caching of idempotent lookups
+
+    :param host_limit: defaults to pool_size, so that requests never need
+        more connections than the pool keeps alive
+    """
+
+    def __init__(
+        self,
+        pool_size=DEFAULT_POOL_SIZE,
+        timeout=DEFAULT_TIMEOUT,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+        host_limit=None,
+        cache_ttl=DEFAULT_CACHE_TTL,
+    ):
+        super().__init__()
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.host_limit = host_limit or pool_size
+        self.cache_ttl = cache_ttl
+        adapter = HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=RETRY_STATUSES,
+                raise_on_status=False,
+            ),
+        )
+        self.mount("http://", adapter)
+        self.mount("https://", adapter)
+        self._lock = threading.Lock()
+        self._host_limits = {}
+        self._cache = OrderedDict()
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(
+                    self.host_limit
+                )
+            return self._host_limits[host]
+
+    def request(self, method, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        if method.upper() not in {"GET", "HEAD", "OPTIONS"}:
+            self.uncache(url)
+        with self._host_limit(url):
+            return super().request(method, url, *args, **kwargs)
+
+    def cached_get(self, url, ttl=None):
+        """
+        GET a URL, reusing a successful response from the last ttl seconds
+        (default cache_ttl). Any other request to the URL through this client
+        drops it from the cache.
+        """
+        ttl = self.cache_ttl if ttl is None else ttl
+        key = url.rstrip("/")
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None and now - entry[1] < ttl:
+                return entry[0]
+        resp = self.get(url)
+        if resp.status_code == 200:
+            with self._lock:
+                self._cache[key] = (resp, now)
+                self._cache.move_to_end(key)
+                while len(self._cache) > MAX_CACHE_ENTRIES:
+                    self._cache.popitem(last=False)
+        return resp
+
+    def uncache(self, url=None):
+        """
+        Drop a URL, or everything if url is None, from the cache
+        """
+        with self._lock:
+            if url is None:
+                self._cache.clear()
+            else:
+                self._cache.pop(url.rstrip("/"), None)
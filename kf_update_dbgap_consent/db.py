@@ -0,0 +1,340 @@
+"""
+Direct access to the dataservice's Postgres database.
+
+Writing patches through the API costs one HTTP round trip per entity.
+apply_records_to_db instead streams patches into pages of kf_ids with the
+same patch body (most patches in a study are identical, e.g. every hidden
+biospecimen gets `visible=False`), and writes each page with one set-based
+UPDATE statement.
+
+This bypasses the API, including its synchronization of genomic file
+changes to indexd. Genomic file ACLs aren't stored in the database at all
+but in indexd, so they can only be changed through the API: split patches
+with db_records and indexd_records.
+"""
+
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor, execute_values
+
+from kf_update_dbgap_consent.entities import STUDY_ENDPOINTS
+from kf_update_dbgap_consent.metrics import Metrics
+
+TABLES = {
+    "studies": "study",
+    "participants": "participant",
+    "biospecimens": "biospecimen",
+    "biospecimen-diagnoses": "biospecimen_diagnosis",
+    "biospecimen-genomic-files": "biospecimen_genomic_file",
+    "genomic-files": "genomic_file",
+    "read-groups": "read_group",
+    "read-group-genomic-files": "read_group_genomic_file",
+    "sequencing-experiments": "sequencing_experiment",
+    "sequencing-experiment-genomic-files": (
+        "sequencing_experiment_genomic_file"
+    ),
+}
+
+# fields the dataservice keeps in indexd rather than in its database
+INDEXD_FIELDS = {"genomic-files": {"acl"}}
+
+PAGE_SIZE = 10000
+ITERSIZE = 10000
+# how far before the last snapshot refresh to look for modified rows
+SNAPSHOT_OVERLAP = timedelta(minutes=10)
+
+_STUDY_BIOSPECIMENS = (
+    "SELECT b.kf_id FROM biospecimen b"
+    " JOIN participant p ON p.kf_id = b.participant_id"
+    " WHERE p.study_id = %(study_id)s"
+)
+_STUDY_GENOMIC_FILES = (
+    "SELECT bg.genomic_file_id FROM biospecimen_genomic_file bg"
+    f" WHERE bg.biospecimen_id IN ({_STUDY_BIOSPECIMENS})"
+)
+
+
+# every link of the groups of the study's genomic files, including links to
+# other genomic files, so that groups are only hidden once all of their
+# genomic files are
+def _gf_links(table, group):
+    return (
+        f"SELECT kf_id, visible, genomic_file_id, {group}_id FROM {table}"
+        f" WHERE {group}_id IN (SELECT {group}_id FROM {table}"
+        f" WHERE genomic_file_id IN ({_STUDY_GENOMIC_FILES}))"
+    )
+
+
+def _gf_groups(table, group):
+    return (
+        f"SELECT kf_id, visible FROM {group} WHERE kf_id IN"
+        f" (SELECT {group}_id FROM {table}"
+        f" WHERE genomic_file_id IN ({_STUDY_GENOMIC_FILES}))"
+    )
+
+
+# Only the columns the rules read, for each of entities.STUDY_ENDPOINTS.
+# Genomic file ACLs are kept in indexd, not the database, so they aren't
+# known and every genomic file gets an acl patch.
+STUDY_QUERIES = {
+    "biospecimens": (
+        "SELECT kf_id, visible, consent_type, dbgap_consent_code,"
+        " external_sample_id, external_aliquot_id FROM biospecimen"
+        f" WHERE kf_id IN ({_STUDY_BIOSPECIMENS})"
+    ),
+    "genomic-files": (
+        "SELECT kf_id, visible, controlled_access, latest_did"
+        " FROM genomic_file"
+        f" WHERE kf_id IN ({_STUDY_GENOMIC_FILES})"
+    ),
+    "biospecimen-genomic-files": (
+        "SELECT kf_id, visible, biospecimen_id, genomic_file_id"
+        " FROM biospecimen_genomic_file"
+        f" WHERE biospecimen_id IN ({_STUDY_BIOSPECIMENS})"
+    ),
+    "biospecimen-diagnoses": (
+        "SELECT kf_id, visible, biospecimen_id, diagnosis_id"
+        " FROM biospecimen_diagnosis"
+        f" WHERE biospecimen_id IN ({_STUDY_BIOSPECIMENS})"
+    ),
+    "sequencing-experiment-genomic-files": _gf_links(
+        "sequencing_experiment_genomic_file", "sequencing_experiment"
+    ),
+    "read-group-genomic-files": _gf_links(
+        "read_group_genomic_file", "read_group"
+    ),
+    "sequencing-experiments": _gf_groups(
+        "sequencing_experiment_genomic_file", "sequencing_experiment"
+    ),
+    "read-groups": _gf_groups("read_group_genomic_file", "read_group"),
+}
+
+
+def _update_statement(table, patch):
+    return sql.SQL(
+        "UPDATE {table} SET {assignments}, modified_at = now()"
+        " FROM (VALUES %s) AS v(kf_id) WHERE {table}.kf_id = v.kf_id"
+    ).format(
+        table=sql.Identifier(table),
+        assignments=sql.SQL(", ").join(
+            sql.SQL("{} = {}").format(sql.Identifier(k), sql.Literal(v))
+            for k, v in sorted(patch.items())
+        ),
+    )
+
+
+def _stream_rows(conn, name, query, params, handle, itersize, metrics):
+    n = 0
+    with metrics.db_query(name):
+        with conn.cursor(
+            name=name.replace(" ", "_").replace("-", "_"),
+            cursor_factory=RealDictCursor,
+        ) as cur:
+            cur.itersize = itersize
+            cur.execute(query, params)
+            for row in cur:
+                handle(row)
+                n += 1
+    return n
+
+
+def stream_study_rows(
+    db_url,
+    study_id,
+    handle,
+    endpoints=STUDY_ENDPOINTS,
+    itersize=ITERSIZE,
+    metrics=None,
+):
+    """
+    Stream the rows of a study's entities that the rules need through
+    server-side cursors, so that only itersize rows are held at once.
+
+    :param handle: called with (endpoint, row) for every row
+    :returns: {endpoint: number of rows}
+    """
+    metrics = metrics or Metrics()
+    counts = {}
+    conn = psycopg2.connect(db_url)
+    try:
+        for endpoint in endpoints:
+            counts[endpoint] = _stream_rows(
+                conn,
+                f"stream {endpoint}",
+                STUDY_QUERIES[endpoint],
+                {"study_id": study_id},
+                lambda row: handle(endpoint, row),
+                itersize,
+                metrics,
+            )
+        conn.rollback()
+    finally:
+        conn.close()
+    return counts
+
+
+def refresh_snapshot(
+    db_url, study_id, snapshot, full=False, itersize=ITERSIZE, metrics=None
+):
+    """
+    Bring a snapshot.StudySnapshot of a study's rows up to date.
+
+    Only rows modified since the snapshot was last refreshed (less
+    SNAPSHOT_OVERLAP, for transactions that were still open then) are read.
+    An endpoint is then read again in full if its number of rows doesn't
+    match the database, which catches deleted rows and entities that were
+    linked into the study without being modified. Snapshots read with
+    other STUDY_QUERIES are read again in full. Everything is read in
+    one REPEATABLE READ transaction so that the counts and rows agree.
+
+    :param full: read every row, as for a new snapshot
+    :returns: {endpoint: number of rows read}
+    """
+    metrics = metrics or Metrics()
+    read = {}
+    conn = psycopg2.connect(db_url)
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ", readonly=True)
+        with conn.cursor() as cur:
+            cur.execute("SELECT now()")
+            taken_at = cur.fetchone()[0]
+        queries = json.dumps(STUDY_QUERIES, sort_keys=True)
+        since = None if full else snapshot.taken_at(queries)
+        for endpoint in STUDY_ENDPOINTS:
+            params = {"study_id": study_id}
+
+            def reload():
+                snapshot.clear(endpoint)
+                return _stream_rows(
+                    conn,
+                    f"snapshot {endpoint}",
+                    STUDY_QUERIES[endpoint],
+                    params,
+                    lambda row: snapshot.put(endpoint, row),
+                    itersize,
+                    metrics,
+                )
+
+            if since is None:
+                read[endpoint] = reload()
+                continue
+            read[endpoint] = _stream_rows(
+                conn,
+                f"snapshot changed {endpoint}",
+                f"{STUDY_QUERIES[endpoint]}"
+                f" AND {TABLES[endpoint]}.modified_at > %(since)s",
+                {**params, "since": since - SNAPSHOT_OVERLAP},
+                lambda row: snapshot.put(endpoint, row),
+                itersize,
+                metrics,
+            )
+            with metrics.db_query(f"count {endpoint}"):
+                with conn.cursor() as cur:
+                    cur.execute(
+                        f"SELECT count(*) FROM ({STUDY_QUERIES[endpoint]}) q",
+                        params,
+                    )
+                    count = cur.fetchone()[0]
+            if count != snapshot.count(endpoint):
+                print(f"Snapshot of {endpoint} is out of step, reloading")
+                read[endpoint] += reload()
+        snapshot.commit(taken_at, queries)
+        conn.rollback()
+    finally:
+        conn.close()
+    return read
+
+
+def db_records(records):
+    """
+    :yields: the (endpoint, kf_id, patch) records without INDEXD_FIELDS,
+        skipping patches left empty
+    """
+    for endpoint, kfid, patch in records:
+        fields = INDEXD_FIELDS.get(endpoint, ())
+        patch = {k: v for k, v in patch.items() if k not in fields}
+        if patch:
+            yield endpoint, kfid, patch
+
+
+def indexd_records(records):
+    """
+    :yields: the (endpoint, kf_id, patch) records with only INDEXD_FIELDS,
+        skipping patches left empty
+    """
+    for endpoint, kfid, patch in records:
+        fields = INDEXD_FIELDS.get(endpoint, ())
+        patch = {k: v for k, v in patch.items() if k in fields}
+        if patch:
+            yield endpoint, kfid, patch
+
+
+def apply_records_to_db(db_url, records, page_size=PAGE_SIZE, metrics=None):
+    """
+    Write a stream of (endpoint, kf_id, patch) directly to the database.
+    kf_ids are grouped by patch body and written page_size at a time, so
+    only one page per distinct patch is held in memory. Each run of records
+    for the same endpoint is one transaction. Patches of INDEXD_FIELDS
+    aren't accepted (see db_records).
+
+    :returns: {endpoint: number of rows updated}
+    """
+    metrics = metrics or Metrics()
+    updated = defaultdict(int)
+    expected = defaultdict(int)
+    groups = {}
+    current = None
+    conn = psycopg2.connect(db_url)
+    cur = conn.cursor()
+
+    def flush(key):
+        kfids = groups.pop(key)
+        statement = _update_statement(TABLES[current], json.loads(key))
+        with metrics.db_query(f"update {current}"):
+            execute_values(
+                cur, statement, [(k,) for k in kfids], page_size=page_size
+            )
+        updated[current] += cur.rowcount
+
+    def finish():
+        for key in list(groups):
+            flush(key)
+        conn.commit()
+
+    try:
+        for endpoint, kfid, patch in records:
+            if endpoint != current:
+                finish()
+                if endpoint not in TABLES:
+                    raise Exception(f"Don't know the table for {endpoint}")
+                current = endpoint
+            fields = INDEXD_FIELDS.get(endpoint, set()) & patch.keys()
+            if fields:
+                raise Exception(
+                    f"{endpoint} {sorted(fields)} are kept in indexd, not"
+                    " the database, and must be patched through the API"
+                )
+            key = json.dumps(patch, sort_keys=True)
+            groups.setdefault(key, []).append(kfid)
+            expected[endpoint] += 1
+            if len(groups[key]) >= page_size:
+                flush(key)
+        finish()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for endpoint, n in expected.items():
+        print(f"Updated {updated[endpoint]} {endpoint}")
+        if updated[endpoint] != n:
+            print(
+                f"WARNING: {n - updated[endpoint]} {endpoint} not found in"
+                " the database"
+            )
+    return dict(updated)
@@ -0,0 +1,322 @@
+"""
+Set-based evaluation of the consent rules inside the dataservice database.
+
+Loading a study from the database still copies every biospecimen, genomic
+file, and link row into Python. Instead, evaluate_in_db loads the dbGaP
+samples into a temporary table and has Postgres join them to the study's
+biospecimens. It then reduces every genomic file to the facts the ACL rules
+need: its own visibility and controlled_access, the first of its
+contributing biospecimens that is or will be hidden, and the distinct
+consent codes of the others. Descendants of hidden biospecimens are found
+with a few more set-based queries. Only biospecimens and descendants that
+need changes are returned. Genomic file ACLs are kept in indexd, not the
+database, so as with db.STUDY_QUERIES every genomic file gets an acl patch.
+
+Each result is read through a server-side cursor, and the study is read in
+one REPEATABLE READ transaction so that every query sees the same data.
+"""
+
+from collections import defaultdict
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import RealDictCursor, execute_values
+
+from kf_update_dbgap_consent.acl_engine import AclEngine
+from kf_update_dbgap_consent.alerts import MissingSample
+from kf_update_dbgap_consent.db import ITERSIZE, PAGE_SIZE
+from kf_update_dbgap_consent.decisions import (
+    BS_HIDDEN,
+    BS_LOADED,
+    BS_NO_SAMPLE,
+    BS_NOT_LOADED,
+)
+from kf_update_dbgap_consent.entities import StudyEntities
+from kf_update_dbgap_consent.metrics import Metrics
+
+MATCH_ENTITIES = ["external_sample_id", "external_aliquot_id"]
+
+_SAMPLES = """
+CREATE TEMP TABLE dbgap_sample (
+    sample_id TEXT PRIMARY KEY,
+    position INTEGER,
+    loaded BOOLEAN,
+    consent_type TEXT,
+    consent_code TEXT
+) ON COMMIT DROP
+"""
+
+# every biospecimen of the study, its new consent code, and whether it is
+# or will be hidden
+_STUDY_BIOSPECIMENS = """
+CREATE TEMP TABLE study_bs ON COMMIT DROP AS
+SELECT b.kf_id, b.visible, b.consent_type, b.dbgap_consent_code,
+    b.external_sample_id, b.external_aliquot_id, s.sample_id, s.loaded,
+    CASE WHEN s.loaded THEN s.consent_type END AS new_type,
+    CASE WHEN s.loaded THEN s.consent_code END AS new_code,
+    s.loaded IS NOT TRUE OR b.visible IS NOT TRUE AS hidden
+FROM biospecimen b
+JOIN participant p ON p.kf_id = b.participant_id
+LEFT JOIN dbgap_sample s ON s.sample_id = b.{match_entity}
+WHERE p.study_id = %(study_id)s
+"""
+
+_MISSING_SAMPLES = """
+SELECT s.sample_id FROM dbgap_sample s
+WHERE s.loaded AND NOT EXISTS
+    (SELECT 1 FROM study_bs b WHERE b.{match_entity} = s.sample_id)
+ORDER BY s.position
+"""
+
+# biospecimens whose consent_type, dbgap_consent_code, or visible change
+_CHANGED_BIOSPECIMENS = """
+SELECT kf_id, visible, consent_type, dbgap_consent_code, external_sample_id,
+    external_aliquot_id
+FROM study_bs WHERE {where}
+ORDER BY kf_id
+"""
+_CHANGED = """
+consent_type IS DISTINCT FROM new_type
+OR dbgap_consent_code IS DISTINCT FROM new_code
+OR (hidden AND visible IS DISTINCT FROM false)
+"""
+
+# every genomic file linked to a biospecimen of the study
+_STUDY_GENOMIC_FILES = """
+CREATE TEMP TABLE study_gf ON COMMIT DROP AS
+SELECT bg.genomic_file_id AS kf_id,
+    min(b.kf_id) FILTER (WHERE b.hidden) AS hidden_by,
+    array_agg(DISTINCT b.new_code) AS codes
+FROM biospecimen_genomic_file bg
+JOIN study_bs b ON b.kf_id = bg.biospecimen_id
+GROUP BY bg.genomic_file_id
+"""
+
+_GENOMIC_FILE_FACTS = """
+SELECT f.kf_id, g.visible, g.controlled_access, f.hidden_by, f.codes,
+    g.latest_did
+FROM study_gf f JOIN genomic_file g ON g.kf_id = f.kf_id
+ORDER BY f.kf_id
+"""
+
+# visible descendants of hidden biospecimens, by endpoint
+_HIDDEN_DESCENDANTS = {
+    "biospecimen-diagnoses": """
+SELECT l.kf_id FROM biospecimen_diagnosis l
+JOIN study_bs b ON b.kf_id = l.biospecimen_id
+WHERE b.hidden AND l.visible IS TRUE
+""",
+    "biospecimen-genomic-files": """
+SELECT l.kf_id FROM biospecimen_genomic_file l
+JOIN study_bs b ON b.kf_id = l.biospecimen_id
+WHERE b.hidden AND l.visible IS TRUE
+""",
+}
+for _table, _group, _endpoints in [
+    (
+        "sequencing_experiment_genomic_file",
+        "sequencing_experiment",
+        ["sequencing-experiment-genomic-files", "sequencing-experiments"],
+    ),
+    (
+        "read_group_genomic_file",
+        "read_group",
+        ["read-group-genomic-files", "read-groups"],
+    ),
+]:
+    _HIDDEN_DESCENDANTS[_endpoints[0]] = f"""
+SELECT l.kf_id FROM {_table} l
+JOIN study_gf f ON f.kf_id = l.genomic_file_id
+WHERE f.hidden_by IS NOT NULL AND l.visible IS TRUE
+"""
+    # groups are hidden once all of their genomic files are, counting links
+    # to genomic files outside of the study
+    _HIDDEN_DESCENDANTS[_endpoints[1]] = f"""
+SELECT l.{_group}_id FROM {_table} l
+LEFT JOIN study_gf f ON f.kf_id = l.genomic_file_id
+WHERE l.{_group}_id IN
+    (SELECT h.{_group}_id FROM {_table} h
+    JOIN study_gf hf ON hf.kf_id = h.genomic_file_id
+    WHERE hf.hidden_by IS NOT NULL)
+GROUP BY l.{_group}_id
+HAVING bool_and(f.hidden_by IS NOT NULL) AND NOT EXISTS
+    (SELECT 1 FROM {_group} g
+    WHERE g.kf_id = l.{_group}_id AND g.visible IS NOT TRUE)
+"""
+
+
+def _rows(conn, name, query, params=None, itersize=ITERSIZE, dicts=False):
+    with conn.cursor(
+        name=name, cursor_factory=RealDictCursor if dicts else None
+    ) as cur:
+        cur.itersize = itersize
+        cur.execute(query, params)
+        yield from cur
+
+
+def evaluate_in_db(
+    db_url,
+    study_id,
+    study_phs,
+    dbgap_samples,
+    match_entity="external_sample_id",
+    decisions=None,
+    acls=None,
+    itersize=ITERSIZE,
+    metrics=None,
+):
+    """
+    Apply the consent rules (see sample_status) to a study inside the
+    database, giving the same patches and alerts as
+    ConsentProcessor.get_patches_for_study with no-op patches removed.
+
+    :param dbgap_samples: {sample ID: dbgap.Sample} of the study's release
+    :param decisions: optional list to add a decisions.DecisionIndex row
+        to for every biospecimen and genomic file
+    :param acls: optional list to add the (kf_id, latest_did, final ACL) of
+        every genomic file to
+    :returns: (patches, alerts, {endpoint: number of entities read})
+    """
+    if match_entity not in MATCH_ENTITIES:
+        raise Exception(f"Can't match dbGaP samples to {match_entity}")
+    metrics = metrics or Metrics()
+    match = sql.Identifier(match_entity)
+    patches = defaultdict(lambda: defaultdict(dict))
+    alerts = []
+    counts = {}
+    conn = psycopg2.connect(db_url)
+    try:
+        conn.set_session(isolation_level="REPEATABLE READ")
+        cur = conn.cursor()
+        with metrics.db_query("load samples"):
+            cur.execute(_SAMPLES)
+            execute_values(
+                cur,
+                "INSERT INTO dbgap_sample VALUES %s",
+                [
+                    (
+                        extid,
+                        i,
+                        s.dbgap_status == "Loaded",
+                        s.consent_short_name,
+                        f"{study_phs}.c{s.consent_code}",
+                    )
+                    for i, (extid, s) in enumerate(dbgap_samples.items())
+                ],
+                page_size=PAGE_SIZE,
+            )
+            cur.execute("ANALYZE dbgap_sample")
+        with metrics.db_query("study biospecimens"):
+            cur.execute(
+                sql.SQL(_STUDY_BIOSPECIMENS).format(match_entity=match),
+                {"study_id": study_id},
+            )
+            counts["biospecimens"] = cur.rowcount
+            cur.execute("CREATE INDEX ON study_bs (kf_id)")
+            cur.execute("ANALYZE study_bs")
+
+        """
+        Rule: For all samples in the sample status file which are not found
+        in the dataservice, return or display an alert.
+        """
+        with metrics.db_query("missing samples"):
+            for (extid,) in _rows(
+                conn,
+                "missing_samples",
+                sql.SQL(_MISSING_SAMPLES).format(match_entity=match),
+            ):
+                alerts.append(MissingSample(extid))
+
+        """
+        Rule: Biospecimens whose samples are found in the sample status file
+        with status "Loaded" should have their consent_type
+        dbgap_consent_code fields set as indicated in the file.
+
+        All other biospecimens should be hidden in the dataservice and their
+        "consent_type" and "dbgap_consent_code" fields should be set to null.
+        """
+        biospecimens = StudyEntities()
+        bs_patches = {}
+        with metrics.db_query("biospecimens"):
+            for row in _rows(
+                conn,
+                "biospecimens",
+                sql.SQL(_CHANGED_BIOSPECIMENS).format(
+                    where=sql.SQL("true" if decisions is not None else _CHANGED)
+                ),
+                itersize=itersize,
+                dicts=True,
+            ):
+                biospecimens.add("biospecimens", row)
+                kfid, extid = row["kf_id"], row[match_entity]
+                sample = dbgap_samples.get(extid)
+                if sample and sample.dbgap_status == "Loaded":
+                    patch = {
+                        "consent_type": sample.consent_short_name,
+                        "dbgap_consent_code": (
+                            f"{study_phs}.c{sample.consent_code}"
+                        ),
+                    }
+                    rule = BS_LOADED
+                    if not row["visible"]:
+                        patch["visible"] = False
+                        rule = BS_HIDDEN
+                else:
+                    patch = {
+                        "consent_type": None,
+                        "dbgap_consent_code": None,
+                        "visible": False,
+                    }
+                    rule = BS_NOT_LOADED if sample else BS_NO_SAMPLE
+                bs_patches[kfid] = patch
+                if decisions is not None:
+                    detail = f"{match_entity} {extid}"
+                    if sample:
+                        detail += f", dbGaP status {sample.dbgap_status}"
+                    decisions.append((kfid, rule, None, detail))
+        patches.update(
+            biospecimens.remove_noop_patches({"biospecimens": bs_patches})
+        )
+
+        with metrics.db_query("study genomic files"):
+            cur.execute(_STUDY_GENOMIC_FILES)
+            cur.execute("CREATE INDEX ON study_gf (kf_id)")
+            cur.execute("ANALYZE study_gf")
+
+        """
+        Rule: If a biospecimen is hidden in the dataservice, its descendants
+        (genomic files, read groups, etc) should also be hidden.
+        """
+        for endpoint, query in _HIDDEN_DESCENDANTS.items():
+            with metrics.db_query(f"hidden {endpoint}"):
+                for (kfid,) in _rows(
+                    conn, "hidden_descendants", query, itersize=itersize
+                ):
+                    patches[endpoint][kfid]["visible"] = False
+
+        # genomic file ACLs, see acl_engine
+        engine = AclEngine(study_id, study_phs, {}, set())
+        gf_patches = patches["genomic-files"]
+        dids = []
+
+        def facts():
+            for row in _rows(
+                conn, "genomic_files", _GENOMIC_FILE_FACTS, itersize=itersize
+            ):
+                gfid, visible, controlled_access, hidden_by, codes, did = row
+                if hidden_by is not None and visible is not False:
+                    gf_patches[gfid]["visible"] = False
+                if acls is not None:
+                    dids.append((gfid, did))
+                yield gfid, visible, controlled_access, None, hidden_by, codes
+
+        with metrics.db_query("genomic files"):
+            counts["genomic-files"] = engine.evaluate_facts(
+                facts(), patches, alerts, decisions
+            )
+        for gfid, did in dids:
+            acls.append((gfid, did, gf_patches.get(gfid, {}).get("acl")))
+        conn.rollback()
+    finally:
+        conn.close()
+    return {k: dict(v) for k, v in patches.items() if v}, alerts, counts
@@ -0,0 +1,209 @@
+"""
+Streaming access to dbGaP sample status files.
+
+Sample status XML for large studies is tens of MB, so instead of building a
+full dict tree we incrementally parse it and keep only the sample fields the
+consent rules need. Parsed tables are cached on disk by full accession
+(phsXXXXXX.vN.pN) so a released version is only ever downloaded and parsed
+once.
+"""
+
+import csv
+import gzip
+import os
+import sys
+import tempfile
+from collections import namedtuple
+from contextlib import closing
+
+from kf_update_dbgap_consent.client import HttpClient
+
+DBGAP_SAMPLE_STATUS_URL = (
+    "https://www.ncbi.nlm.nih.gov/projects/gap/cgi-bin/GetSampleStatus.cgi"
+)
+
+Sample = namedtuple(
+    "Sample", ["dbgap_status", "consent_code", "consent_short_name"]
+)
+
+
+def read_sample_status(source):
+    """
+    Incrementally parse a dbGaP sample status XML document.
+
+    :param source: filename or binary file object
+    :returns: the Study element attributes and a lazy iterator of
+        (submitted_sample_id, Sample) pairs. The study attributes are read
+        before any samples, so callers can stop without reading the rest of
+        the document.
+    """
+    # cached sample status files are read without any XML parsing
+    from xml.etree.ElementTree import iterparse
+
+    events = iterparse(source, events=("start", "end"))
+    for event, elem in events:
+        if event == "start" and elem.tag == "Study":
+            study = dict(elem.attrib)
+            break
+    else:
+        raise Exception("No Study found in dbGaP sample status XML")
+
+    def samples():
+        sample_list = None
+        for event, elem in events:
+            if event == "start":
+                if elem.tag == "SampleList":
+                    sample_list = elem
+                elif elem.tag == "Sample":
+                    yield elem.get("submitted_sample_id"), Sample(
+                        sys.intern(elem.get("dbgap_status")),
+                        sys.intern(elem.get("consent_code")),
+                        sys.intern(elem.get("consent_short_name")),
+                    )
+            elif elem.tag == "Sample" and sample_list is not None:
+                # drop finished samples so memory stays flat
+                sample_list.remove(elem)
+
+    return study, samples()
+
+
+class SampleStatusCache:
+    """
+    On-disk cache of parsed sample tables keyed by full dbGaP accession.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, accession):
+        return os.path.join(self.cache_dir, f"{accession}.tsv.gz")
+
+    def get(self, accession):
+        try:
+            with gzip.open(self._path(accession), "rt", newline="") as f:
+                return {
+                    row[0]: Sample(*map(sys.intern, row[1:]))
+                    for row in csv.reader(f, delimiter="\t")
+                }
+        except FileNotFoundError:
+            return None
+
+    def put(self, accession, samples):
+        path = self._path(accession)
+        # unique per writer, so threads storing the same study don't clash
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f"{accession}.", suffix=".tmp", dir=self.cache_dir
+        )
+        os.close(fd)
+        try:
+            with gzip.open(tmp_path, "wt", newline="") as f:
+                writer = csv.writer(f, delimiter="\t")
+                for sample_id, sample in samples.items():
+                    writer.writerow([sample_id, *sample])
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def _sample_status_versions(study_phs, session, headers=None):
+    """
+    Request a study's sample status, newest version first.
+
+    Yields (study attributes, lazy samples, response) for each version until
+    the caller stops or v1 is reached. If headers (e.g. If-None-Match) are given for the
+    newest version's request and the server answers 304 Not Modified, a
+    single (None, None, response) is yielded instead.
+    """
+    study_phs = study_phs.split(".", 1)[0]
+    query = study_phs
+    while True:
+        resp = session.get(
+            DBGAP_SAMPLE_STATUS_URL,
+            params={"study_id": query, "rettype": "xml"},
+            headers=headers if query == study_phs else None,
+            stream=True,
+        )
+        with closing(resp):
+            if resp.status_code == 304 and query == study_phs:
+                yield None, None, resp
+                return
+            if resp.status_code != 200:
+                raise Exception(
+                    f"dbGaP sample status request for {query} failed with"
+                    f" status {resp.status_code}"
+                )
+            resp.raw.decode_content = True
+            study, samples = read_sample_status(resp.raw)
+            accession = study["accession"]
+            yield study, samples, resp
+
+        version = int(accession.split(".")[1].lstrip("v"))
+        if version <= 1:
+            return
+        query = f"{study_phs}.v{version - 1}"
+
+
+def get_latest_sample_status(
+    study_phs, dbgap_status="released", cache=None, session=None
+):
+    """
+    Discover the latest version of a study's sample status file that has the
+    given status and return its samples.
+
+    Versions are walked backwards from the newest one (e.g. if phsXXX.v2.p1
+    exists but isn't released yet, phsXXX.v1.p1 is tried next). Only the
+    Study header of each candidate is read until the wanted version is found,
+    and that version's samples are served from the cache when possible.
+
+    :returns: the full accession and {submitted_sample_id: Sample}
+    """
+    session = session or HttpClient()
+    for study, samples, _ in _sample_status_versions(study_phs, session):
+        if study.get("registration_status") == dbgap_status:
+            accession = study["accession"]
+            table = cache.get(accession) if cache else None
+            if table is None:
+                table = dict(samples)
+                if cache:
+                    cache.put(accession, table)
+            return accession, table
+    raise Exception(
+        f"No version of {study_phs.split('.', 1)[0]} has dbGaP status"
+        f" '{dbgap_status}'"
+    )
+
+
+def find_latest_release(
+    study_phs, dbgap_status="released", session=None, validators=None
+):
+    """
+    Find the newest version of a study's sample status and the newest one
+    with the given status, reading only Study headers.
+
+    :param validators: {"etag": ..., "last_modified": ...} from an earlier
+        call, sent as a conditional request for the newest version
+    :returns: None if the newest version hasn't changed since validators
+        were recorded, otherwise {"latest": accession, "released": accession
+        or None, "etag": ..., "last_modified": ...}
+    """
+    session = session or HttpClient()
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+    found = {"latest": None, "released": None}
+    for study, _, resp in _sample_status_versions(study_phs, session, headers):
+        if study is None:
+            return None
+        if found["latest"] is None:
+            found["latest"] = study["accession"]
+            found["etag"] = resp.headers.get("ETag")
+            found["last_modified"] = resp.headers.get("Last-Modified")
+        if study.get("registration_status") == dbgap_status:
+            found["released"] = study["accession"]
+            break
+    return found
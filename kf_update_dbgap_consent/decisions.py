@@ -0,0 +1,216 @@
+"""
+An index of why every biospecimen and genomic file got its consent fields,
+visibility, and ACL.
+
+While the rules are evaluated, each decision is recorded as a compact rule ID
+(see RULES) with the resulting ACL and a short detail, such as the hidden
+biospecimen that hid a genomic file or the codes that were inconsistent.
+Decisions are written to a SQLite file keyed by kf_id, so explaining an
+entity's result later is a lookup instead of a rerun of the study.
+
+Delta runs only record decisions for the entities they reevaluate.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+# biospecimens
+BS_LOADED = "bs_loaded"
+BS_HIDDEN = "bs_hidden"
+BS_NO_SAMPLE = "bs_no_sample"
+BS_NOT_LOADED = "bs_not_loaded"
+# genomic files
+GF_OPEN = "gf_open"
+GF_CONSENT = "gf_consent"
+GF_INCONSISTENT_CODES = "gf_inconsistent_codes"
+GF_NULL_ACCESS = "gf_null_access"
+GF_HIDDEN = "gf_hidden"
+GF_HIDDEN_SPECIMEN = "gf_hidden_specimen"
+
+# rule: (endpoint, description)
+RULES = {
+    BS_LOADED: (
+        "biospecimens",
+        "visible: its dbGaP sample is Loaded, consent set from it",
+    ),
+    BS_HIDDEN: (
+        "biospecimens",
+        "hidden: already hidden in the dataservice, consent set from its"
+        " Loaded dbGaP sample",
+    ),
+    BS_NO_SAMPLE: ("biospecimens", "hidden: no dbGaP sample matches it"),
+    BS_NOT_LOADED: ("biospecimens", "hidden: its dbGaP sample isn't Loaded"),
+    GF_OPEN: ("genomic-files", "visible, controlled_access False: open ACL"),
+    GF_CONSENT: (
+        "genomic-files",
+        "visible, controlled access: default ACL plus the consent code of"
+        " its biospecimens",
+    ),
+    GF_INCONSISTENT_CODES: (
+        "genomic-files",
+        "visible, controlled access: default ACL because its biospecimens"
+        " have inconsistent consent codes",
+    ),
+    GF_NULL_ACCESS: (
+        "genomic-files",
+        "visible, controlled_access null: ACL left as is",
+    ),
+    GF_HIDDEN: (
+        "genomic-files",
+        "hidden: the genomic file is hidden, so default ACL (empty if"
+        " controlled_access is null)",
+    ),
+    GF_HIDDEN_SPECIMEN: (
+        "genomic-files",
+        "hidden: a contributing biospecimen is hidden, so default ACL (empty"
+        " if controlled_access is null)",
+    ),
+}
+
+INSERT_BATCH = 10000
+
+# Decisions are indexed once they're all written, which is much cheaper than
+# keeping the index up to date on every insert. Each distinct ACL is only
+# stored once.
+_SCHEMA = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+CREATE TABLE rules (rule TEXT PRIMARY KEY, endpoint TEXT, description TEXT);
+CREATE TABLE studies (study_id TEXT PRIMARY KEY, accession TEXT);
+CREATE TABLE acls (id INTEGER PRIMARY KEY, acl TEXT);
+CREATE TABLE decisions (
+    kf_id TEXT,
+    study_id TEXT,
+    rule TEXT,
+    acl INTEGER,
+    detail TEXT
+);
+"""
+_INDEXES = """
+CREATE INDEX decisions_kf_id ON decisions (kf_id);
+CREATE INDEX decisions_rule ON decisions (study_id, rule);
+"""
+
+
+def decisions_path(plan_path):
+    """
+    :returns: the path of the decision index kept next to a plan file, e.g.
+        SD_12345678.decisions.sqlite for SD_12345678.ndjson.gz
+    """
+    base = plan_path
+    for suffix in [".gz", ".ndjson", ".jsonl", ".json"]:
+        if base.endswith(suffix):
+            base = base[: -len(suffix)]
+    return f"{base}.decisions.sqlite"
+
+
+class DecisionIndex:
+    """
+    Records rule decisions to a new SQLite file at path, replacing any
+    previous one. Safe to share between threads, e.g. by the workers of
+    batch.process_studies. Close it to make the decisions readable.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.db.executemany(
+            "INSERT INTO rules VALUES (?, ?, ?)",
+            [(rule, *info) for rule, info in RULES.items()],
+        )
+        self.acl_ids = {None: None}
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def add_study(self, study_id, accession):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO studies VALUES (?, ?)",
+                (study_id, accession),
+            )
+
+    def _acl_id(self, acl):
+        if acl not in self.acl_ids:
+            self.acl_ids[acl] = len(self.acl_ids)
+            self.db.execute(
+                "INSERT INTO acls VALUES (?, ?)", (self.acl_ids[acl], acl)
+            )
+        return self.acl_ids[acl]
+
+    def add(self, study_id, rows):
+        """
+        :param rows: (kf_id, rule, acl as JSON or None, detail or None)
+            tuples
+        """
+        with self._lock:
+            acl_id = self._acl_id
+            self.pending.extend(
+                (kfid, study_id, rule, acl_id(acl), detail)
+                for kfid, rule, acl, detail in rows
+            )
+            if len(self.pending) >= INSERT_BATCH:
+                self._flush()
+
+    def _flush(self):
+        self.db.executemany(
+            "INSERT INTO decisions VALUES (?, ?, ?, ?, ?)", self.pending
+        )
+        self.pending = []
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            self.db.executescript(_INDEXES)
+            self.db.commit()
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def explain(path, kf_id):
+    """
+    Look up why an entity got its result.
+
+    :returns: dict of kf_id, study_id, accession, endpoint, rule,
+        description, acl, and detail, or None if no decision was recorded
+        for kf_id
+    """
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        # the latest decision, if a study was evaluated more than once
+        row = db.execute(
+            "SELECT d.kf_id, d.study_id, s.accession, r.endpoint, d.rule,"
+            " r.description, a.acl, d.detail FROM decisions d"
+            " LEFT JOIN studies s ON s.study_id = d.study_id"
+            " LEFT JOIN rules r ON r.rule = d.rule"
+            " LEFT JOIN acls a ON a.id = d.acl"
+            " WHERE d.kf_id = ? ORDER BY d.rowid DESC LIMIT 1",
+            (kf_id,),
+        ).fetchone()
+    finally:
+        db.close()
+    if row is None:
+        return None
+    keys = [
+        "kf_id",
+        "study_id",
+        "accession",
+        "endpoint",
+        "rule",
+        "description",
+        "acl",
+        "detail",
+    ]
+    explanation = dict(zip(keys, row))
+    if explanation["acl"] is not None:
+        explanation["acl"] = json.loads(explanation["acl"])
+    return explanation
@@ -0,0 +1,27 @@
+"""
+Default settings shown in the command line help.
+
+They live here, with no imports, rather than in the modules that use them,
+so that building the argument parsers doesn't import the HTTP client,
+database drivers, or anything else a run may not need.
+"""
+
+# batch
+DEFAULT_WORKERS = 4
+# apply
+DEFAULT_PATCH_WORKERS = 8
+# scrape
+DEFAULT_SCRAPE_WORKERS = 8
+# stream
+DEFAULT_CHUNK_SIZE = 50000
+# service
+DEFAULT_PORT = 8765
+# cache sizes in samples and in entities (biospecimens, genomic files, and
+# links between them)
+DEFAULT_SAMPLE_CACHE_SIZE = 5000000
+DEFAULT_ENTITY_CACHE_SIZE = 20000000
+DEFAULT_ENTITY_TTL = 3600
+# watch
+DEFAULT_INTERVAL = 3600
+# alerts
+DEFAULT_ALERT_CONSOLE_LIMIT = 20
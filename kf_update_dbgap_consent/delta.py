@@ -0,0 +1,80 @@
+"""
+State for incremental (delta) consent updates.
+
+After a run's patches are applied, the dbGaP accession and sample table it
+used are saved per study. The next delta run diffs the newly released sample
+table against the saved one and only recomputes consent for biospecimens
+whose samples changed, plus the genomic files linked to them.
+"""
+
+import gzip
+import json
+import os
+import tempfile
+
+from kf_update_dbgap_consent.dbgap import Sample
+
+
+def diff_samples(old_samples, new_samples):
+    """
+    Find submitted sample IDs that were added, removed, or changed between
+    two sample tables.
+    """
+    changed = set(old_samples.keys() ^ new_samples.keys())
+    changed.update(
+        k
+        for k, v in new_samples.items()
+        if k in old_samples and old_samples[k] != v
+    )
+    return changed
+
+
+class ConsentState:
+    """
+    Per-study record of the last applied accession and its sample table.
+    """
+
+    def __init__(self, state_dir):
+        self.state_dir = state_dir
+        os.makedirs(state_dir, exist_ok=True)
+
+    def _path(self, study_id):
+        return os.path.join(self.state_dir, f"{study_id}.json.gz")
+
+    def load(self, study_id, match_aliquot=False):
+        """
+        :returns: (accession, samples) of the last applied run, or None if
+            there isn't one that was matched the same way
+        """
+        try:
+            with gzip.open(self._path(study_id), "rt") as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return None
+        if state["match_aliquot"] != match_aliquot:
+            return None
+        return state["accession"], {
+            k: Sample(*v) for k, v in state["samples"].items()
+        }
+
+    def save(self, study_id, accession, samples, match_aliquot=False):
+        path = self._path(study_id)
+        # unique per writer, so jobs saving the same study don't clash
+        fd, tmp_path = tempfile.mkstemp(
+            prefix=f"{study_id}.", suffix=".tmp", dir=self.state_dir
+        )
+        os.close(fd)
+        try:
+            with gzip.open(tmp_path, "wt") as f:
+                json.dump(
+                    {
+                        "accession": accession,
+                        "match_aliquot": match_aliquot,
+                        "samples": samples,
+                    },
+                    f,
+                )
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
@@ -0,0 +1,243 @@
+"""
+Compact in-memory tables of the study entities the consent rules look at.
+
+Full entity JSON (with `_links` and every API field) for a study with
+millions of genomic files takes many GB of RAM, but the rules only read a
+handful of fields. Entities are therefore projected into `__slots__` records
+as they're loaded, kf_ids are interned, and biospecimen-genomic-file links
+are kept only as a bipartite index between kf_ids.
+
+The other link tables below biospecimens are indexed too, so that the
+descendants of hidden biospecimens can be found locally instead of with
+another traversal of the dataservice.
+"""
+
+import sys
+from collections import Counter, defaultdict
+
+MISSING = object()
+
+# Endpoints loaded for a study, in addition to biospecimens and genomic files
+LINK_ENDPOINTS = {
+    # link endpoint: (parent field, child field, child endpoint)
+    "biospecimen-genomic-files": (
+        "biospecimen",
+        "genomic_file",
+        "genomic-files",
+    ),
+    "biospecimen-diagnoses": ("biospecimen", "diagnosis", "diagnoses"),
+    "sequencing-experiment-genomic-files": (
+        "genomic_file",
+        "sequencing_experiment",
+        "sequencing-experiments",
+    ),
+    "read-group-genomic-files": ("genomic_file", "read_group", "read-groups"),
+}
+GF_GROUP_ENDPOINTS = ["sequencing-experiments", "read-groups"]
+STUDY_ENDPOINTS = [
+    "biospecimens",
+    "genomic-files",
+    *LINK_ENDPOINTS,
+    *GF_GROUP_ENDPOINTS,
+]
+
+
+def _link(e, field):
+    """
+    Get the kf_id of a linked entity from either an API entity (`_links`) or
+    a database row (`<field>_id`)
+    """
+    if f"{field}_id" in e:
+        return e[f"{field}_id"]
+    return e["_links"][field].rsplit("/", 1)[1]
+
+
+class Biospecimen:
+    __slots__ = (
+        "kf_id",
+        "visible",
+        "consent_type",
+        "dbgap_consent_code",
+        "external_sample_id",
+        "external_aliquot_id",
+    )
+
+    def __init__(self, e):
+        self.kf_id = sys.intern(e["kf_id"])
+        self.visible = e["visible"]
+        self.consent_type = e.get("consent_type")
+        self.dbgap_consent_code = e.get("dbgap_consent_code")
+        self.external_sample_id = e.get("external_sample_id")
+        self.external_aliquot_id = e.get("external_aliquot_id")
+
+
+class GenomicFile:
+    __slots__ = ("kf_id", "visible", "controlled_access", "acl", "latest_did")
+
+    def __init__(self, e):
+        self.kf_id = sys.intern(e["kf_id"])
+        self.visible = e["visible"]
+        self.controlled_access = e.get("controlled_access")
+        acl = e.get("acl")
+        self.acl = None if acl is None else tuple(sorted(acl))
+        self.latest_did = e.get("latest_did")
+
+
+class StudyEntities:
+    """
+    Field-projected biospecimens and genomic files of a study, the links
+    between them, and which entities of other endpoints are hidden.
+
+    gf_specimens maps each genomic file to {biospecimen: link kf_id}. The
+    other link tables are kept in links as
+    {link endpoint: {parent: {link kf_id: child}}}.
+    """
+
+    def __init__(self):
+        self.biospecimens = {}
+        self.genomic_files = {}
+        self.gf_specimens = defaultdict(dict)
+        self.links = defaultdict(lambda: defaultdict(dict))
+        self.group_sizes = defaultdict(Counter)
+        self.hidden = defaultdict(set)
+
+    def add(self, endpoint, e):
+        """
+        Add an API entity or database row from the given endpoint
+        """
+        if endpoint == "biospecimens":
+            bs = Biospecimen(e)
+            self.biospecimens[bs.kf_id] = bs
+        elif endpoint == "genomic-files":
+            gf = GenomicFile(e)
+            self.genomic_files[gf.kf_id] = gf
+        else:
+            kfid = sys.intern(e["kf_id"])
+            if endpoint in LINK_ENDPOINTS:
+                parent_field, child_field, child_endpoint = LINK_ENDPOINTS[
+                    endpoint
+                ]
+                self.add_link(
+                    endpoint,
+                    kfid,
+                    _link(e, parent_field),
+                    _link(e, child_field),
+                )
+            if e["visible"]:
+                self.hidden[endpoint].discard(kfid)
+            else:
+                self.hidden[endpoint].add(kfid)
+
+    def add_link(self, endpoint, kfid, parent, child):
+        kfid, parent, child = map(sys.intern, (kfid, parent, child))
+        if endpoint == "biospecimen-genomic-files":
+            self.gf_specimens[child][parent] = kfid
+        else:
+            children = self.links[endpoint][parent]
+            if kfid not in children:
+                child_endpoint = LINK_ENDPOINTS[endpoint][2]
+                if child_endpoint in GF_GROUP_ENDPOINTS:
+                    self.group_sizes[child_endpoint][child] += 1
+            children[kfid] = child
+
+    def hidden_descendants(self, specimens):
+        """
+        Find the descendants of the given biospecimens, the same way as
+        kf_utils' find_descendants_by_kfids with
+        ignore_gfs_with_hidden_external_contribs=False: every genomic file
+        with a contribution from one of the biospecimens is included, whether
+        or not other biospecimens also contribute to it, and sequencing
+        experiments and read groups are only included if all of their genomic
+        files are.
+
+        :returns: {endpoint: {kf_id, ...}}, not including the biospecimens
+        """
+        descendants = defaultdict(set)
+        for bsid in specimens:
+            descendants["biospecimen-diagnoses"].update(
+                self.links["biospecimen-diagnoses"].get(bsid, ())
+            )
+        for gfid, bs_links in self.gf_specimens.items():
+            for bsid, link_kfid in bs_links.items():
+                if bsid in specimens:
+                    descendants["biospecimen-genomic-files"].add(link_kfid)
+                    descendants["genomic-files"].add(gfid)
+        for endpoint, (_, _, child_endpoint) in LINK_ENDPOINTS.items():
+            if child_endpoint not in GF_GROUP_ENDPOINTS:
+                continue
+            found = Counter()
+            gf_links = self.links[endpoint]
+            for gfid in descendants["genomic-files"]:
+                for link_kfid, child in gf_links.get(gfid, {}).items():
+                    descendants[endpoint].add(link_kfid)
+                    found[child] += 1
+            sizes = self.group_sizes[child_endpoint]
+            descendants[child_endpoint] = {
+                k for k, n in found.items() if n == sizes[k]
+            }
+        return {k: v for k, v in descendants.items() if v}
+
+    def specimen_gfs(self):
+        """
+        :returns: the reverse of gf_specimens, biospecimen -> genomic files
+        """
+        index = defaultdict(set)
+        for gfid, bsids in self.gf_specimens.items():
+            for bsid in bsids:
+                index[bsid].add(gfid)
+        return index
+
+    def get_field(self, endpoint, kfid, field):
+        """
+        Get the current value of an entity field, or MISSING if it isn't
+        known
+        """
+        if endpoint == "biospecimens":
+            table = self.biospecimens
+        elif endpoint == "genomic-files":
+            table = self.genomic_files
+        else:
+            if field == "visible" and kfid in self.hidden.get(endpoint, ()):
+                return False
+            return MISSING
+        e = table.get(kfid)
+        if e is None:
+            return MISSING
+        return getattr(e, field, MISSING)
+
+    def remove_noop_patches(self, patches):
+        """
+        Drop patch fields that already match the current values, then any
+        patches and endpoints left empty.
+        """
+        kept = {}
+        for endpoint, ep_patches in patches.items():
+            if endpoint == "biospecimens":
+                table = self.biospecimens
+            elif endpoint == "genomic-files":
+                table = self.genomic_files
+            else:
+                table = None
+            hidden = self.hidden.get(endpoint, ())
+            kept_patches = {}
+            for kfid, patch in ep_patches.items():
+                e = None if table is None else table.get(kfid)
+                changes = {}
+                for k, v in patch.items():
+                    if e is not None:
+                        current = getattr(e, k, MISSING)
+                    elif table is None and k == "visible" and kfid in hidden:
+                        current = False
+                    else:
+                        current = MISSING
+                    if isinstance(current, tuple) and isinstance(v, list):
+                        unneeded = current == tuple(sorted(v))
+                    else:
+                        unneeded = current == v
+                    if not unneeded:
+                        changes[k] = v
+                if changes:
+                    kept_patches[kfid] = changes
+            if kept_patches:
+                kept[endpoint] = kept_patches
+        return kept
@@ -0,0 +1,213 @@
+"""
+Lightweight run instrumentation.
+
+Collects per-phase wall and CPU time, HTTP request counts and latency
+histograms per endpoint, database query times, counters (entities, patches,
+alerts), and peak RSS. Recording is a few dictionary updates under a lock,
+so it is always on; the report is only written when asked for.
+"""
+
+import json
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Upper bounds of the HTTP latency histogram buckets, in milliseconds
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+KFID_RE = re.compile(r"^[A-Z]{2}_[A-Z0-9]{8}$")
+
+
+def peak_rss_bytes():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def endpoint_key(method, url):
+    """
+    Group requests by method and path with kf_ids replaced, e.g.
+    "PATCH /genomic-files/{kf_id}"
+    """
+    path = "/".join(
+        "{kf_id}" if KFID_RE.match(p) else p
+        for p in urlparse(url).path.split("/")
+    )
+    return f"{method} {path}"
+
+
+class _Stats:
+    __slots__ = ("count", "seconds", "max_seconds")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+
+    def report(self):
+        return {
+            "count": self.count,
+            "seconds": round(self.seconds, 6),
+            "mean_ms": round(1000 * self.seconds / max(self.count, 1), 3),
+            "max_ms": round(1000 * self.max_seconds, 3),
+        }
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.phases = defaultdict(lambda: {"wall": 0.0, "cpu": 0.0, "count": 0})
+        self.counters = Counter()
+        self.http = defaultdict(_Stats)
+        self.http_status = defaultdict(Counter)
+        self.http_histogram = defaultdict(
+            lambda: [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        )
+        self.db = defaultdict(_Stats)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the run. Phases that run more than once (e.g. for
+        each study of a batch) accumulate. CPU time is that of the calling
+        thread, so studies processed in parallel don't count each other's.
+        """
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.thread_time() - cpu
+            with self._lock:
+                p = self.phases[name]
+                p["wall"] += wall
+                p["cpu"] += cpu
+                p["count"] += 1
+
+    @contextmanager
+    def db_query(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.db[name].add(elapsed)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe_http(self, method, url, status_code, seconds):
+        key = endpoint_key(method, url)
+        ms = 1000 * seconds
+        bucket = len(LATENCY_BUCKETS_MS)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if ms <= bound:
+                bucket = i
+                break
+        with self._lock:
+            self.http[key].add(seconds)
+            self.http_status[key][status_code] += 1
+            self.http_histogram[key][bucket] += 1
+
+    def http_hook(self, resp, *args, **kwargs):
+        """
+        requests response hook, e.g.
+        session.hooks["response"].append(metrics.http_hook)
+        """
+        self.observe_http(
+            resp.request.method,
+            resp.url,
+            resp.status_code,
+            resp.elapsed.total_seconds(),
+        )
+
+    def instrument(self, session):
+        """
+        Record every request made through a requests session
+        """
+        if self.http_hook not in session.hooks["response"]:
+            session.hooks["response"].append(self.http_hook)
+        return session
+
+    def report(self):
+        buckets = [f"<={b}ms" for b in LATENCY_BUCKETS_MS] + [
+            f">{LATENCY_BUCKETS_MS[-1]}ms"
+        ]
+        with self._lock:
+            return {
+                "wall_seconds": round(time.time() - self.started, 3),
+                "peak_rss_bytes": peak_rss_bytes(),
+                "phases": {
+                    k: {
+                        "wall": round(v["wall"], 6),
+                        "cpu": round(v["cpu"], 6),
+                        "count": v["count"],
+                    }
+                    for k, v in self.phases.items()
+                },
+                "counters": dict(self.counters),
+                "http": {
+                    k: {
+                        **v.report(),
+                        "status": {
+                            str(s): n for s, n in self.http_status[k].items()
+                        },
+                        "latency_histogram": dict(
+                            zip(buckets, self.http_histogram[k])
+                        ),
+                    }
+                    for k, v in self.http.items()
+                },
+                "db": {k: v.report() for k, v in self.db.items()},
+            }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def summary(self):
+        """
+        :returns: a short human readable summary of the report
+        """
+        report = self.report()
+        lines = [f"Total wall time: {report['wall_seconds']:.1f}s"]
+        for name, p in report["phases"].items():
+            lines.append(
+                f"  {name}: {p['wall']:.2f}s wall, {p['cpu']:.2f}s cpu"
+                + (f" ({p['count']} runs)" if p["count"] > 1 else "")
+            )
+        for key, h in sorted(report["http"].items()):
+            lines.append(
+                f"  {key}: {h['count']} requests, {h['mean_ms']:.0f}ms mean,"
+                f" {h['max_ms']:.0f}ms max"
+            )
+        for key, d in report["db"].items():
+            lines.append(
+                f"  db {key}: {d['count']} queries, {d['seconds']:.2f}s"
+            )
+        for key, n in sorted(report["counters"].items()):
+            lines.append(f"  {key}: {n}")
+        if report["peak_rss_bytes"]:
+            lines.append(
+                f"Peak RSS: {report['peak_rss_bytes'] / 2 ** 20:.0f} MiB"
+            )
+        return "\n".join(lines)
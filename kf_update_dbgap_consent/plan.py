@@ -0,0 +1,140 @@
+"""
+Plan files: the patches computed for a set of studies, written as they are
+computed so that they can be reviewed and then applied later without
+repeating the scrape and rule evaluation.
+
+A plan is NDJSON, gzip-compressed if its path ends in ".gz". Every line is
+either a patch:
+
+    {"type": "patch", "study_id": ..., "accession": ..., "endpoint": ...,
+     "kf_id": ..., "patch": {...}}
+
+or, after all of a study's patches, a record of the study's outcome:
+
+    {"type": "study", "study_id": ..., "accession": ...,
+     "match_aliquot": ..., "patches": <count>, "alerts": [...],
+     "error": ...}
+
+Streamed studies (see batch.stream_studies) write their patches a chunk at
+a time, so a study that fails partway leaves some of its patches ahead of a
+study record with an error. Only the patches of studies that finished
+without an error should be applied (see complete_studies).
+
+A study's patches are written parents first (see apply.ENDPOINT_ORDER), so
+applying a plan in file order keeps the order PatchApplier uses.
+"""
+
+import gzip
+import json
+from collections import Counter
+
+from kf_update_dbgap_consent.apply import ordered_endpoints
+
+
+def open_plan(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, f"{mode}t")
+    return open(path, mode)
+
+
+class PlanWriter:
+    def __init__(self, path):
+        self.file = open_plan(path, "w")
+        self.counts = Counter()
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, sort_keys=True))
+        self.file.write("\n")
+
+    def write_patches(self, study_id, patches, accession=None):
+        """
+        Write some of a study's patches ahead of write_study, e.g. a chunk
+        from batch.stream_studies
+        """
+        for endpoint in ordered_endpoints(patches):
+            for kfid, patch in patches[endpoint].items():
+                self._write(
+                    {
+                        "type": "patch",
+                        "study_id": study_id,
+                        "accession": accession,
+                        "endpoint": endpoint,
+                        "kf_id": kfid,
+                        "patch": patch,
+                    }
+                )
+                self.counts[study_id] += 1
+        self.file.flush()
+
+    def write_study(
+        self, study_id, result, accession=None, match_aliquot=False
+    ):
+        """
+        Write the rest of a study's patches and its outcome.
+
+        :param result: a study result from batch.process_studies or
+            batch.stream_studies
+        """
+        self.write_patches(study_id, result["patches"], accession)
+        self._write(
+            {
+                "type": "study",
+                "study_id": study_id,
+                "accession": accession,
+                "match_aliquot": match_aliquot,
+                "patches": self.counts.pop(study_id, 0),
+                "alerts": [str(a) for a in result["alerts"]],
+                "error": result["error"],
+            }
+        )
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_plan(path):
+    """
+    Stream the records of a plan file
+    """
+    with open_plan(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_studies(path):
+    """
+    Read the study records of a plan file
+
+    :returns: {study_id: study record}
+    """
+    return {r["study_id"]: r for r in read_plan(path) if r["type"] == "study"}
+
+
+def complete_studies(studies):
+    """
+    The IDs of the studies that finished without an error
+    """
+    return {k for k, v in studies.items() if not v["error"]}
+
+
+def patch_records(records, studies=None, study_ids=None):
+    """
+    Reduce plan records to (endpoint, kf_id, patch), collecting the study
+    records into the studies dict (if given) along the way.
+
+    :param study_ids: optional set of the only studies to yield patches for
+    """
+    for record in records:
+        if record["type"] == "patch":
+            if study_ids is None or record["study_id"] in study_ids:
+                yield record["endpoint"], record["kf_id"], record["patch"]
+        elif studies is not None:
+            studies[record["study_id"]] = record
@@ -56,26 +56,129 @@
     that genomic file should get `{default_acl}`. **Return or display an alert
     for each such case.**
 """
-from collections import defaultdict
-from concurrent.futures import ThreadPoolExecutor, as_completed
-
-from d3b_utils.requests_retry import Session
 
-from kf_utils.dataservice.descendants import find_descendants_by_kfids
-from kf_utils.dataservice.scrape import yield_entities
-from kf_utils.dbgap.release import get_latest_sample_status
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from kf_update_dbgap_consent.acl_engine import batched_acls
+from kf_update_dbgap_consent.acl_export import final_acls
+from kf_update_dbgap_consent.alerts import (
+    AlertLog,
+    InconsistentCodes,
+    MissingSample,
+    NullAccess,
+)
+from kf_update_dbgap_consent.client import HttpClient, pool_size_for
+from kf_update_dbgap_consent.dbgap import (
+    SampleStatusCache,
+    get_latest_sample_status,
+)
+from kf_update_dbgap_consent.decisions import (
+    BS_HIDDEN,
+    BS_LOADED,
+    BS_NO_SAMPLE,
+    BS_NOT_LOADED,
+)
+from kf_update_dbgap_consent.defaults import (
+    DEFAULT_CHUNK_SIZE,
+    DEFAULT_SCRAPE_WORKERS,
+)
+from kf_update_dbgap_consent.delta import ConsentState, diff_samples
+from kf_update_dbgap_consent.entities import STUDY_ENDPOINTS, StudyEntities
+from kf_update_dbgap_consent.metrics import Metrics
 
 
 class ConsentProcessor:
-    def __init__(self, api_url, db_url=None):
+    def __init__(
+        self,
+        api_url,
+        db_url=None,
+        cache_dir=None,
+        state_dir=None,
+        metrics=None,
+        scrape_workers=DEFAULT_SCRAPE_WORKERS,
+        sample_status_cache=None,
+        entity_cache=None,
+        session=None,
+        pool_size=None,
+        decisions=None,
+        alert_log=None,
+        snapshot_dir=None,
+        full_refresh=False,
+        rules_in_db=False,
+        acl_export=None,
+    ):
+        """
+        :param sample_status_cache: optional cache of parsed sample status
+            files with get(accession) and put(accession, samples), used
+            instead of a SampleStatusCache in cache_dir
+        :param entity_cache: optional cache of StudyEntities by study, with
+            get(study_id) and put(study_id, entities)
+        :param session: optional HttpClient for every dataservice and dbGaP
+            request. Share it (e.g. with PatchApplier) to reuse connections.
+        :param pool_size: connections per host for a new HttpClient, by
+            default enough for scrape_workers
+        :param decisions: optional decisions.DecisionIndex to record the rule
+            behind each biospecimen and genomic file result in
+        :param alert_log: optional alerts.AlertLog to report every study's
+            alerts to, by default one that only prints a limited number of
+            them
+        :param snapshot_dir: optional directory for keeping a snapshot of
+            each study's rows from the db_url database, so that later runs
+            only read the rows that changed
+        :param full_refresh: read every row again instead of only the
+            changed ones when refreshing snapshots
+        :param rules_in_db: evaluate the rules inside the db_url database
+            (see db_rules) instead of loading the study's entities
+        :param acl_export: optional acl_export.AclExport to add the final
+            ACL of every genomic file of each study to
+        """
+        if snapshot_dir and not db_url:
+            raise Exception("Study snapshots require a db_url")
+        if rules_in_db and not db_url:
+            raise Exception(
+                "Evaluating the rules in the database requires a db_url"
+            )
         self.api_url = api_url
         self.db_url = db_url
+        self.metrics = metrics or Metrics()
+        self.scrape_workers = scrape_workers
+        if session is None:
+            session = HttpClient(
+                pool_size=pool_size or pool_size_for(scrape_workers, 1)
+            )
+        self.session = self.metrics.instrument(session)
+        if sample_status_cache is None and cache_dir:
+            sample_status_cache = SampleStatusCache(cache_dir)
+        self.sample_status_cache = sample_status_cache
+        self.entity_cache = entity_cache
+        self.state = ConsentState(state_dir) if state_dir else None
+        self.used_samples = {}
+        self.decisions = decisions
+        self.alert_log = alert_log or AlertLog()
+        self.snapshot_dir = snapshot_dir
+        self.full_refresh = full_refresh
+        self.rules_in_db = rules_in_db
+        self.acl_export = acl_export
+
+    def save_state(self, study_id):
+        """
+        Record the dbGaP samples used for the study's last computed patches
+        as applied, so that the next delta run only considers what changed
+        since then.
+        """
+        accession, samples, match_aliquot = self.used_samples.pop(study_id)
+        self.state.save(study_id, accession, samples, match_aliquot)
 
-    def _link(self, e, field):
-        return e["_links"][field].rsplit("/", 1)[1]
-
-    def get_accession(self, study_id):
-        resp = Session().get(f"{self.api_url}/studies/{study_id}")
+    def get_accession(self, study_id, ttl=None):
+        """
+        :param ttl: how old (in seconds) a cached study lookup may be, by
+            default the session's cache_ttl
+        :returns: the study's dbGaP accession and its version
+        """
+        resp = self.session.cached_get(
+            f"{self.api_url}/studies/{study_id}", ttl=ttl
+        )
         if resp.status_code != 200:
             raise Exception(f"Study {study_id} not found in dataservice")
         study = resp.json()["results"]
@@ -87,30 +190,161 @@ class ConsentProcessor:
                 f"data_access_authority for study {study_id} is not 'dbGaP'"
             )
 
-    def get_patches_for_study(
-        self, study_id, dbgap_status="released", match_aliquot=False
-    ):
-        if match_aliquot:
-            match_entity = "external_aliquot_id"
+    def get_study_entities(self, study_id):
+        """
+        load_study_entities, through the entity cache if there is one
+        """
+        if self.entity_cache is None:
+            return self.load_study_entities(study_id)
+        entities = self.entity_cache.get(study_id)
+        if entities is None:
+            entities = self.load_study_entities(study_id)
+            self.entity_cache.put(study_id, entities)
         else:
-            match_entity = "external_sample_id"
-        print("Looking up dbGaP accession ID")
-        study_phs, study_version = self.get_accession(study_id)
-        print(f"Found accession ID: {study_phs}")
-        default_acl = {study_id, f"{study_phs}.c999"}
-        open_acl = {"*"}
-        empty_acl = set()
-        alerts = []
-        patches = defaultdict(lambda: defaultdict(dict))
+            self.metrics.count("entity_cache.hits")
+        return entities
+
+    def load_study_entities(self, study_id):
+        """
+        Load the fields the rules need for a study's biospecimens, genomic
+        files, and the links between them, either from the database (if
+        db_url was given) or by scraping the dataservice API.
+        """
+        entities = StudyEntities()
+        # the database and scrape paths are imported on first use so that
+        # runs only load the one they take
+        if self.snapshot_dir:
+            self.load_snapshot(study_id, entities.add)
+        elif self.db_url:
+            from kf_utils.dataservice.descendants import (
+                find_descendants_by_kfids,
+            )
+
+            print("Querying the database...")
+            with self.metrics.db_query("find_descendants_by_kfids"):
+                storage = find_descendants_by_kfids(
+                    self.db_url,
+                    "studies",
+                    [study_id],
+                    False,
+                    kfids_only=False,
+                )
+            for endpoint in STUDY_ENDPOINTS:
+                for e in storage.pop(endpoint, {}).values():
+                    entities.add(endpoint, e)
+            del storage
+        else:
+            from kf_update_dbgap_consent.scrape import Scraper
 
+            print("Scraping the dataservice...")
+            Scraper(self.session, self.api_url, self.scrape_workers).scrape(
+                STUDY_ENDPOINTS, {"study_id": study_id}, entities.add
+            )
+        self.metrics.count("entities.biospecimens", len(entities.biospecimens))
+        self.metrics.count(
+            "entities.genomic-files", len(entities.genomic_files)
+        )
+        self.metrics.count(
+            "entities.biospecimen-genomic-files",
+            sum(len(v) for v in entities.gf_specimens.values()),
+        )
+        return entities
+
+    def spool_study_entities(self, study_id, spool):
+        """
+        Load a study's entities into an EntitySpool, streaming them from the
+        database (if db_url was given) or scraping the dataservice API.
+        """
+        if self.snapshot_dir:
+            self.load_snapshot(study_id, spool.add)
+        elif self.db_url:
+            from kf_update_dbgap_consent.db import stream_study_rows
+
+            print("Streaming from the database...")
+            stream_study_rows(
+                self.db_url, study_id, spool.add, metrics=self.metrics
+            )
+        else:
+            from kf_update_dbgap_consent.scrape import Scraper
+
+            print("Scraping the dataservice...")
+            Scraper(self.session, self.api_url, self.scrape_workers).scrape(
+                STUDY_ENDPOINTS, {"study_id": study_id}, spool.add
+            )
+        spool.finish()
+        for endpoint in [
+            "biospecimens",
+            "genomic-files",
+            "biospecimen-genomic-files",
+        ]:
+            self.metrics.count(f"entities.{endpoint}", spool.counts[endpoint])
+
+    def load_snapshot(self, study_id, handle):
+        """
+        Refresh the study's snapshot from the database and load its rows
+
+        :param handle: called with (endpoint, row) for every row
+        """
+        from kf_update_dbgap_consent.db import refresh_snapshot
+        from kf_update_dbgap_consent.snapshot import StudySnapshot
+
+        with StudySnapshot(self.snapshot_dir, study_id) as snapshot:
+            print("Refreshing the study snapshot from the database...")
+            read = refresh_snapshot(
+                self.db_url,
+                study_id,
+                snapshot,
+                full=self.full_refresh,
+                metrics=self.metrics,
+            )
+            self.metrics.count("snapshot.rows_read", sum(read.values()))
+            snapshot.load(handle)
+
+    def _in_background(self, fn, *args):
+        """
+        Start fn(*args) in its own thread
+
+        :returns: a Future of its result
+        """
+        executor = ThreadPoolExecutor(1, thread_name_prefix="load")
+        try:
+            return executor.submit(fn, *args)
+        finally:
+            executor.shutdown(wait=False)
+
+    def _timed_entities(self, study_id):
+        with self.metrics.phase("load_entities"):
+            return self.get_study_entities(study_id)
+
+    def _timed_spool(self, study_id, spool):
+        with self.metrics.phase("load_entities"):
+            self.spool_study_entities(study_id, spool)
+
+    def find_release(self, study_id, dbgap_status, match_aliquot, patches):
+        """
+        Look up the study's dbGaP accession and get its latest sample status
+        with the given dbGaP status, adding the study's version patch to
+        patches and recording the samples in used_samples.
+
+        :returns: (study_phs, dbgap_samples)
+        """
+        with self.metrics.phase("lookup_study"):
+            print("Looking up dbGaP accession ID")
+            study_phs, study_version = self.get_accession(study_id)
+            print(f"Found accession ID: {study_phs}")
         """
         Rule: The tool should discover and use the latest version of the
         study’s sample status file that has status "released".
         """
-        released_accession, study = get_latest_sample_status(
-            study_phs, dbgap_status
-        )
+        with self.metrics.phase("fetch_sample_status"):
+            released_accession, dbgap_samples = get_latest_sample_status(
+                study_phs,
+                dbgap_status,
+                cache=self.sample_status_cache,
+                session=self.session,
+            )
         released_version = released_accession.split(".", 1)[1]
+        self.metrics.count("dbgap_samples", len(dbgap_samples))
 
         """
         Rule: The Study entity in the dataservice should have its version set to
@@ -119,131 +353,330 @@ class ConsentProcessor:
         if study_version != released_version:
             patches["studies"][study_id] = {"version": released_version}
 
-        dbgap_samples = {
-            s["@submitted_sample_id"]: s for s in study["SampleList"]["Sample"]
-        }
-
-        storage = defaultdict(dict)
-        gfids_bsids = defaultdict(set)
+        self.used_samples[study_id] = (
+            released_accession,
+            dbgap_samples,
+            match_aliquot,
+        )
+        if self.decisions:
+            self.decisions.add_study(study_id, released_accession)
+        return study_phs, dbgap_samples
 
-        if self.db_url:
-            print("Querying the database...")
-            storage = find_descendants_by_kfids(
-                self.db_url,
-                "studies",
-                [study_id],
-                False,
-                kfids_only=False,
+    def get_patches_for_study(
+        self,
+        study_id,
+        dbgap_status="released",
+        match_aliquot=False,
+        delta=False,
+    ):
+        """
+        Compute the dataservice patches needed to apply dbGaP consent for a
+        study.
+
+        With delta=True, only biospecimens whose dbGaP samples changed since
+        the last saved state (see save_state), and the genomic files linked to
+        them, are considered. This assumes the dataservice side of the study
+        hasn't otherwise changed since that state was applied. Without a
+        saved state, everything is considered.
+        """
+        if match_aliquot:
+            match_entity = "external_aliquot_id"
+        else:
+            match_entity = "external_sample_id"
+        patches = defaultdict(lambda: defaultdict(dict))
+        alerts = []
+        if self.rules_in_db:
+            if delta:
+                raise Exception(
+                    "Delta runs can't evaluate the rules in the database"
+                )
+            return self._patches_in_db(
+                study_id, dbgap_status, match_aliquot, match_entity, patches
             )
-            for e in storage["biospecimen-genomic-files"].values():
-                bsid = e["biospecimen_id"]
-                gfid = e["genomic_file_id"]
-                gfids_bsids[gfid].add(bsid)
+        previous = None
+        if delta and self.state:
+            previous = self.state.load(study_id, match_aliquot)
+        # A delta run with nothing changed in dbGaP doesn't need the
+        # entities, so only load them once it's known that it does.
+        # Otherwise they're loaded while the release is found.
+        loading = None
+        if not previous:
+            loading = self._in_background(self._timed_entities, study_id)
+        try:
+            study_phs, dbgap_samples = self.find_release(
+                study_id, dbgap_status, match_aliquot, patches
+            )
+        except BaseException:
+            # don't leave the load holding memory and connections
+            if loading is not None:
+                loading.cancel()
+                wait([loading])
+            raise
+        changed_samples = None
+        if previous:
+            changed_samples = diff_samples(previous[1], dbgap_samples)
+            print(f"{len(changed_samples)} samples changed since {previous[0]}")
+            if not changed_samples:
+                return {k: dict(v) for k, v in patches.items()}, alerts
+            entities = self._timed_entities(study_id)
         else:
-            print("Scraping the dataservice...")
-            with ThreadPoolExecutor() as tpex:
+            entities = loading.result()
+
+        with self.metrics.phase("rules"):
+            decisions = [] if self.decisions else None
+            rule_patches, alerts = self.evaluate_rules(
+                study_id,
+                study_phs,
+                dbgap_samples,
+                entities,
+                match_entity,
+                changed_samples,
+                decisions=decisions,
+            )
+            patches.update(rule_patches)
+            if self.decisions:
+                self.decisions.add(study_id, decisions)
 
-                def entities_dict(endpoint, filt):
-                    return {
-                        e["kf_id"]: e
-                        for e in yield_entities(
-                            self.api_url, endpoint, filt, True
-                        )
-                    }
-
-                futures = {
-                    tpex.submit(entities_dict, endpoint, filt): endpoint
-                    for endpoint, filt in [
-                        ("biospecimens", {"study_id": study_id}),
-                        ("biospecimen-genomic-files", {"study_id": study_id}),
-                        ("genomic-files", {"study_id": study_id}),
-                    ]
-                }
-                for f in as_completed(futures):
-                    storage[futures[f]].update(f.result())
-            print()
-            for e in storage["biospecimen-genomic-files"].values():
-                bsid = self._link(e, "biospecimen")
-                gfid = self._link(e, "genomic_file")
-                gfids_bsids[gfid].add(bsid)
-
-        hidden_specimens = {
-            k: e for k, e in storage["biospecimens"].items() if not e["visible"]
-        }
-        hidden_genomic_files = set(
-            k for k, e in storage["genomic-files"].items() if not e["visible"]
+        # remove known unneeded patches
+        with self.metrics.phase("diffing"):
+            patches = entities.remove_noop_patches(patches)
+        if self.acl_export:
+            self.acl_export.add(
+                study_id,
+                final_acls(
+                    entities.genomic_files, patches.get("genomic-files", {})
+                ),
+            )
+
+        for endpoint, endpoint_patches in patches.items():
+            self.metrics.count(f"patches.{endpoint}", len(endpoint_patches))
+        self.metrics.count("alerts", len(alerts))
+        self.alert_log.add(study_id, alerts)
+        return patches, alerts
+
+    def _patches_in_db(
+        self, study_id, dbgap_status, match_aliquot, match_entity, patches
+    ):
+        from kf_update_dbgap_consent.db_rules import evaluate_in_db
+
+        study_phs, dbgap_samples = self.find_release(
+            study_id, dbgap_status, match_aliquot, patches
+        )
+        with self.metrics.phase("rules"):
+            print("Evaluating the rules in the database...")
+            decisions = [] if self.decisions else None
+            acls = [] if self.acl_export else None
+            rule_patches, alerts, counts = evaluate_in_db(
+                self.db_url,
+                study_id,
+                study_phs,
+                dbgap_samples,
+                match_entity,
+                decisions,
+                acls,
+                metrics=self.metrics,
+            )
+            patches.update(rule_patches)
+            if self.decisions:
+                self.decisions.add(study_id, decisions)
+        if self.acl_export:
+            self.acl_export.add(study_id, acls)
+        for endpoint, n in counts.items():
+            self.metrics.count(f"entities.{endpoint}", n)
+        return self._counted(
+            study_id, {k: dict(v) for k, v in patches.items() if v}, alerts
         )
 
+    def stream_patches_for_study(
+        self,
+        study_id,
+        dbgap_status="released",
+        match_aliquot=False,
+        chunk_size=DEFAULT_CHUNK_SIZE,
+        spool_dir=None,
+    ):
         """
-        Rule: For all samples in the sample status file which are not found in
-        the dataservice, return or display an alert.
+        Compute the same patches and alerts as get_patches_for_study, with
+        memory bounded by chunk_size instead of by the size of the study (see
+        stream). Neither delta runs nor the entity cache are supported.
+
+        :param spool_dir: optional directory for the temporary entity spool
+        :yields: (patches, alerts) for the study and its biospecimens, then
+            for each chunk of genomic files, then for sequencing experiments
+            and read groups
         """
-        specimen_extids = set(
-            bs[match_entity] for bs in storage["biospecimens"].values()
-        )
-        for extid, s in dbgap_samples.items():
-            if (s["@dbgap_status"] == "Loaded") and (
-                extid not in specimen_extids
-            ):
-                alerts.append(
-                    f"ALERT: sample {extid} from dbGaP not found in dataservice"
+        from kf_update_dbgap_consent.stream import EntitySpool, chunked_rules
+
+        if match_aliquot:
+            match_entity = "external_aliquot_id"
+        else:
+            match_entity = "external_sample_id"
+        patches = defaultdict(lambda: defaultdict(dict))
+        alerts = []
+
+        with EntitySpool(spool_dir) as spool:
+            loaded = self._in_background(self._timed_spool, study_id, spool)
+            try:
+                study_phs, dbgap_samples = self.find_release(
+                    study_id, dbgap_status, match_aliquot, patches
                 )
-                print(alerts[-1])
+            finally:
+                # don't close the spool while it's still being written to
+                wait([loaded])
+            loaded.result()
+
+            with self.metrics.phase("rules"):
+                decisions = [] if self.decisions else None
+                specimen_codes, hidden_specimens, _, _ = self.specimen_rules(
+                    study_phs,
+                    dbgap_samples,
+                    spool.biospecimens.biospecimens,
+                    match_entity,
+                    None,
+                    patches,
+                    alerts,
+                    decisions,
+                )
+                for kfid, bsid, _, visible in spool.links(
+                    "biospecimen-diagnoses"
+                ):
+                    # null is already hidden, as in StudyEntities
+                    if bsid in hidden_specimens and visible:
+                        patches["biospecimen-diagnoses"][kfid][
+                            "visible"
+                        ] = False
+            with self.metrics.phase("diffing"):
+                patches = spool.biospecimens.remove_noop_patches(patches)
+            # only the consent code table is needed from here on
+            spool.biospecimens = None
+            yield self._counted(study_id, patches, alerts)
+
+            acls = [] if self.acl_export else None
+            chunks = chunked_rules(
+                study_id,
+                study_phs,
+                spool,
+                specimen_codes,
+                hidden_specimens,
+                chunk_size,
+                decisions,
+                acls,
+            )
+            while True:
+                with self.metrics.phase("rules"):
+                    chunk = next(chunks, None)
+                    if decisions:
+                        self.decisions.add(study_id, decisions)
+                        decisions.clear()
+                    if acls:
+                        self.acl_export.add(study_id, acls)
+                        acls.clear()
+                if chunk is None:
+                    break
+                yield self._counted(study_id, *chunk)
+
+    def _counted(self, study_id, patches, alerts):
+        for endpoint, endpoint_patches in patches.items():
+            self.metrics.count(f"patches.{endpoint}", len(endpoint_patches))
+        self.metrics.count("alerts", len(alerts))
+        self.alert_log.add(study_id, alerts)
+        return patches, alerts
 
+    def evaluate_rules(
+        self,
+        study_id,
+        study_phs,
+        dbgap_samples,
+        entities,
+        match_entity="external_sample_id",
+        changed_samples=None,
+        reference=False,
+        decisions=None,
+    ):
         """
-        Rule: Biospecimens whose samples are found in the sample status file
-        with status "Loaded" should have their consent_type dbgap_consent_code
-        fields set as indicated in the file.
-
-        All other biospecimens should be hidden in the dataservice and their
-        "consent_type" and "dbgap_consent_code" fields should be set to null.
+        Apply the consent rules for biospecimens, their descendants, and
+        genomic file ACLs.
+
+        :param changed_samples: if given, only consider biospecimens matched
+            to these dbGaP samples and the genomic files linked to them
+        :param reference: evaluate the genomic file ACL rules one file at a
+            time, as written below, instead of with the batched engine in
+            acl_engine. Both give the same patches and alerts once no-op
+            patches are removed.
+        :param decisions: optional list to add a decisions.DecisionIndex row
+            to for each evaluated biospecimen and, unless reference is set,
+            genomic file
+        :returns: patches (including ones that may not change anything) and
+            alerts
         """
-        for kfid, bs in storage["biospecimens"].items():
-            sample = dbgap_samples.get(bs[match_entity], {})
-            if sample.get("@dbgap_status") == "Loaded":
-                patches["biospecimens"][kfid] = {
-                    "consent_type": sample["@consent_short_name"],
-                    "dbgap_consent_code": f"{study_phs}.c{sample['@consent_code']}",
-                }
-            else:
-                patches["biospecimens"][kfid] = {
-                    "consent_type": None,
-                    "dbgap_consent_code": None,
-                    "visible": False,
-                }
-                hidden_specimens[kfid] = bs
+        default_acl = {study_id, f"{study_phs}.c999"}
+        open_acl = {"*"}
+        empty_acl = set()
+        alerts = []
+        patches = defaultdict(lambda: defaultdict(dict))
+        gfids_bsids = entities.gf_specimens
+
+        (
+            specimen_codes,
+            hidden_specimens,
+            newly_hidden_specimens,
+            affected_specimens,
+        ) = self.specimen_rules(
+            study_phs,
+            dbgap_samples,
+            entities.biospecimens,
+            match_entity,
+            changed_samples,
+            patches,
+            alerts,
+            decisions,
+        )
+        hidden_genomic_files = set(
+            k for k, e in entities.genomic_files.items() if not e.visible
+        )
 
         """
         Rule: If a biospecimen is hidden in the dataservice, its descendants
         should also be hidden.
         """
-        if hidden_specimens:
-            descendants_of_hidden_specimens = find_descendants_by_kfids(
-                self.db_url or self.api_url,
-                "biospecimens",
-                list(hidden_specimens.keys()),
-                ignore_gfs_with_hidden_external_contribs=False,
-                kfids_only=False,
-            )
-            descendants_of_hidden_specimens["biospecimens"] = hidden_specimens
-            for endpoint, entities in descendants_of_hidden_specimens.items():
-                for k, e in entities.items():
-                    storage[endpoint][k] = e
+        if newly_hidden_specimens:
+            descendants = entities.hidden_descendants(newly_hidden_specimens)
+            for endpoint, kfids in descendants.items():
+                for k in kfids:
                     patches[endpoint][k]["visible"] = False
 
         print()
 
         # ACLs
-        for gfid, bsids in gfids_bsids.items():
+        if changed_samples is None:
+            affected_genomic_files = gfids_bsids.keys()
+        else:
+            affected_genomic_files = set()
+            bsids_gfids = entities.specimen_gfs()
+            for bsid in affected_specimens:
+                affected_genomic_files.update(bsids_gfids[bsid])
+        if not reference:
+            batched_acls(
+                study_id,
+                study_phs,
+                entities,
+                affected_genomic_files,
+                specimen_codes,
+                hidden_specimens,
+                patches,
+                alerts,
+                decisions,
+            )
+            return patches, alerts
+
+        for gfid in affected_genomic_files:
+            bsids = gfids_bsids[gfid]
             all_biospecimens_visible = all(
                 [k not in hidden_specimens for k in bsids]
             )
-            biospecimen_codes = set(
-                patches["biospecimens"][k].get("dbgap_consent_code")
-                for k in bsids
-            )
+            biospecimen_codes = set(specimen_codes.get(k) for k in bsids)
             if (gfid not in hidden_genomic_files) and all_biospecimens_visible:
-                if storage["genomic-files"][gfid]["controlled_access"] is False:
+                if entities.genomic_files[gfid].controlled_access is False:
                     """
                     Rule: All non-hidden (aka visible) genomic files in the dataservice
                     with their `controlled_access` field set to **False** should get
@@ -252,19 +685,13 @@ class ConsentProcessor:
                     patches["genomic-files"][gfid].update(
                         {"acl": sorted(open_acl)}
                     )
-                elif (
-                    storage["genomic-files"][gfid]["controlled_access"] is None
-                ):
+                elif entities.genomic_files[gfid].controlled_access is None:
                     """
                     Rule: All non-hidden (aka visible) genomic files in the dataservice
                     with their controlled_access field set to **null** should **return or
                     display a QC failure alert**.
                     """
-                    alerts.append(
-                        f"ALERT: GF {gfid} is visible but has controlled_access"
-                        " set to null instead of True/False."
-                    )
-                    print(alerts[-1])
+                    alerts.append(NullAccess(gfid))
                 else:
                     """
                     Rule: All other genomic files in the dataservice should get
@@ -295,15 +722,13 @@ class ConsentProcessor:
                         case.
                         """
                         alerts.append(
-                            f"ALERT: GF {gfid} has inconsistent sample access"
-                            f" codes {biospecimen_codes}"
+                            InconsistentCodes(gfid, biospecimen_codes)
                         )
-                        print(alerts[-1])
                         patches["genomic-files"][gfid].update(
                             {"acl": sorted(default_acl)}
                         )
             else:
-                if storage["genomic-files"][gfid]["controlled_access"] is None:
+                if entities.genomic_files[gfid].controlled_access is None:
                     """
                     Rule: All hidden genomic files in the dataservice with their
                     controlled_access field set to **null** should get `{empty_acl}`.
@@ -320,35 +745,101 @@ class ConsentProcessor:
                         {"acl": sorted(default_acl)}
                     )
 
-        # remove known unneeded patches
+        return patches, alerts
 
-        def cmp(a, b):
-            if isinstance(a, list) and isinstance(b, list):
-                return sorted(a) == sorted(b)
+    def specimen_rules(
+        self,
+        study_phs,
+        dbgap_samples,
+        biospecimens,
+        match_entity,
+        changed_samples,
+        patches,
+        alerts,
+        decisions=None,
+    ):
+        """
+        Apply the consent rules for dbGaP samples and biospecimens, adding
+        their patches and alerts to the given ones.
+
+        :param biospecimens: {kf_id: Biospecimen}
+        :param decisions: optional list to add a decisions.DecisionIndex row
+            to for each affected biospecimen
+        :returns: (specimen_codes, hidden_specimens, newly_hidden_specimens,
+            affected_specimens) where specimen_codes maps every biospecimen
+            to its dbgap_consent_code
+        """
+        if changed_samples is None:
+            affected_specimens = biospecimens.keys()
+            affected_samples = dbgap_samples.keys()
+        else:
+            affected_specimens = {
+                k
+                for k, bs in biospecimens.items()
+                if getattr(bs, match_entity) in changed_samples
+            }
+            affected_samples = changed_samples & dbgap_samples.keys()
+
+        hidden_specimens = set(
+            k for k, e in biospecimens.items() if not e.visible
+        )
+
+        """
+        Rule: For all samples in the sample status file which are not found in
+        the dataservice, return or display an alert.
+        """
+        specimen_extids = set(
+            getattr(bs, match_entity) for bs in biospecimens.values()
+        )
+        for extid in affected_samples:
+            s = dbgap_samples[extid]
+            if (s.dbgap_status == "Loaded") and (extid not in specimen_extids):
+                alerts.append(MissingSample(extid))
+
+        """
+        Rule: Biospecimens whose samples are found in the sample status file
+        with status "Loaded" should have their consent_type dbgap_consent_code
+        fields set as indicated in the file.
+
+        All other biospecimens should be hidden in the dataservice and their
+        "consent_type" and "dbgap_consent_code" fields should be set to null.
+        """
+        specimen_codes = {}
+        newly_hidden_specimens = set()
+        for kfid, bs in biospecimens.items():
+            extid = getattr(bs, match_entity)
+            sample = dbgap_samples.get(extid)
+            if sample and sample.dbgap_status == "Loaded":
+                patch = {
+                    "consent_type": sample.consent_short_name,
+                    "dbgap_consent_code": f"{study_phs}.c{sample.consent_code}",
+                }
+                rule = BS_LOADED if bs.visible else BS_HIDDEN
             else:
-                return a == b
-
-        patches = {
-            endpoint: {
-                kfid: {
-                    k: v
-                    for k, v in patch.items()
-                    if not (
-                        (endpoint in storage)
-                        and (kfid in storage[endpoint])
-                        and (k in storage[endpoint][kfid])
-                        and (cmp(storage[endpoint][kfid][k], v))
-                    )
+                patch = {
+                    "consent_type": None,
+                    "dbgap_consent_code": None,
+                    "visible": False,
                 }
-                for kfid, patch in ep_patches.items()
-            }
-            for endpoint, ep_patches in patches.items()
-        }
-        patches = {
-            endpoint: {k: v for k, v in ep_patches.items() if v}
-            for endpoint, ep_patches in patches.items()
-        }
-        patches = {k: v for k, v in patches.items() if v}
-        # from pprint import pprint
-        # breakpoint()
-        return patches, alerts
+                hidden_specimens.add(kfid)
+                if kfid in affected_specimens:
+                    newly_hidden_specimens.add(kfid)
+                rule = BS_NOT_LOADED if sample else BS_NO_SAMPLE
+            specimen_codes[kfid] = patch["dbgap_consent_code"]
+            if kfid in affected_specimens:
+                patches["biospecimens"][kfid] = patch
+                if decisions is not None:
+                    detail = f"{match_entity} {extid}"
+                    if sample:
+                        detail += f", dbGaP status {sample.dbgap_status}"
+                    decisions.append((kfid, rule, None, detail))
+        if changed_samples is None:
+            newly_hidden_specimens = hidden_specimens
+        for k in newly_hidden_specimens:
+            patches["biospecimens"][k]["visible"] = False
+        return (
+            specimen_codes,
+            hidden_specimens,
+            newly_hidden_specimens,
+            affected_specimens,
+        )
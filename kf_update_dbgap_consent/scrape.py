@@ -0,0 +1,205 @@
+"""
+Concurrent scraping of dataservice endpoints.
+
+The dataservice pages through an endpoint in creation order: each page holds
+the next `limit` entities created after the `after` timestamp. Here every
+endpoint is split into created_at windows that are paged through at the
+same time. Whenever a worker is idle, a window that still has pages to go
+hands the upper half of its remaining time range to a new window, so even
+entities created in a few bulk loads keep every worker busy. The number of
+entities scraped from each endpoint is checked against the total the
+dataservice reports.
+
+The API can't return only some of an entity's fields, so pages carry whole
+entities and callers keep only what they need.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from kf_update_dbgap_consent.defaults import DEFAULT_SCRAPE_WORKERS
+
+PAGE_LIMIT = 100
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def to_microseconds(created_at):
+    """
+    :param created_at: ISO 8601 timestamp from the dataservice
+    :returns: integer microseconds since the epoch
+    """
+    dt = datetime.fromisoformat(created_at.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return (dt - EPOCH) // timedelta(microseconds=1)
+
+
+def format_after(microseconds):
+    """
+    The `after` query parameter for a time given in microseconds. Keeping
+    times as integers and formatting them exactly means that windows split
+    at any point neither drop nor repeat entities.
+    """
+    seconds, micros = divmod(microseconds, 1000000)
+    return f"{seconds}.{micros:06d}"
+
+
+class Scraper:
+    def __init__(
+        self, session, api_url, workers=DEFAULT_SCRAPE_WORKERS, limit=PAGE_LIMIT
+    ):
+        self.session = session
+        self.api_url = api_url
+        self.workers = workers
+        self.limit = limit
+
+    def scrape(self, endpoints, filters, handle):
+        """
+        Fetch every entity of the given endpoints that matches the filters.
+
+        :param endpoints: list of dataservice endpoints
+        :param filters: query filters, e.g. {"study_id": "SD_12345678"}
+        :param handle: called with (endpoint, entity) for every entity, from
+            worker threads but never more than one at a time
+        :returns: {endpoint: number of entities}
+        """
+        run = _ScrapeRun(self, filters, handle)
+        return run.run(endpoints)
+
+
+class _ScrapeRun:
+    def __init__(self, scraper, filters, handle):
+        self.scraper = scraper
+        self.filters = filters
+        self.handle = handle
+        self.lock = threading.Condition()
+        self.handle_lock = threading.Lock()
+        self.active = 0
+        self.error = None
+        self.counts = {}
+        self.totals = {}
+        self.scraped = 0
+        self.tpex = None
+
+    def run(self, endpoints):
+        # entities created after this are not part of the scrape's snapshot
+        # but are still picked up by an open-ended last window
+        now = (datetime.now(timezone.utc) - EPOCH) // timedelta(microseconds=1)
+        with ThreadPoolExecutor(max_workers=self.scraper.workers) as tpex:
+            self.tpex = tpex
+            for endpoint in endpoints:
+                self.counts[endpoint] = 0
+                self._submit(self._start, endpoint, now)
+            with self.lock:
+                while self.active:
+                    self.lock.wait()
+        if self.error:
+            raise self.error
+        for endpoint, total in self.totals.items():
+            if self.counts[endpoint] != total:
+                raise Exception(
+                    f"Scraped {self.counts[endpoint]} {endpoint} but the"
+                    f" dataservice reported {total}. Did they change during"
+                    " the scrape?"
+                )
+        if self.scraped:
+            print(f"  {self.scraped} entities")
+        return self.counts
+
+    def _submit(self, func, *args):
+        with self.lock:
+            self.active += 1
+        self.tpex.submit(self._call, func, *args)
+
+    def _call(self, func, *args):
+        try:
+            func(*args)
+        except Exception as e:
+            with self.lock:
+                self.error = self.error or e
+        finally:
+            with self.lock:
+                self.active -= 1
+                self.lock.notify_all()
+
+    def _get(self, endpoint, after, limit):
+        url = f"{self.scraper.api_url}/{endpoint}"
+        params = dict(self.filters, limit=limit)
+        if after is not None:
+            params["after"] = format_after(after)
+        resp = self.scraper.session.get(url, params=params)
+        if resp.status_code != 200:
+            raise Exception(
+                f"GET {url} with {params} failed: {resp.status_code}"
+                f" {resp.text}"
+            )
+        return resp.json()
+
+    def _start(self, endpoint, now):
+        """
+        Find the earliest entity and split the endpoint into a window up to
+        now and one for anything newer.
+        """
+        body = self._get(endpoint, None, 1)
+        self.totals[endpoint] = body["total"]
+        first = body["results"]
+        if not first:
+            return
+        start = to_microseconds(first[0]["created_at"]) - 1
+        self._submit(self._window, endpoint, start, max(now, start + 1))
+        self._submit(self._window, endpoint, max(now, start + 1), None)
+
+    def _window(self, endpoint, after, until):
+        """
+        Page through entities created in (after, until], or after `after`
+        if until is None.
+
+        Entities created at the same time as the last entity of a page may
+        not fit on it, so the next page starts at that time again and skips
+        the entities already handled.
+        """
+        seen = set()
+        while not self.error:
+            body = self._get(endpoint, after, self.scraper.limit)
+            page = []
+            finished = not body["_links"].get("next")
+            for e in body["results"]:
+                created = to_microseconds(e["created_at"])
+                if until is not None and created > until:
+                    finished = True
+                    break
+                if e["kf_id"] not in seen:
+                    page.append((created, e))
+            self._handle(endpoint, [e for _, e in page])
+            if finished or not body["results"]:
+                return
+            if not page:
+                raise Exception(
+                    f"More than {self.scraper.limit} {endpoint} were created"
+                    f" at {format_after(after + 1)}, can't page past them"
+                )
+            last = page[-1][0]
+            if last != after + 1:
+                seen = set()
+            seen.update(e["kf_id"] for created, e in page if created == last)
+            after = last - 1
+            if (
+                until is not None
+                and until - last > 1
+                and self.active < self.scraper.workers
+            ):
+                middle = last + (until - last) // 2
+                self._submit(self._window, endpoint, middle, until)
+                until = middle
+
+    def _handle(self, endpoint, page):
+        with self.handle_lock:
+            for e in page:
+                self.handle(endpoint, e)
+            self.counts[endpoint] += len(page)
+            before = self.scraped
+            self.scraped += len(page)
+            if self.scraped // 10000 > before // 10000:
+                print(f"  {self.scraped} entities", end="\r")
@@ -0,0 +1,400 @@
+"""
+A long-running consent service.
+
+Instead of paying process startup, connection setup, dbGaP downloads, and a
+full scrape for every invocation, the service keeps one ConsentProcessor
+warm and runs submitted studies as jobs on a pool of worker threads. Parsed
+sample status files and per-study entity indexes are kept in size-bounded
+LRU caches across jobs.
+
+Cached entity indexes are dropped when a job applies patches to their
+study, when they are older than the entity TTL, or on request.
+
+Local HTTP API (JSON unless noted):
+
+* GET /health
+* POST /jobs with {"study_id": ..., "match_aliquot": false, "delta": false,
+  "apply": false} -> 202 with the job
+* GET /jobs -> the most recent jobs
+* GET /jobs/<job_id> -> job status, patch counts, alerts, and error
+* GET /jobs/<job_id>/plan -> the job's patches as an NDJSON plan
+* DELETE /cache -> drop every entity index and sample status file cached in
+  memory
+* DELETE /cache/<study_id> -> drop one study's cached entity index
+* GET /metrics -> the service's metrics report
+"""
+
+import itertools
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from kf_update_dbgap_consent.apply import PatchApplier
+from kf_update_dbgap_consent.client import pool_size_for
+from kf_update_dbgap_consent.dbgap import SampleStatusCache
+from kf_update_dbgap_consent.defaults import (
+    DEFAULT_ENTITY_CACHE_SIZE,
+    DEFAULT_ENTITY_TTL,
+    DEFAULT_PATCH_WORKERS,
+    DEFAULT_PORT,
+    DEFAULT_SAMPLE_CACHE_SIZE,
+    DEFAULT_SCRAPE_WORKERS,
+    DEFAULT_WORKERS,
+)
+from kf_update_dbgap_consent.metrics import Metrics
+from kf_update_dbgap_consent.plan import PlanWriter
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+
+MAX_FINISHED_JOBS = 1000
+
+
+class LRUCache:
+    """
+    Thread-safe least recently used cache bounded by the total weight of its
+    values.
+
+    :param maxsize: maximum total weight
+    :param weight: function giving the weight of a value (default 1)
+    :param ttl: optional seconds after which entries expire
+    :param backing: optional slower cache with get/put (e.g. a
+        SampleStatusCache) consulted on misses and written through
+    """
+
+    def __init__(self, maxsize, weight=None, ttl=None, backing=None):
+        self.maxsize = maxsize
+        self.weight = weight or (lambda v: 1)
+        self.ttl = ttl
+        self.backing = backing
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, weight, added = entry
+                if self.ttl is None or time.monotonic() - added < self.ttl:
+                    self.entries.move_to_end(key)
+                    return value
+                self._pop(key)
+        if self.backing is not None:
+            value = self.backing.get(key)
+            if value is not None:
+                self._add(key, value)
+            return value
+        return None
+
+    def put(self, key, value):
+        self._add(key, value)
+        if self.backing is not None:
+            self.backing.put(key, value)
+
+    def _add(self, key, value):
+        weight = self.weight(value)
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            if weight > self.maxsize:
+                return
+            self.entries[key] = (value, weight, time.monotonic())
+            self.size += weight
+            while self.size > self.maxsize:
+                self._pop(next(iter(self.entries)))
+
+    def _pop(self, key):
+        _, weight, _ = self.entries.pop(key)
+        self.size -= weight
+
+    def invalidate(self, key=None):
+        """
+        Drop one key, or everything if key is None. A backing cache is left
+        alone.
+        """
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            elif key in self.entries:
+                self._pop(key)
+
+
+def entities_size(entities):
+    return (
+        len(entities.biospecimens)
+        + len(entities.genomic_files)
+        + sum(len(v) for v in entities.gf_specimens.values())
+    )
+
+
+class Job:
+    def __init__(self, job_id, study_id, match_aliquot, delta, apply):
+        self.job_id = job_id
+        self.study_id = study_id
+        self.match_aliquot = match_aliquot
+        self.delta = delta
+        self.apply = apply
+        self.status = "queued"
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.patch_counts = None
+        self.alerts = []
+        self.applied = None
+        self.error = None
+        self.plan_path = None
+
+    def report(self):
+        return {
+            "job_id": self.job_id,
+            "study_id": self.study_id,
+            "match_aliquot": self.match_aliquot,
+            "delta": self.delta,
+            "apply": self.apply,
+            "status": self.status,
+            "submitted": self.submitted,
+            "started": self.started,
+            "finished": self.finished,
+            "patch_counts": self.patch_counts,
+            "alerts": [str(a) for a in self.alerts],
+            "applied": self.applied,
+            "error": self.error,
+        }
+
+
+class ConsentService:
+    def __init__(
+        self,
+        api_url,
+        db_url=None,
+        cache_dir=None,
+        state_dir=None,
+        plan_dir=None,
+        workers=DEFAULT_WORKERS,
+        patch_workers=DEFAULT_PATCH_WORKERS,
+        sample_cache_size=DEFAULT_SAMPLE_CACHE_SIZE,
+        entity_cache_size=DEFAULT_ENTITY_CACHE_SIZE,
+        entity_ttl=DEFAULT_ENTITY_TTL,
+        pool_size=None,
+    ):
+        self.metrics = Metrics()
+        self.sample_cache = LRUCache(
+            sample_cache_size,
+            weight=len,
+            backing=SampleStatusCache(cache_dir) if cache_dir else None,
+        )
+        self.entity_cache = LRUCache(
+            entity_cache_size, weight=entities_size, ttl=entity_ttl
+        )
+        self.processor = ConsentProcessor(
+            api_url,
+            db_url,
+            state_dir=state_dir,
+            metrics=self.metrics,
+            sample_status_cache=self.sample_cache,
+            entity_cache=self.entity_cache,
+            pool_size=pool_size
+            or pool_size_for(
+                workers * (DEFAULT_SCRAPE_WORKERS + 1), patch_workers
+            ),
+        )
+        # one set of connections for jobs and the patches they apply
+        self.applier = PatchApplier(
+            api_url,
+            workers=patch_workers,
+            session=self.processor.session,
+            metrics=self.metrics,
+        )
+        self.own_plan_dir = plan_dir is None
+        self.plan_dir = plan_dir or tempfile.mkdtemp(prefix="dbgapconsent-")
+        os.makedirs(self.plan_dir, exist_ok=True)
+        self.tpex = ThreadPoolExecutor(max_workers=workers)
+        self.jobs = OrderedDict()
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        # jobs for the same study run one at a time
+        self.study_locks = {}
+
+    def submit(self, study_id, match_aliquot=False, delta=False, apply=False):
+        if delta and not self.processor.state:
+            raise ValueError("delta jobs need a service state_dir")
+        with self.lock:
+            job = Job(
+                str(next(self.job_ids)), study_id, match_aliquot, delta, apply
+            )
+            self.jobs[job.job_id] = job
+            self.study_locks.setdefault(study_id, threading.Lock())
+            self._prune()
+        self.tpex.submit(self._run, job)
+        return job
+
+    def _prune(self):
+        finished = [
+            k for k, j in self.jobs.items() if j.status in {"done", "failed"}
+        ]
+        for job_id in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            job = self.jobs.pop(job_id)
+            if job.plan_path and os.path.exists(job.plan_path):
+                os.remove(job.plan_path)
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self, limit=100):
+        with self.lock:
+            return list(self.jobs.values())[-limit:]
+
+    def _run(self, job):
+        with self.study_locks[job.study_id]:
+            job.status = "running"
+            job.started = time.time()
+            status = "failed"
+            try:
+                with self.metrics.phase("job"):
+                    self._process(job)
+                status = "done"
+            except Exception as e:
+                job.error = f"{type(e).__name__}: {e}"
+                print(f"ERROR: job {job.job_id} ({job.study_id}) failed:")
+                print(job.error)
+            finally:
+                # only kept until the state of an applied job is saved
+                self.processor.used_samples.pop(job.study_id, None)
+                job.finished = time.time()
+                job.status = status
+
+    def _process(self, job):
+        patches, alerts = self.processor.get_patches_for_study(
+            job.study_id, match_aliquot=job.match_aliquot, delta=job.delta
+        )
+        job.alerts = alerts
+        job.patch_counts = {k: len(v) for k, v in patches.items()}
+        accession = self.processor.used_samples[job.study_id][0]
+        job.plan_path = os.path.join(self.plan_dir, f"{job.job_id}.ndjson")
+        with PlanWriter(job.plan_path) as writer:
+            writer.write_study(
+                job.study_id,
+                {"patches": patches, "alerts": alerts, "error": None},
+                accession,
+                job.match_aliquot,
+            )
+        if not job.apply:
+            return
+        # cached entities no longer match the dataservice
+        self.entity_cache.invalidate(job.study_id)
+        job.applied = self.applier.apply(patches)
+        if job.applied["failed"]:
+            raise Exception(
+                f"{len(job.applied['failed'])} patches failed to apply"
+            )
+        if self.processor.state:
+            self.processor.save_state(job.study_id)
+
+    def invalidate(self, study_id=None):
+        self.entity_cache.invalidate(study_id)
+        if study_id is None:
+            self.sample_cache.invalidate()
+
+    def shutdown(self):
+        self.tpex.shutdown(wait=True)
+        if self.own_plan_dir:
+            shutil.rmtree(self.plan_dir, ignore_errors=True)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    service = None
+
+    def _send_json(self, body, status=200):
+        data = json.dumps(body, sort_keys=True).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _not_found(self):
+        self._send_json({"error": f"{self.path} not found"}, 404)
+
+    def _parts(self):
+        return [p for p in self.path.split("?", 1)[0].split("/") if p]
+
+    def do_GET(self):
+        parts = self._parts()
+        if parts == ["health"]:
+            self._send_json({"status": "ok"})
+        elif parts == ["metrics"]:
+            self._send_json(self.service.metrics.report())
+        elif parts == ["jobs"]:
+            self._send_json([j.report() for j in self.service.list_jobs()])
+        elif len(parts) in {2, 3} and parts[0] == "jobs":
+            job = self.service.get_job(parts[1])
+            if job is None:
+                self._not_found()
+            elif len(parts) == 2:
+                self._send_json(job.report())
+            elif parts[2] == "plan":
+                self._send_plan(job)
+            else:
+                self._not_found()
+        else:
+            self._not_found()
+
+    def _send_plan(self, job):
+        if job.status != "done" or not job.plan_path:
+            self._send_json({"error": f"job {job.job_id} is {job.status}"}, 409)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Content-Length", str(os.path.getsize(job.plan_path)))
+        self.end_headers()
+        with open(job.plan_path, "rb") as f:
+            shutil.copyfileobj(f, self.wfile)
+
+    def do_POST(self):
+        if self._parts() != ["jobs"]:
+            self._not_found()
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            job = self.service.submit(
+                body["study_id"],
+                match_aliquot=bool(body.get("match_aliquot")),
+                delta=bool(body.get("delta")),
+                apply=bool(body.get("apply")),
+            )
+        except (KeyError, ValueError) as e:
+            self._send_json({"error": f"Bad request: {e}"}, 400)
+            return
+        self._send_json(job.report(), 202)
+
+    def do_DELETE(self):
+        parts = self._parts()
+        if parts == ["cache"]:
+            self.service.invalidate()
+        elif len(parts) == 2 and parts[0] == "cache":
+            self.service.invalidate(parts[1])
+        else:
+            self._not_found()
+            return
+        self._send_json({"status": "ok"})
+
+
+def make_server(service, host="127.0.0.1", port=DEFAULT_PORT):
+    """
+    :returns: an HTTP server for the service. Run it with serve_forever().
+    """
+    handler = type("Handler", (_Handler,), {"service": service})
+    return _Server((host, port), handler)
@@ -0,0 +1,141 @@
+"""
+Local snapshots of the study rows the consent rules read.
+
+Loading a large study from the database reads millions of rows, and most of
+them haven't changed since the last run. A StudySnapshot keeps each study's
+projected rows (see db.STUDY_QUERIES) in an SQLite file, along with when
+they were read. db.refresh_snapshot then only reads the rows modified since
+then. Snapshots read with different queries (e.g. from an older version
+that projected fewer columns) are read again in full.
+
+Rows are stored as JSON arrays of column values. The column names are
+stored once per endpoint.
+"""
+
+import json
+import os
+import sqlite3
+from datetime import datetime
+
+from kf_update_dbgap_consent.entities import STUDY_ENDPOINTS
+
+BATCH_SIZE = 10000
+
+
+class StudySnapshot:
+    """
+    Changes are only saved by commit(). Closing the snapshot without
+    committing discards them.
+
+    :param directory: where to keep snapshots, one file per study
+    """
+
+    def __init__(self, directory, study_id):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{study_id}.sqlite")
+        self.db = sqlite3.connect(self.path)
+        self.db.executescript(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);"
+            "CREATE TABLE IF NOT EXISTS columns"
+            " (endpoint TEXT PRIMARY KEY, names TEXT);"
+            "CREATE TABLE IF NOT EXISTS rows"
+            " (endpoint TEXT, kf_id TEXT, row TEXT,"
+            " PRIMARY KEY (endpoint, kf_id)) WITHOUT ROWID;"
+        )
+        self.columns = {
+            endpoint: json.loads(names)
+            for endpoint, names in self.db.execute(
+                "SELECT endpoint, names FROM columns"
+            )
+        }
+        self.pending = []
+
+    def _meta(self, key):
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def taken_at(self, queries):
+        """
+        :param queries: the queries the rows are read with
+        :returns: when the committed rows were read, or None if there are
+            none or they were read with other queries
+        """
+        taken_at = self._meta("taken_at")
+        if taken_at is None or self._meta("queries") != queries:
+            return None
+        return datetime.fromisoformat(taken_at)
+
+    def put(self, endpoint, row):
+        """
+        Add or replace a row (a dict with a kf_id)
+        """
+        columns = self.columns.get(endpoint)
+        if columns is None:
+            columns = self.columns[endpoint] = list(row)
+            self.db.execute(
+                "INSERT INTO columns VALUES (?, ?)",
+                (endpoint, json.dumps(columns)),
+            )
+        self.pending.append(
+            (endpoint, row["kf_id"], json.dumps([row[c] for c in columns]))
+        )
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        self.db.executemany(
+            "INSERT OR REPLACE INTO rows VALUES (?, ?, ?)", self.pending
+        )
+        self.pending = []
+
+    def clear(self, endpoint):
+        self.flush()
+        self.db.execute("DELETE FROM rows WHERE endpoint = ?", (endpoint,))
+        # the next rows may have other columns
+        self.db.execute("DELETE FROM columns WHERE endpoint = ?", (endpoint,))
+        self.columns.pop(endpoint, None)
+
+    def count(self, endpoint):
+        self.flush()
+        return self.db.execute(
+            "SELECT count(*) FROM rows WHERE endpoint = ?", (endpoint,)
+        ).fetchone()[0]
+
+    def commit(self, taken_at, queries):
+        """
+        Save the changes as the study's rows at the given time, read with
+        the given queries
+        """
+        self.flush()
+        self.db.executemany(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?)",
+            [("taken_at", taken_at.isoformat()), ("queries", queries)],
+        )
+        self.db.commit()
+
+    def load(self, handle, endpoints=STUDY_ENDPOINTS):
+        """
+        :param handle: called with (endpoint, row) for every committed row
+        :returns: {endpoint: number of rows}
+        """
+        counts = {}
+        for endpoint in endpoints:
+            columns = self.columns.get(endpoint, [])
+            counts[endpoint] = 0
+            for (row,) in self.db.execute(
+                "SELECT row FROM rows WHERE endpoint = ?", (endpoint,)
+            ):
+                handle(endpoint, dict(zip(columns, json.loads(row))))
+                counts[endpoint] += 1
+        return counts
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,292 @@
+"""
+Memory-bounded evaluation of the consent rules for very large studies.
+
+ConsentProcessor.get_patches_for_study holds all of a study's entities, and
+all of its patches, in memory at once. In streaming mode (see
+ConsentProcessor.stream_patches_for_study) only the biospecimens are kept in
+memory, and only until they're reduced to a table of consent codes. Genomic
+files and link rows are spooled to a temporary SQLite file as they're
+loaded and read back in chunks of consecutive genomic file kf_ids, so peak
+memory depends on the chunk size instead of the size of the study. Patches
+and alerts are yielded as each chunk is done.
+
+Besides the biospecimen table, the only thing kept across chunks is a count
+of the hidden genomic file links of each sequencing experiment and read
+group, since those are hidden only once all of their genomic files are.
+"""
+
+import json
+import os
+import sqlite3
+import tempfile
+from collections import Counter, defaultdict
+
+from kf_update_dbgap_consent.acl_engine import AclEngine
+from kf_update_dbgap_consent.acl_export import final_acls
+from kf_update_dbgap_consent.defaults import DEFAULT_CHUNK_SIZE
+from kf_update_dbgap_consent.entities import (
+    GF_GROUP_ENDPOINTS,
+    LINK_ENDPOINTS,
+    StudyEntities,
+    _link,
+)
+
+INSERT_BATCH = 10000
+
+# link endpoint: group endpoint
+GROUP_LINK_ENDPOINTS = {
+    endpoint: child_endpoint
+    for endpoint, (_, _, child_endpoint) in LINK_ENDPOINTS.items()
+    if child_endpoint in GF_GROUP_ENDPOINTS
+}
+
+_SCHEMA = """
+PRAGMA journal_mode = OFF;
+PRAGMA synchronous = OFF;
+CREATE TABLE genomic_files (
+    kf_id TEXT PRIMARY KEY,
+    visible INTEGER,
+    controlled_access INTEGER,
+    acl TEXT,
+    latest_did TEXT
+);
+CREATE TABLE links (
+    kf_id TEXT PRIMARY KEY,
+    endpoint TEXT,
+    parent TEXT,
+    child TEXT,
+    genomic_file TEXT,
+    visible INTEGER
+);
+CREATE TABLE entities (
+    kf_id TEXT PRIMARY KEY,
+    endpoint TEXT,
+    visible INTEGER
+);
+"""
+_INSERTS = {
+    "genomic_files": (
+        "INSERT OR REPLACE INTO genomic_files VALUES (?, ?, ?, ?, ?)"
+    ),
+    "links": "INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?, ?, ?)",
+    "entities": "INSERT OR REPLACE INTO entities VALUES (?, ?, ?)",
+}
+
+
+def _bool(value):
+    return None if value is None else bool(value)
+
+
+class EntitySpool:
+    """
+    A study's biospecimens, in memory, and its genomic files, link rows,
+    and other entities, in a temporary SQLite file.
+
+    Add entities with add() from a single thread at a time, then call
+    finish() before reading them back.
+    """
+
+    def __init__(self, directory=None):
+        fd, self.path = tempfile.mkstemp(
+            prefix="dbgapconsent-", suffix=".sqlite", dir=directory
+        )
+        os.close(fd)
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.executescript(_SCHEMA)
+        self.biospecimens = StudyEntities()
+        self.pending = defaultdict(list)
+        self.counts = Counter()
+
+    def add(self, endpoint, e):
+        """
+        Add an API entity or database row from the given endpoint
+        """
+        self.counts[endpoint] += 1
+        if endpoint == "biospecimens":
+            self.biospecimens.add(endpoint, e)
+            return
+        if endpoint == "genomic-files":
+            acl = e.get("acl")
+            row = (
+                e["kf_id"],
+                e["visible"],
+                e.get("controlled_access"),
+                None if acl is None else json.dumps(acl),
+                e.get("latest_did"),
+            )
+            self._insert("genomic_files", row)
+        elif endpoint in LINK_ENDPOINTS:
+            parent_field, child_field, child_endpoint = LINK_ENDPOINTS[endpoint]
+            parent, child = _link(e, parent_field), _link(e, child_field)
+            if child_endpoint == "genomic-files":
+                gfid = child
+            elif parent_field == "genomic_file":
+                gfid = parent
+            else:
+                gfid = None
+            row = (e["kf_id"], endpoint, parent, child, gfid, e["visible"])
+            self._insert("links", row)
+        else:
+            self._insert("entities", (e["kf_id"], endpoint, e["visible"]))
+
+    def _insert(self, table, row):
+        rows = self.pending[table]
+        rows.append(row)
+        if len(rows) >= INSERT_BATCH:
+            self._flush(table)
+
+    def _flush(self, table):
+        self.db.executemany(_INSERTS[table], self.pending.pop(table))
+
+    def finish(self):
+        for table in list(self.pending):
+            self._flush(table)
+        self.db.execute("CREATE INDEX links_gf ON links (genomic_file)")
+        self.db.execute("CREATE INDEX links_endpoint ON links (endpoint)")
+        self.db.commit()
+
+    def gf_chunks(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Read the genomic files back in kf_id order.
+
+        :yields: StudyEntities holding up to chunk_size consecutive genomic
+            files and all of their links
+        """
+        last = ""
+        while True:
+            rows = self.db.execute(
+                "SELECT kf_id, visible, controlled_access, acl, latest_did"
+                " FROM genomic_files WHERE kf_id > ? ORDER BY kf_id LIMIT ?",
+                (last, chunk_size),
+            ).fetchall()
+            if not rows:
+                return
+            chunk = StudyEntities()
+            for kfid, visible, controlled_access, acl, latest_did in rows:
+                chunk.add(
+                    "genomic-files",
+                    {
+                        "kf_id": kfid,
+                        "visible": _bool(visible),
+                        "controlled_access": _bool(controlled_access),
+                        "acl": None if acl is None else json.loads(acl),
+                        "latest_did": latest_did,
+                    },
+                )
+            first, last = rows[0][0], rows[-1][0]
+            for kfid, endpoint, parent, child, visible in self.db.execute(
+                "SELECT kf_id, endpoint, parent, child, visible FROM links"
+                " WHERE genomic_file BETWEEN ? AND ?",
+                (first, last),
+            ):
+                chunk.add_link(endpoint, kfid, parent, child)
+                if not visible:
+                    chunk.hidden[endpoint].add(kfid)
+            yield chunk
+
+    def links(self, endpoint):
+        """
+        :yields: (kf_id, parent, child, visible) for every link of the given
+            endpoint
+        """
+        for kfid, parent, child, visible in self.db.execute(
+            "SELECT kf_id, parent, child, visible FROM links"
+            " WHERE endpoint = ?",
+            (endpoint,),
+        ):
+            yield kfid, parent, child, _bool(visible)
+
+    def group_sizes(self, endpoint):
+        """
+        :yields: (group kf_id, number of genomic file links, whether the
+            group is visible or None if it wasn't loaded) for the groups of
+            a genomic file group link endpoint. Groups with a null visible
+            aren't visible, as in StudyEntities.
+        """
+        for child, size, loaded, visible in self.db.execute(
+            "SELECT l.child, count(*), e.kf_id IS NOT NULL, e.visible"
+            " FROM links l LEFT JOIN entities e ON e.kf_id = l.child"
+            " WHERE l.endpoint = ? GROUP BY l.child",
+            (endpoint,),
+        ):
+            yield child, size, bool(visible) if loaded else None
+
+    def close(self):
+        self.db.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def chunked_rules(
+    study_id,
+    study_phs,
+    spool,
+    specimen_codes,
+    hidden_specimens,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    decisions=None,
+    acls=None,
+):
+    """
+    Apply the hidden descendant and genomic file ACL rules (see
+    sample_status) to the spooled genomic files a chunk at a time.
+
+    :param specimen_codes: {biospecimen kf_id: dbgap_consent_code}
+    :param hidden_specimens: biospecimens that are or will be hidden
+    :param decisions: optional list to add the decision rows of each chunk's
+        genomic files to before the chunk is yielded
+    :param acls: optional list to add the (kf_id, latest_did, final ACL) of
+        each chunk's genomic files to, in the same way
+    :yields: (patches, alerts) with no-op patches removed, for each chunk
+        of genomic files and then for sequencing experiments and read groups
+    """
+    engine = AclEngine(study_id, study_phs, specimen_codes, hidden_specimens)
+    hidden_group_links = defaultdict(Counter)
+    for chunk in spool.gf_chunks(chunk_size):
+        patches = defaultdict(lambda: defaultdict(dict))
+        alerts = []
+        for gfid, bs_links in chunk.gf_specimens.items():
+            hidden_links = [
+                link_kfid
+                for bsid, link_kfid in bs_links.items()
+                if bsid in hidden_specimens
+            ]
+            if not hidden_links:
+                continue
+            patches["genomic-files"][gfid]["visible"] = False
+            for link_kfid in hidden_links:
+                patches["biospecimen-genomic-files"][link_kfid][
+                    "visible"
+                ] = False
+            for endpoint, group_endpoint in GROUP_LINK_ENDPOINTS.items():
+                for link_kfid, group in (
+                    chunk.links[endpoint].get(gfid, {}).items()
+                ):
+                    patches[endpoint][link_kfid]["visible"] = False
+                    hidden_group_links[group_endpoint][group] += 1
+        engine.evaluate(
+            chunk, chunk.gf_specimens.keys(), patches, alerts, decisions
+        )
+        if acls is not None:
+            acls.extend(
+                final_acls(chunk.genomic_files, patches["genomic-files"])
+            )
+        patches = chunk.remove_noop_patches(patches)
+        if patches or alerts:
+            yield patches, alerts
+
+    # groups are hidden once all of their genomic files are
+    patches = defaultdict(dict)
+    for endpoint, group_endpoint in GROUP_LINK_ENDPOINTS.items():
+        hidden_links = hidden_group_links.pop(group_endpoint, {})
+        for group, size, visible in spool.group_sizes(endpoint):
+            if hidden_links.get(group) == size and visible is not False:
+                patches[group_endpoint][group] = {"visible": False}
+    if patches:
+        yield dict(patches), []
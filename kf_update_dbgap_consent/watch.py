@@ -0,0 +1,181 @@
+"""
+Watch dbGaP for new sample status releases.
+
+Checking a study is cheap: one dataservice study lookup and one conditional
+request for the header of the newest sample status version, only walking
+back to older versions when the newest one has changed and isn't released.
+A consent run is queued only when the latest released version differs from
+the version recorded on the dataservice study, and not again for the same
+release until retrigger_after has passed (in case that run failed).
+
+What's known about each study is kept between polls in a small JSON state
+file. Checks are spread out with jitter, and studies whose checks fail back
+off exponentially.
+"""
+
+import json
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from kf_update_dbgap_consent.dbgap import find_latest_release
+from kf_update_dbgap_consent.defaults import DEFAULT_INTERVAL
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+
+DEFAULT_BACKOFF = 60
+MAX_BACKOFF = 24 * 3600
+RETRIGGER_AFTER = 24 * 3600
+DEFAULT_WATCH_WORKERS = 8
+
+
+class WatchState:
+    """
+    {study_id: {...}} persisted as JSON
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as f:
+                self.studies = json.load(f)
+        except FileNotFoundError:
+            self.studies = {}
+
+    def study(self, study_id):
+        return self.studies.setdefault(study_id, {})
+
+    def save(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.studies, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+class ReleaseWatcher:
+    """
+    :param trigger: called with (study_id, released accession) to queue a
+        consent run
+    """
+
+    def __init__(
+        self,
+        api_url,
+        state_path,
+        trigger,
+        interval=DEFAULT_INTERVAL,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=MAX_BACKOFF,
+        retrigger_after=RETRIGGER_AFTER,
+        dbgap_status="released",
+        workers=DEFAULT_WATCH_WORKERS,
+        processor=None,
+        rand=None,
+    ):
+        self.processor = processor or ConsentProcessor(api_url)
+        self.session = self.processor.session
+        self.state = WatchState(state_path)
+        self.trigger = trigger
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retrigger_after = retrigger_after
+        self.dbgap_status = dbgap_status
+        self.workers = workers
+        self.rand = rand or random.Random()
+
+    def check(self, study_id, now=None):
+        """
+        Check one study now and queue a run for it if needed.
+
+        :returns: whether a run was queued
+        """
+        now = time.time() if now is None else now
+        s = self.state.study(study_id)
+        phs, version = self.processor.get_accession(study_id, ttl=0)
+        if s.get("phs") != phs:
+            s.clear()
+            s["phs"] = phs
+        s["dataservice_version"] = version
+
+        found = find_latest_release(
+            phs, self.dbgap_status, self.session, s.get("validators")
+        )
+        if found is not None:
+            s["latest"] = found["latest"]
+            s["released"] = found["released"]
+            s["validators"] = {
+                "etag": found["etag"],
+                "last_modified": found["last_modified"],
+            }
+
+        released = s.get("released")
+        if not released or released.split(".", 1)[1] == version:
+            s.pop("triggered", None)
+            s.pop("triggered_at", None)
+            return False
+        if (
+            s.get("triggered") == released
+            and now - s["triggered_at"] < self.retrigger_after
+        ):
+            return False
+        print(
+            f"{study_id}: dbGaP has released {released}, dataservice has"
+            f" {version}"
+        )
+        self.trigger(study_id, released)
+        s["triggered"] = released
+        s["triggered_at"] = now
+        return True
+
+    def _check_due(self, study_id, now):
+        s = self.state.study(study_id)
+        try:
+            triggered = self.check(study_id, now)
+            s["failures"] = 0
+            delay = self.interval * self.rand.uniform(0.9, 1.1)
+        except Exception as e:
+            triggered = False
+            s["failures"] = s.get("failures", 0) + 1
+            s["error"] = f"{type(e).__name__}: {e}"
+            print(f"ERROR: checking {study_id} failed: {s['error']}")
+            delay = min(
+                self.max_backoff, self.backoff * 2 ** (s["failures"] - 1)
+            )
+            delay *= self.rand.uniform(0.5, 1.0)
+        else:
+            s.pop("error", None)
+        s["next_check"] = now + delay
+        return triggered
+
+    def poll(self, study_ids, now=None):
+        """
+        Check the given studies that are due for a check.
+
+        :returns: the studies that runs were queued for
+        """
+        now = time.time() if now is None else now
+        due = [
+            k
+            for k in study_ids
+            if self.state.study(k).get("next_check", 0) <= now
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as tpex:
+            triggered = [
+                k
+                for k, t in zip(
+                    due, tpex.map(lambda k: self._check_due(k, now), due)
+                )
+                if t
+            ]
+        self.state.save()
+        return triggered
+
+    def next_due(self, study_ids):
+        """
+        :returns: when the next of the given studies is due for a check
+        """
+        return min(
+            (self.state.study(k).get("next_check", 0) for k in study_ids),
+            default=time.time() + self.interval,
+        )
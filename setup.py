@@ -26,8 +26,14 @@ setup(
     entry_points={
         "console_scripts": [
             "dbgapconsent=kf_update_dbgap_consent.app.cli:cli",
+            "dbgapconsent-plan=kf_update_dbgap_consent.app.cli:plan_cli",
+            "dbgapconsent-apply=kf_update_dbgap_consent.app.cli:apply_cli",
+            "dbgapconsent-explain=kf_update_dbgap_consent.app.cli:explain_cli",
+            "dbgapconsent-merge-acls=kf_update_dbgap_consent.app.cli:merge_acls_cli",
+            "dbgapconsent-service=kf_update_dbgap_consent.app.cli:service_cli",
+            "dbgapconsent-watch=kf_update_dbgap_consent.app.cli:watch_cli",
         ],
     },
-    python_requires=">=3.6, <4",
+    python_requires=">=3.7, <4",
     install_requires=requirements,
 )
@@ -0,0 +1,118 @@
+"""
+In-process stand-ins for the dataservice API and the dbGaP sample status
+endpoint, serving a SyntheticStudy through requests_mock.
+"""
+
+import re
+from bisect import bisect_right
+from collections import Counter
+from datetime import datetime, timezone
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+from requests_mock import ANY
+
+from kf_update_dbgap_consent.dbgap import DBGAP_SAMPLE_STATUS_URL
+
+HOST = "http://dataservice.fake"
+MAX_LIMIT = 100
+
+LINKED_ENDPOINTS = {
+    "study": "studies",
+    "participant": "participants",
+    "biospecimen": "biospecimens",
+    "diagnosis": "diagnoses",
+    "genomic_file": "genomic-files",
+    "sequencing_experiment": "sequencing-experiments",
+    "read_group": "read-groups",
+}
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+class FakeServices:
+    def __init__(self, study, host=HOST, burst=1):
+        """
+        :param burst: how many entities are created at the same time
+        """
+        self.study = study
+        self.host = host
+        self.entities = study.entities
+        self.xml = study.sample_status_xml()
+        self.requests = Counter()
+
+        # entities are "created" in bursts one second apart, in generation
+        # order
+        self.kfids = {}
+        self.positions = {}
+        self.created = {}
+        ts = 1500000000.0
+        for endpoint, entities in self.entities.items():
+            self.kfids[endpoint] = list(entities)
+            self.positions[endpoint] = {k: i for i, k in enumerate(entities)}
+            self.created[endpoint] = [
+                ts + i // burst for i in range(len(entities))
+            ]
+            ts += len(entities) // burst + 1
+
+    def install(self, mocker):
+        mocker.get(DBGAP_SAMPLE_STATUS_URL, content=self._sample_status)
+        mocker.register_uri(
+            ANY, re.compile(rf"^{re.escape(self.host)}/"), json=self._handle
+        )
+
+    def _sample_status(self, request, context):
+        self.requests["dbgap"] += 1
+        return self.xml
+
+    def _render(self, endpoint, kfid, index=None):
+        if index is None:
+            index = self.positions[endpoint][kfid]
+        e = {"kf_id": kfid, "_links": {"self": f"/{endpoint}/{kfid}"}}
+        for k, v in self.entities[endpoint][kfid].items():
+            if k.endswith("_id") and k[:-3] in LINKED_ENDPOINTS:
+                e["_links"][k[:-3]] = f"/{LINKED_ENDPOINTS[k[:-3]]}/{v}"
+            else:
+                e[k] = v
+        created = _iso(self.created[endpoint][index])
+        e["created_at"] = e["modified_at"] = created
+        return e
+
+    def _handle(self, request, context):
+        url = urlparse(request.url)
+        parts = url.path.strip("/").split("/")
+        endpoint = parts[0]
+        self.requests[f"{request.method} {endpoint}"] += 1
+        if len(parts) == 2:
+            kfid = parts[1]
+            if kfid not in self.entities.get(endpoint, {}):
+                context.status_code = 404
+                return {"_status": {"code": 404}}
+            if request.method == "PATCH":
+                self.entities[endpoint][kfid].update(request.json())
+            elif request.method != "GET":
+                context.status_code = 405
+                return {"_status": {"code": 405}}
+            return {"results": self._render(endpoint, kfid)}
+
+        query = dict(parse_qsl(url.query))
+        limit = min(int(query.get("limit", 10)), MAX_LIMIT)
+        after = float(query.get("after", 0))
+        study_id = query.get("study_id", self.study.study_id)
+        if study_id == self.study.study_id and endpoint in self.kfids:
+            kfids, created = self.kfids[endpoint], self.created[endpoint]
+        else:
+            kfids, created = [], []
+        start = bisect_right(created, after)
+        page = range(start, min(start + limit, len(kfids)))
+        body = {
+            "results": [self._render(endpoint, kfids[i], i) for i in page],
+            "total": len(kfids),
+            "limit": limit,
+            "_links": {"self": f"/{endpoint}?{url.query}"},
+        }
+        if page and page[-1] + 1 < len(kfids):
+            query["after"] = created[page[-1]]
+            body["_links"]["next"] = f"/{endpoint}?{urlencode(query)}"
+        return body
@@ -0,0 +1,184 @@
+"""
+End-to-end benchmarks of ConsentProcessor against synthetic studies served
+by in-process fakes of the dataservice and dbGaP.
+
+Each phase of a run is timed separately:
+
+* fetch: study lookup and dbGaP sample status download/parse
+* scrape: loading the study's entities from the dataservice
+* rules: evaluating the consent rules
+* diffing: removing patches that wouldn't change anything
+* apply: sending the patches to the dataservice
+
+It also checks that importing the command line tools stays within
+IMPORT_BUDGET_US.
+
+Usage:
+
+    python -m tests.benchmarks.run_benchmarks --sizes 1k,100k,1M
+    python -m tests.benchmarks.run_benchmarks --save_baseline
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+
+import requests_mock
+
+from kf_update_dbgap_consent.apply import PatchApplier
+from kf_update_dbgap_consent.metrics import Metrics
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+SIZES = {"1k": 1000, "100k": 100000, "1M": 1000000}
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+# Slower than baseline by this factor (and by more than MIN_REGRESSION
+# seconds) counts as a regression
+TOLERANCE = 1.5
+MIN_REGRESSION = 0.1
+# Cumulative microseconds to import the CLI module, as reported by
+# python -X importtime. It takes ~25ms on a laptop, and importing the HTTP
+# client alone (requests) adds ~100ms.
+IMPORT_BUDGET_US = 100000
+
+
+# benchmark phase: processor metrics phases
+PHASES = {
+    "fetch": ["lookup_study", "fetch_sample_status"],
+    "scrape": ["load_entities"],
+    "rules": ["rules"],
+    "diffing": ["diffing"],
+    "apply": ["apply"],
+}
+
+
+def run_benchmark(n_genomic_files, apply=True, **study_kwargs):
+    """
+    Run and time a full consent update of a synthetic study.
+
+    :returns: ({phase: seconds}, patches, alerts)
+    """
+    study = SyntheticStudy(n_genomic_files=n_genomic_files, **study_kwargs)
+    services = FakeServices(study)
+    metrics = Metrics()
+    with requests_mock.Mocker() as mocker, contextlib.redirect_stdout(
+        io.StringIO()
+    ):
+        services.install(mocker)
+        processor = ConsentProcessor(services.host, metrics=metrics)
+        patches, alerts = processor.get_patches_for_study(study.study_id)
+        if apply:
+            PatchApplier(services.host, metrics=metrics).apply(patches)
+    phases = metrics.report()["phases"]
+    timings = {
+        name: sum(phases[p]["wall"] for p in parts)
+        for name, parts in PHASES.items()
+        if any(p in phases for p in parts)
+    }
+    return timings, patches, alerts
+
+
+def cli_import_time(runs=3):
+    """
+    Time importing the command line tools in a fresh interpreter.
+
+    :returns: the best cumulative import time of a few runs in microseconds,
+        since the first may compile bytecode
+    """
+    times = []
+    for _ in range(runs):
+        out = subprocess.run(
+            [
+                sys.executable,
+                "-X",
+                "importtime",
+                "-c",
+                "import kf_update_dbgap_consent.app.cli",
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stderr
+        for line in out.splitlines():
+            if line.endswith("| kf_update_dbgap_consent.app.cli"):
+                times.append(int(line.split("|")[1]))
+    return min(times)
+
+
+def find_regressions(results, baseline):
+    regressions = []
+    for size, timings in results.items():
+        for phase, seconds in timings.items():
+            before = baseline.get(size, {}).get(phase)
+            if before is None:
+                continue
+            if seconds > before * TOLERANCE and seconds - before > (
+                MIN_REGRESSION
+            ):
+                regressions.append(
+                    f"{size} {phase}: {seconds:.3f}s vs baseline {before:.3f}s"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        default=",".join(SIZES),
+        help=f"Comma-separated numbers of genomic files, from {list(SIZES)}",
+    )
+    parser.add_argument(
+        "--no_apply",
+        action="store_true",
+        default=False,
+        help="Skip timing the apply phase",
+    )
+    parser.add_argument(
+        "--save_baseline",
+        action="store_true",
+        default=False,
+        help=f"Save results as the new baseline in {BASELINE_PATH}",
+    )
+    args = parser.parse_args()
+
+    import_time = cli_import_time()
+    print(f"CLI import: {import_time / 1000:.1f}ms")
+    if import_time > IMPORT_BUDGET_US:
+        sys.exit(
+            f"Importing the CLI took {import_time / 1000:.1f}ms,"
+            f" over the {IMPORT_BUDGET_US / 1000:.0f}ms budget"
+        )
+
+    results = {}
+    for size in args.sizes.split(","):
+        timings, patches, alerts = run_benchmark(
+            SIZES[size], apply=not args.no_apply
+        )
+        results[size] = {k: round(v, 4) for k, v in timings.items()}
+        print(f"{size}: {json.dumps(results[size])}")
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(BASELINE_PATH):
+            with open(BASELINE_PATH) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        return
+
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            regressions = find_regressions(results, json.load(f))
+        if regressions:
+            sys.exit("Regressions:\n" + "\n".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""
+Generator of synthetic studies: a dbGaP sample status file together with
+matching dataservice entities.
+"""
+
+import random
+from collections import defaultdict
+from xml.sax.saxutils import quoteattr
+
+STUDY_ID = "SD_00000000"
+STUDY_PHS = "phs999999"
+ACCESSION = f"{STUDY_PHS}.v1.p1"
+CONSENT_NAMES = {"1": "GRU", "2": "HMB", "3": "DS-CA", "4": "HMB-NPU"}
+
+
+def _kfid(prefix, i):
+    return f"{prefix}_{i:08d}"
+
+
+class SyntheticStudy:
+    """
+    A randomly generated study.
+
+    :param n_genomic_files: number of genomic files
+    :param gfs_per_specimen: average genomic files per biospecimen
+    :param multi_specimen_fraction: fraction of GFs with contributions from
+        more than one biospecimen
+    :param hidden_fraction: fraction of biospecimens and GFs already hidden
+    :param unmatched_fraction: fraction of biospecimens with no dbGaP sample
+    :param missing_samples: number of dbGaP samples with no biospecimen
+    :param consent_mix: {consent code: weight}
+    :param open_fraction: fraction of GFs with controlled_access=False
+    :param null_access_fraction: fraction of GFs with controlled_access=null
+    """
+
+    def __init__(
+        self,
+        n_genomic_files=1000,
+        gfs_per_specimen=4,
+        multi_specimen_fraction=0.05,
+        hidden_fraction=0.02,
+        unmatched_fraction=0.02,
+        missing_samples=10,
+        consent_mix=None,
+        open_fraction=0.1,
+        null_access_fraction=0.001,
+        seed=0,
+    ):
+        rand = random.Random(seed)
+        consent_mix = consent_mix or {"1": 6, "2": 3, "3": 1}
+        codes, weights = zip(*consent_mix.items())
+
+        self.study_id = STUDY_ID
+        self.accession = ACCESSION
+        self.entities = defaultdict(dict)
+        self.samples = []
+
+        self.entities["studies"][STUDY_ID] = {
+            "external_id": STUDY_PHS,
+            "data_access_authority": "dbGaP",
+            "version": None,
+        }
+        n_specimens = max(1, n_genomic_files // gfs_per_specimen)
+        n_participants = max(1, n_specimens // 2)
+        for i in range(n_participants):
+            self.entities["participants"][_kfid("PT", i)] = {
+                "study_id": STUDY_ID,
+                "visible": True,
+            }
+
+        for i in range(n_specimens):
+            sample_id = f"sample_{i}"
+            code = rand.choices(codes, weights)[0]
+            if rand.random() >= unmatched_fraction:
+                status = "Loaded" if rand.random() > 0.01 else "Withdrawn"
+                self.samples.append(
+                    (sample_id, status, code, CONSENT_NAMES.get(code, "X"))
+                )
+            self.entities["biospecimens"][_kfid("BS", i)] = {
+                "participant_id": _kfid("PT", i % n_participants),
+                "external_sample_id": sample_id,
+                "external_aliquot_id": f"aliquot_{i}",
+                "visible": rand.random() >= hidden_fraction,
+                "consent_type": None,
+                "dbgap_consent_code": None,
+            }
+        for i in range(missing_samples):
+            self.samples.append((f"missing_{i}", "Loaded", codes[0], "GRU"))
+
+        n_links = 0
+        for i in range(n_genomic_files):
+            gfid = _kfid("GF", i)
+            r = rand.random()
+            if r < null_access_fraction:
+                controlled_access = None
+            elif r < null_access_fraction + open_fraction:
+                controlled_access = False
+            else:
+                controlled_access = True
+            self.entities["genomic-files"][gfid] = {
+                "controlled_access": controlled_access,
+                "visible": rand.random() >= hidden_fraction,
+                "acl": [],
+                "latest_did": f"did-{i}",
+            }
+            specimens = {i * n_specimens // n_genomic_files}
+            if rand.random() < multi_specimen_fraction:
+                specimens.update(rand.sample(range(n_specimens), 2))
+            for bs in specimens:
+                self.entities["biospecimen-genomic-files"][
+                    _kfid("BG", n_links)
+                ] = {
+                    "biospecimen_id": _kfid("BS", bs),
+                    "genomic_file_id": gfid,
+                    "visible": True,
+                }
+                n_links += 1
+            # every 10 GFs share a sequencing experiment
+            seid = _kfid("SE", i // 10)
+            self.entities["sequencing-experiments"][seid] = {"visible": True}
+            self.entities["sequencing-experiment-genomic-files"][
+                _kfid("SG", i)
+            ] = {
+                "sequencing_experiment_id": seid,
+                "genomic_file_id": gfid,
+                "visible": True,
+            }
+
+    def sample_status_xml(self):
+        """
+        :returns: dbGaP sample status XML for the study as bytes
+        """
+        lines = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            "<DbGap>",
+            f'<Study accession="{self.accession}" study_handle="SYNTHETIC"'
+            ' registration_status="released">',
+            "<SampleList>",
+        ]
+        for sample_id, status, code, name in self.samples:
+            lines.append(
+                f"<Sample submitted_sample_id={quoteattr(sample_id)}"
+                f' consent_code="{code}" consent_short_name="{name}"'
+                f' dbgap_status="{status}">'
+                "<Aliases></Aliases><Uses></Uses><SRAData></SRAData>"
+                "</Sample>"
+            )
+        lines += ["</SampleList>", "</Study>", "</DbGap>", ""]
+        return "\n".join(lines).encode("utf-8")
@@ -0,0 +1,28 @@
+from tests.benchmarks.run_benchmarks import (
+    cli_import_time,
+    find_regressions,
+    run_benchmark,
+)
+
+
+def test_run_benchmark():
+    timings, patches, alerts = run_benchmark(1000, missing_samples=10)
+    assert set(timings) == {"fetch", "scrape", "rules", "diffing", "apply"}
+    assert len(patches["biospecimens"]) == 250
+    assert len(patches["genomic-files"]) > 900
+    assert sum("not found in dataservice" in str(a) for a in alerts) == 10
+
+
+def test_find_regressions():
+    baseline = {"1k": {"rules": 1.0, "scrape": 0.01}}
+    assert (
+        find_regressions({"1k": {"rules": 1.2, "scrape": 0.09}}, baseline) == []
+    )
+    assert find_regressions({"1k": {"rules": 2.0}}, baseline) == [
+        "1k rules: 2.000s vs baseline 1.000s"
+    ]
+
+
+def test_cli_import_time():
+    # only the measurement, the budget is checked by run_benchmarks
+    assert cli_import_time(runs=1) > 0
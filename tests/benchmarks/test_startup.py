@@ -0,0 +1,53 @@
+import json
+import subprocess
+import sys
+
+import pytest
+
+# The import time budget is checked by run_benchmarks, since wall clock
+# limits are flaky on shared CI runners. This only checks what is imported.
+HEAVY_MODULES = [
+    "requests",
+    "urllib3",
+    "psycopg2",
+    "kf_utils",
+    "d3b_utils",
+    "xml.etree.ElementTree",
+    "sqlite3",
+]
+COMMANDS = [
+    "cli",
+    "plan_cli",
+    "apply_cli",
+    "explain_cli",
+    "merge_acls_cli",
+    "service_cli",
+    "watch_cli",
+]
+
+_HELP = """
+import json, sys
+sys.argv = ["{command}", "--help"]
+from kf_update_dbgap_consent.app import cli
+try:
+    cli.{command}()
+except SystemExit:
+    pass
+print(json.dumps([m for m in {heavy} if m in sys.modules]))
+"""
+
+
+@pytest.mark.parametrize("command", COMMANDS)
+def test_help_loads_nothing_heavy(command):
+    out = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            _HELP.format(command=command, heavy=HEAVY_MODULES),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert "usage:" in out
+    assert json.loads(out.splitlines()[-1]) == []
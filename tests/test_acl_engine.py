@@ -0,0 +1,123 @@
+import contextlib
+import io
+import random
+from collections import defaultdict
+
+import pytest
+
+from kf_update_dbgap_consent.acl_engine import AclEngine
+from kf_update_dbgap_consent.dbgap import Sample
+from kf_update_dbgap_consent.entities import STUDY_ENDPOINTS, StudyEntities
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.benchmarks.synthetic import STUDY_PHS, SyntheticStudy
+
+STUDIES = [
+    {},
+    {"multi_specimen_fraction": 0.5, "hidden_fraction": 0.2},
+    {
+        "consent_mix": {str(c): 1 for c in range(1, 80)},
+        "multi_specimen_fraction": 0.3,
+        "null_access_fraction": 0.1,
+        "unmatched_fraction": 0.2,
+    },
+    {"gfs_per_specimen": 1, "open_fraction": 0.5, "hidden_fraction": 0.5},
+]
+
+
+def load(study):
+    entities = StudyEntities()
+    for endpoint in STUDY_ENDPOINTS:
+        for kfid, e in study.entities.get(endpoint, {}).items():
+            entities.add(endpoint, dict(e, kf_id=kfid))
+    samples = {
+        sample_id: Sample(status, code, name)
+        for sample_id, status, code, name in study.samples
+    }
+    return entities, samples
+
+
+def evaluate(study, entities, samples, changed_samples, reference):
+    processor = ConsentProcessor("http://dataservice.fake")
+    with contextlib.redirect_stdout(io.StringIO()):
+        patches, alerts = processor.evaluate_rules(
+            study.study_id,
+            STUDY_PHS,
+            samples,
+            entities,
+            changed_samples=changed_samples,
+            reference=reference,
+        )
+    return entities.remove_noop_patches(patches), alerts
+
+
+@pytest.mark.parametrize("seed", range(3))
+@pytest.mark.parametrize("study_kwargs", STUDIES)
+def test_batched_acls_match_reference(study_kwargs, seed):
+    study = SyntheticStudy(n_genomic_files=3000, seed=seed, **study_kwargs)
+    entities, samples = load(study)
+    # some genomic files already have the ACL they should get
+    for gf in list(entities.genomic_files.values())[::3]:
+        gf.acl = (study.study_id, f"{STUDY_PHS}.c999")
+
+    changed = set(random.Random(seed).sample(sorted(samples), 50))
+    for changed_samples in [None, changed]:
+        reference = evaluate(study, entities, samples, changed_samples, True)
+        batched = evaluate(study, entities, samples, changed_samples, False)
+        assert batched == reference
+
+
+@pytest.mark.parametrize("study_kwargs", STUDIES)
+def test_facts_match_entities(study_kwargs):
+    study = SyntheticStudy(n_genomic_files=3000, seed=1, **study_kwargs)
+    entities, samples = load(study)
+    for gf in list(entities.genomic_files.values())[::3]:
+        gf.acl = (study.study_id, f"{STUDY_PHS}.c999")
+    processor = ConsentProcessor("http://dataservice.fake")
+    specimen_codes, hidden, _, _ = processor.specimen_rules(
+        STUDY_PHS,
+        samples,
+        entities.biospecimens,
+        "external_sample_id",
+        None,
+        defaultdict(lambda: defaultdict(dict)),
+        [],
+    )
+
+    results = []
+    for use_facts in [False, True]:
+        patches = defaultdict(lambda: defaultdict(dict))
+        alerts = []
+        decisions = []
+        if use_facts:
+            # what db_rules reads for each genomic file
+            rows = []
+            for gfid, bs_links in sorted(entities.gf_specimens.items()):
+                gf = entities.genomic_files[gfid]
+                rows.append(
+                    (
+                        gfid,
+                        gf.visible,
+                        gf.controlled_access,
+                        None if gf.acl is None else list(gf.acl),
+                        min((k for k in bs_links if k in hidden), default=None),
+                        list({specimen_codes[k] for k in bs_links}),
+                    )
+                )
+            engine = AclEngine(study.study_id, STUDY_PHS, {}, set())
+            assert engine.evaluate_facts(
+                rows, patches, alerts, decisions
+            ) == len(rows)
+        else:
+            engine = AclEngine(
+                study.study_id, STUDY_PHS, specimen_codes, hidden
+            )
+            engine.evaluate(
+                entities,
+                sorted(entities.gf_specimens),
+                patches,
+                alerts,
+                decisions,
+            )
+        results.append((patches, alerts, decisions))
+    assert results[0] == results[1]
+    assert results[0][0]["genomic-files"]
@@ -0,0 +1,118 @@
+import contextlib
+import io
+import json
+import os
+
+import pytest
+
+from kf_update_dbgap_consent.acl_export import (
+    AclExport,
+    merge_exports,
+    write_export,
+)
+from kf_update_dbgap_consent.plan import open_plan
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+
+def read_export(path):
+    with open_plan(path) as f:
+        records = [json.loads(line) for line in f]
+    acls = {r["id"]: r["acl"] for r in records if r["type"] == "acl"}
+    gfs = [r for r in records if r["type"] == "gf"]
+    # the ACL table comes first
+    assert records[: len(acls)] == [r for r in records if r["type"] == "acl"]
+    return acls, gfs
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_export_every_genomic_file(requests_mock, tmp_path, stream):
+    study = SyntheticStudy(
+        n_genomic_files=1000, hidden_fraction=0.2, null_access_fraction=0.1
+    )
+    services = FakeServices(study)
+    services.install(requests_mock)
+    processor = ConsentProcessor(services.host)
+    path = str(tmp_path / "acls.ndjson.gz")
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        with AclExport(path) as export:
+            processor.acl_export = export
+            if stream:
+                chunks = processor.stream_patches_for_study(
+                    study.study_id, chunk_size=300, spool_dir=str(tmp_path)
+                )
+                patches = {"genomic-files": {}}
+                for chunk, _ in chunks:
+                    patches["genomic-files"].update(
+                        chunk.get("genomic-files", {})
+                    )
+            else:
+                patches, _ = processor.get_patches_for_study(study.study_id)
+
+    acls, gfs = read_export(path)
+    genomic_files = study.entities["genomic-files"]
+    assert [r["kf_id"] for r in gfs] == sorted(genomic_files)
+    assert len(acls) < len(gfs)
+    for r in gfs:
+        gf = genomic_files[r["kf_id"]]
+        patch = patches["genomic-files"].get(r["kf_id"], {})
+        acl = patch["acl"] if "acl" in patch else gf["acl"]
+        assert r["study_id"] == study.study_id
+        assert r["latest_did"] == gf["latest_did"]
+        if acl is None:
+            assert r["acl"] is None
+        else:
+            assert acls[r["acl"]] == sorted(acl)
+    # the temporary runs are removed
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["acls.ndjson.gz"]
+
+
+def test_merge_exports(tmp_path):
+    a, b, merged = (str(tmp_path / n) for n in ["a", "b", "merged.gz"])
+    write_export(
+        a,
+        "SD_1",
+        [("GF_3", "did-3", ["SD_1", "phs1.c1"]), ("GF_1", "did-1", None)],
+    )
+    write_export(
+        b,
+        "SD_2",
+        [
+            ("GF_2", "did-2", ["*"]),
+            ("GF_1", "did-1", ["*"]),
+            ("GF_4", None, ["phs1.c1", "SD_1"]),
+        ],
+    )
+
+    assert merge_exports([a, b], merged) == (4, 1)
+    acls, gfs = read_export(merged)
+    assert acls == {0: ["*"], 1: ["SD_1", "phs1.c1"]}
+    assert [(r["kf_id"], r["study_id"], r["acl"]) for r in gfs] == [
+        ("GF_1", "SD_1", None),
+        ("GF_2", "SD_2", 0),
+        ("GF_3", "SD_1", 1),
+        ("GF_4", "SD_2", 1),
+    ]
+
+
+def test_failed_studies_are_left_out(tmp_path):
+    path = str(tmp_path / "acls.ndjson")
+    with contextlib.redirect_stdout(io.StringIO()):
+        with AclExport(path) as export:
+            export.add("SD_1", [("GF_1", "did-1", ["*"])])
+            export.add("SD_2", [("GF_2", "did-2", ["*"])])
+            export.add("SD_2", [("GF_3", "did-3", ["*"])])
+            export.discard("SD_2")
+    assert [r["kf_id"] for r in read_export(path)[1]] == ["GF_1"]
+
+    # nothing is written if the run fails
+    path = str(tmp_path / "failed.ndjson")
+    with pytest.raises(Exception, match="boom"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            with AclExport(path) as export:
+                export.add("SD_1", [("GF_1", "did-1", ["*"])])
+                raise Exception("boom")
+    assert not os.path.exists(path)
+    assert not os.path.exists(export.dir)
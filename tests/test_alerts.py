@@ -0,0 +1,71 @@
+import csv
+import json
+
+import pytest
+
+from kf_update_dbgap_consent.alerts import (
+    AlertLog,
+    InconsistentCodes,
+    MissingSample,
+    NullAccess,
+    count_alerts,
+)
+
+ALERTS = [
+    MissingSample("sample_1"),
+    NullAccess("GF_11111111"),
+    InconsistentCodes("GF_22222222", {"phs001.c2", None, "phs001.c1"}),
+    MissingSample("sample_2"),
+]
+
+
+def test_alert_messages():
+    assert str(ALERTS[0]) == (
+        "ALERT: sample sample_1 from dbGaP not found in dataservice"
+    )
+    assert str(ALERTS[1]) == (
+        "ALERT: GF GF_11111111 is visible but has controlled_access set to"
+        " null instead of True/False."
+    )
+    assert ALERTS[2].codes == (None, "phs001.c1", "phs001.c2")
+    assert ALERTS[2] == InconsistentCodes(
+        "GF_22222222", ["phs001.c1", "phs001.c2", None]
+    )
+    assert MissingSample("x") != NullAccess("x")
+    assert count_alerts(ALERTS) == {
+        "missing_sample": 2,
+        "null_access": 1,
+        "inconsistent_codes": 1,
+    }
+
+
+@pytest.mark.parametrize("name", ["alerts.ndjson", "alerts.csv"])
+def test_alert_log(tmp_path, capsys, name):
+    path = str(tmp_path / name)
+    with AlertLog(path, console_limit=3) as log:
+        log.add("SD_11111111", ALERTS)
+        log.add("SD_22222222", ALERTS[:1])
+
+    printed = capsys.readouterr().out.splitlines()
+    assert printed == [str(a) for a in ALERTS[:3]]
+    assert log.summary() == (
+        "5 alerts: 1 inconsistent_codes, 3 missing_sample, 1 null_access"
+        f" (2 not printed, see {path})"
+    )
+
+    with open(path) as f:
+        if name.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f]
+    assert len(rows) == 5
+    assert rows[2]["type"] == "inconsistent_codes"
+    assert rows[2]["study_id"] == "SD_11111111"
+    assert rows[2]["kf_id"] == "GF_22222222"
+    assert rows[4]["study_id"] == "SD_22222222"
+    assert rows[4]["sample_id"] == "sample_1"
+    if name.endswith(".csv"):
+        assert rows[2]["codes"] == "None phs001.c1 phs001.c2"
+    else:
+        assert rows[2]["codes"] == [None, "phs001.c1", "phs001.c2"]
+    assert AlertLog().summary() == "No alerts"
@@ -0,0 +1,68 @@
+from kf_update_dbgap_consent.apply import PatchApplier
+
+host = "http://localhost:5000"
+
+patches = {
+    "genomic-files": {
+        "GF_11111111": {"acl": ["*"]},
+        "GF_22222222": {"visible": False},
+    },
+    "biospecimens": {
+        "BS_11111111": {"visible": False},
+        "BS_22222222": {"consent_type": "GRU"},
+    },
+}
+
+
+def test_apply_order_and_backoff(requests_mock):
+    requests_mock.patch(f"{host}/genomic-files/GF_11111111", json={})
+    requests_mock.patch(f"{host}/genomic-files/GF_22222222", json={})
+    requests_mock.patch(f"{host}/biospecimens/BS_11111111", json={})
+    # Throttled once before succeeding
+    requests_mock.patch(
+        f"{host}/biospecimens/BS_22222222",
+        [{"status_code": 429, "json": {}}, {"status_code": 200, "json": {}}],
+    )
+
+    result = PatchApplier(host, workers=4, backoff=0.01).apply(patches)
+    assert result == {"applied": 4, "skipped": 0, "failed": {}}
+
+    paths = [r.path for r in requests_mock.request_history]
+    assert len(paths) == 5
+    # All biospecimens are patched before any genomic files
+    assert all("biospecimens" in p for p in paths[:3])
+    assert all("genomic-files" in p for p in paths[3:])
+
+
+def test_apply_resume(requests_mock, tmp_path):
+    journal = str(tmp_path / "journal")
+    requests_mock.patch(f"{host}/biospecimens/BS_11111111", json={})
+    requests_mock.patch(f"{host}/biospecimens/BS_22222222", json={})
+    requests_mock.patch(f"{host}/genomic-files/GF_11111111", json={})
+    requests_mock.patch(
+        f"{host}/genomic-files/GF_22222222", status_code=400, json={}
+    )
+
+    result = PatchApplier(host, backoff=0.01, journal_path=journal).apply(
+        patches
+    )
+    assert result["applied"] == 3
+    assert list(result["failed"]) == ["GF_22222222"]
+
+    # Resuming only resends what hasn't been applied
+    requests_mock.reset_mock()
+    requests_mock.patch(f"{host}/genomic-files/GF_22222222", json={})
+    result = PatchApplier(host, backoff=0.01, journal_path=journal).apply(
+        patches
+    )
+    assert result == {"applied": 1, "skipped": 3, "failed": {}}
+    assert [r.path for r in requests_mock.request_history] == [
+        "/genomic-files/gf_22222222"
+    ]
+
+    # A different patch for an applied kf_id is sent again
+    changed = {"biospecimens": {"BS_11111111": {"visible": True}}}
+    result = PatchApplier(host, backoff=0.01, journal_path=journal).apply(
+        changed
+    )
+    assert result["applied"] == 1
@@ -0,0 +1,37 @@
+from kf_update_dbgap_consent.batch import process_studies, summarize
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.test_sample_status import (
+    clear_study,
+    compare,
+    host,
+    load_data,
+    mock_dbgap,
+    populate_dataservice,
+)
+
+
+def test_process_studies(requests_mock):
+    requests_mock._real_http = True
+    mock_dbgap(requests_mock)
+
+    study_id, data, expected_patches = load_data()
+    clear_study(study_id)
+    populate_dataservice(data)
+
+    results = process_studies(
+        ConsentProcessor(host), [study_id, "SD_NOTFOUND"], workers=2
+    )
+    assert list(results) == sorted([study_id, "SD_NOTFOUND"])
+
+    # One study failing shouldn't affect the others
+    assert "SD_NOTFOUND not found" in results["SD_NOTFOUND"]["error"]
+    assert results[study_id]["error"] is None
+    compare(results[study_id]["patches"], expected_patches)
+
+    summary = summarize(results)
+    assert summary["totals"]["studies"] == 2
+    assert summary["totals"]["failed_studies"] == 1
+    assert summary["studies"][study_id]["patch_counts"] == {
+        endpoint: len(entities)
+        for endpoint, entities in expected_patches.items()
+    }
@@ -0,0 +1,82 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from kf_update_dbgap_consent.client import (
+    DEFAULT_TIMEOUT,
+    HttpClient,
+    pool_size_for,
+)
+
+host = "http://dataservice.fake"
+url = f"{host}/studies/SD_00000000"
+
+
+def test_pool_and_timeout(requests_mock):
+    requests_mock.get(url, json={"results": {}})
+    client = HttpClient(pool_size=12)
+    assert client.get_adapter(url)._pool_maxsize == 12
+    assert client.host_limit == 12
+    client.get(url)
+    client.get(url, timeout=1)
+    assert [r.timeout for r in requests_mock.request_history] == [
+        DEFAULT_TIMEOUT,
+        1,
+    ]
+    assert pool_size_for(4 * 8, 8) == 40
+    assert pool_size_for(1) == pool_size_for()
+
+
+def test_cached_get(requests_mock):
+    get = requests_mock.get(url, json={"results": {"version": "v1.p1"}})
+    requests_mock.patch(url, json={})
+    missing = requests_mock.get(f"{host}/studies/SD_11111111", status_code=404)
+    client = HttpClient()
+
+    assert client.cached_get(url).json()["results"]["version"] == "v1.p1"
+    client.cached_get(url + "/")
+    assert get.call_count == 1
+    client.cached_get(url, ttl=0)
+    assert get.call_count == 2
+
+    # writes through the client drop the cached response
+    client.patch(url, json={"version": "v2.p1"})
+    client.cached_get(url)
+    assert get.call_count == 3
+
+    # failures aren't cached
+    client.cached_get(f"{host}/studies/SD_11111111")
+    client.cached_get(f"{host}/studies/SD_11111111")
+    assert missing.call_count == 2
+
+
+def test_host_limit(monkeypatch):
+    lock = threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+
+    def slow(self, method, url, *args, **kwargs):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(0.01)
+        with lock:
+            in_flight["now"] -= 1
+
+    monkeypatch.setattr(requests.Session, "request", slow)
+    client = HttpClient(pool_size=8, host_limit=3)
+    with ThreadPoolExecutor(max_workers=16) as tpex:
+        list(tpex.map(lambda i: client.get(url), range(40)))
+    assert in_flight["max"] == 3
+
+    # limits are per host
+    in_flight["max"] = 0
+    with ThreadPoolExecutor(max_workers=16) as tpex:
+        list(
+            tpex.map(
+                lambda i: client.get(url if i % 2 else "http://other.fake/"),
+                range(40),
+            )
+        )
+    assert in_flight["max"] == 6
@@ -0,0 +1,39 @@
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.test_db import DB_URL
+from tests.test_sample_status import (
+    clear_study,
+    host,
+    load_data,
+    mock_dbgap,
+    populate_dataservice,
+)
+
+
+def run(processor, study_id):
+    patches, alerts = processor.get_patches_for_study(study_id)
+    return patches, sorted(map(str, alerts))
+
+
+def test_rules_in_db_match_in_memory(requests_mock):
+    requests_mock._real_http = True
+    mock_dbgap(requests_mock)
+    study_id, data, _ = load_data()
+    clear_study(study_id)
+    # a sequencing experiment that also holds a genomic file without any
+    # biospecimens, so it isn't hidden along with the others
+    data["genomic-files"]["GF_55555555"] = dict(
+        data["genomic-files"]["GF_11111111"]
+    )
+    data["sequencing-experiment-genomic-files"]["SG_55555555"] = {
+        "sequencing_experiment_id": "SE_11111111",
+        "genomic_file_id": "GF_55555555",
+    }
+    populate_dataservice(data)
+
+    expected = run(ConsentProcessor(host, DB_URL), study_id)
+    assert run(ConsentProcessor(host, DB_URL, rules_in_db=True), study_id) == (
+        expected
+    )
+    patches = expected[0]
+    assert "SG_00000000" in patches["sequencing-experiment-genomic-files"]
+    assert "SE_11111111" not in patches.get("sequencing-experiments", {})
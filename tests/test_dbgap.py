@@ -0,0 +1,62 @@
+import threading
+
+from kf_update_dbgap_consent.dbgap import (
+    Sample,
+    SampleStatusCache,
+    get_latest_sample_status,
+    read_sample_status,
+)
+from tests.test_sample_status import mock_dbgap
+
+expected_samples = {
+    "test_sample_1": Sample("Deleted", "1", "GRU"),
+    "test_sample_2": Sample("Loaded", "1", "LOL"),
+    "test_sample_3": Sample("Loaded", "2", "HMB"),
+}
+
+
+def test_read_sample_status():
+    study, samples = read_sample_status("tests/data/phs999999.v1.xml")
+    assert study["accession"] == "phs999999.v1.p1"
+    assert study["registration_status"] == "released"
+    assert dict(samples) == expected_samples
+
+
+def test_latest_sample_status_cache(requests_mock, tmp_path):
+    mock_dbgap(requests_mock)
+    cache = SampleStatusCache(str(tmp_path))
+
+    # Unreleased v2 should be skipped in favor of released v1
+    accession, samples = get_latest_sample_status("phs999999", cache=cache)
+    assert accession == "phs999999.v1.p1"
+    assert samples == expected_samples
+    assert cache.get(accession) == expected_samples
+
+    # Cached samples are used instead of the downloaded ones
+    cache.put(accession, {"cached_sample": Sample("Loaded", "3", "X")})
+    accession, samples = get_latest_sample_status("phs999999", cache=cache)
+    assert samples == {"cached_sample": Sample("Loaded", "3", "X")}
+
+
+def test_sample_status_cache_concurrent_puts(tmp_path):
+    cache = SampleStatusCache(str(tmp_path))
+    tables = [
+        {f"sample_{i}_{j}": Sample("Loaded", "1", "GRU") for j in range(2000)}
+        for i in range(8)
+    ]
+    errors = []
+
+    def put(samples):
+        try:
+            cache.put("phs999999.v1.p1", samples)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=put, args=(t,)) for t in tables]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert cache.get("phs999999.v1.p1") in tables
+    assert [p.name for p in tmp_path.iterdir()] == ["phs999999.v1.p1.tsv.gz"]
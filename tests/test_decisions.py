@@ -0,0 +1,107 @@
+import contextlib
+import io
+import sqlite3
+
+from kf_update_dbgap_consent.alerts import INCONSISTENT_CODES, NULL_ACCESS
+from kf_update_dbgap_consent.decisions import (
+    BS_HIDDEN,
+    BS_LOADED,
+    BS_NO_SAMPLE,
+    BS_NOT_LOADED,
+    GF_HIDDEN_SPECIMEN,
+    GF_INCONSISTENT_CODES,
+    GF_NULL_ACCESS,
+    RULES,
+    DecisionIndex,
+    decisions_path,
+    explain,
+)
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+HIDDEN_BS_RULES = {BS_HIDDEN, BS_NO_SAMPLE, BS_NOT_LOADED}
+
+
+def _run(study, requests_mock, path, stream=False):
+    services = FakeServices(study)
+    services.install(requests_mock)
+    with DecisionIndex(path) as decisions:
+        processor = ConsentProcessor(services.host, decisions=decisions)
+        with contextlib.redirect_stdout(io.StringIO()):
+            if stream:
+                chunks = list(
+                    processor.stream_patches_for_study(
+                        study.study_id, chunk_size=300
+                    )
+                )
+                return None, [a for _, alerts in chunks for a in alerts]
+            return processor.get_patches_for_study(study.study_id)
+
+
+def test_decisions_explain_results(requests_mock, tmp_path):
+    study = SyntheticStudy(
+        n_genomic_files=2000,
+        seed=2,
+        multi_specimen_fraction=0.3,
+        hidden_fraction=0.2,
+        null_access_fraction=0.1,
+        unmatched_fraction=0.2,
+    )
+    path = str(tmp_path / "decisions.sqlite")
+    patches, alerts = _run(study, requests_mock, path)
+
+    for kfid, patch in patches["genomic-files"].items():
+        e = explain(path, kfid)
+        assert e["study_id"] == study.study_id
+        assert e["accession"].startswith("phs")
+        assert (e["endpoint"], e["description"]) == RULES[e["rule"]]
+        if "acl" in patch:
+            assert e["acl"] == patch["acl"]
+        if patch.get("visible") is False:
+            assert e["rule"] == GF_HIDDEN_SPECIMEN
+            assert explain(path, e["detail"])["rule"] in HIDDEN_BS_RULES
+    rules = {
+        INCONSISTENT_CODES: GF_INCONSISTENT_CODES,
+        NULL_ACCESS: GF_NULL_ACCESS,
+    }
+    for alert in alerts:
+        if alert.kf_id:
+            assert explain(path, alert.kf_id)["rule"] == rules[alert.type]
+    for kfid, patch in patches["biospecimens"].items():
+        rule = explain(path, kfid)["rule"]
+        if patch.get("visible") is False:
+            assert rule in HIDDEN_BS_RULES
+        else:
+            assert rule in {BS_LOADED, BS_HIDDEN}
+    assert explain(path, "GF_NOTFOUND") is None
+
+
+def test_stream_records_same_decisions(requests_mock, tmp_path):
+    study = SyntheticStudy(
+        n_genomic_files=2000,
+        seed=3,
+        multi_specimen_fraction=0.5,
+        hidden_fraction=0.2,
+    )
+    tables = []
+    for stream in [False, True]:
+        path = str(tmp_path / f"{stream}.sqlite")
+        _run(study, requests_mock, path, stream)
+        db = sqlite3.connect(path)
+        tables.append(
+            db.execute(
+                "SELECT kf_id, rule, a.acl, detail FROM decisions"
+                " LEFT JOIN acls a ON a.id = decisions.acl ORDER BY kf_id"
+            ).fetchall()
+        )
+        db.close()
+    assert len(tables[0]) > 2000
+    assert tables[0] == tables[1]
+
+
+def test_decisions_path():
+    assert decisions_path("plans/SD_1.ndjson.gz") == (
+        "plans/SD_1.decisions.sqlite"
+    )
+    assert decisions_path("plan") == "plan.decisions.sqlite"
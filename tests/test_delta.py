@@ -0,0 +1,93 @@
+import threading
+
+from kf_update_dbgap_consent.dbgap import Sample
+from kf_update_dbgap_consent.delta import ConsentState, diff_samples
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.test_sample_status import (
+    clear_study,
+    compare,
+    host,
+    load_data,
+    mock_dbgap,
+    populate_dataservice,
+)
+
+
+def test_diff_samples():
+    old = {
+        "a": Sample("Loaded", "1", "GRU"),
+        "b": Sample("Loaded", "1", "GRU"),
+        "c": Sample("Loaded", "1", "GRU"),
+    }
+    new = {
+        "a": Sample("Loaded", "1", "GRU"),
+        "b": Sample("Loaded", "2", "HMB"),
+        "d": Sample("Loaded", "1", "GRU"),
+    }
+    assert diff_samples(old, new) == {"b", "c", "d"}
+
+
+def test_delta(requests_mock, tmp_path):
+    requests_mock._real_http = True
+    mock_dbgap(requests_mock)
+
+    study_id, data, expected_patches = load_data()
+    clear_study(study_id)
+    populate_dataservice(data)
+
+    # Without saved state a delta run considers everything
+    processor = ConsentProcessor(host, state_dir=str(tmp_path))
+    patches, alerts = processor.get_patches_for_study(study_id, delta=True)
+    compare(patches, expected_patches)
+    processor.save_state(study_id)
+
+    # Nothing changed in dbGaP since the saved state
+    patches, alerts = processor.get_patches_for_study(study_id, delta=True)
+    compare(patches, {"studies": expected_patches["studies"]})
+
+    # Only test_sample_3 changed, so only its specimen and GFs are considered
+    state = ConsentState(str(tmp_path))
+    accession, samples = state.load(study_id)
+    samples["test_sample_3"] = Sample("Loaded", "1", "LOL")
+    state.save(study_id, accession, samples)
+    patches, alerts = processor.get_patches_for_study(study_id, delta=True)
+    compare(
+        patches,
+        {
+            "studies": expected_patches["studies"],
+            "biospecimens": {
+                "BS_33333333": expected_patches["biospecimens"]["BS_33333333"]
+            },
+            "genomic-files": {
+                k: expected_patches["genomic-files"][k]
+                for k in ["GF_33333333", "GF_44444444"]
+            },
+        },
+    )
+
+    # State recorded for a different matching field is ignored
+    assert state.load(study_id, match_aliquot=True) is None
+
+
+def test_concurrent_saves(tmp_path):
+    state = ConsentState(str(tmp_path))
+    tables = [
+        {f"sample_{i}_{j}": Sample("Loaded", "1", "GRU") for j in range(2000)}
+        for i in range(8)
+    ]
+    errors = []
+
+    def save(samples):
+        try:
+            state.save("SD_11111111", "phs999999.v1.p1", samples)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=save, args=(t,)) for t in tables]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert state.load("SD_11111111")[1] in tables
+    assert [p.name for p in tmp_path.iterdir()] == ["SD_11111111.json.gz"]
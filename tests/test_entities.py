@@ -0,0 +1,117 @@
+from kf_update_dbgap_consent.entities import MISSING, StudyEntities
+
+
+def test_study_entities():
+    entities = StudyEntities()
+    entities.add(
+        "biospecimens",
+        {
+            "kf_id": "BS_11111111",
+            "visible": True,
+            "external_sample_id": "test_sample_1",
+            "consent_type": "GRU",
+            "dbgap_consent_code": "phs999999.c1",
+            "_links": {"participant": "/participants/PT_11111111"},
+        },
+    )
+    entities.add(
+        "genomic-files",
+        {
+            "kf_id": "GF_11111111",
+            "visible": True,
+            "controlled_access": True,
+            "acl": ["phs999999.c999", "SD_00000000"],
+        },
+    )
+    # API entities link through _links, database rows through *_id columns
+    entities.add(
+        "biospecimen-genomic-files",
+        {
+            "kf_id": "BG_11111111",
+            "visible": False,
+            "_links": {
+                "biospecimen": "/biospecimens/BS_11111111",
+                "genomic_file": "/genomic-files/GF_11111111",
+            },
+        },
+    )
+    entities.add(
+        "biospecimen-genomic-files",
+        {
+            "kf_id": "BG_22222222",
+            "visible": True,
+            "biospecimen_id": "BS_22222222",
+            "genomic_file_id": "GF_11111111",
+        },
+    )
+
+    assert entities.gf_specimens == {
+        "GF_11111111": {
+            "BS_11111111": "BG_11111111",
+            "BS_22222222": "BG_22222222",
+        }
+    }
+    assert entities.specimen_gfs() == {
+        "BS_11111111": {"GF_11111111"},
+        "BS_22222222": {"GF_11111111"},
+    }
+
+    bs = entities.biospecimens["BS_11111111"]
+    assert bs.external_sample_id == "test_sample_1"
+    assert not hasattr(bs, "_links")
+    assert entities.get_field("genomic-files", "GF_11111111", "acl") == (
+        "SD_00000000",
+        "phs999999.c999",
+    )
+    assert (
+        entities.get_field(
+            "biospecimen-genomic-files", "BG_11111111", "visible"
+        )
+        is False
+    )
+    assert (
+        entities.get_field(
+            "biospecimen-genomic-files", "BG_22222222", "visible"
+        )
+        is MISSING
+    )
+    assert (
+        entities.get_field("biospecimens", "BS_99999999", "visible") is MISSING
+    )
+
+
+def test_hidden_descendants():
+    entities = StudyEntities()
+    for kfid, bsid, gfid in [
+        ("BG_11111111", "BS_11111111", "GF_11111111"),
+        ("BG_22222222", "BS_11111111", "GF_22222222"),
+        ("BG_33333333", "BS_22222222", "GF_22222222"),
+        ("BG_44444444", "BS_22222222", "GF_33333333"),
+    ]:
+        entities.add_link("biospecimen-genomic-files", kfid, bsid, gfid)
+    entities.add_link(
+        "biospecimen-diagnoses", "BD_11111111", "BS_11111111", "DG_11111111"
+    )
+    for kfid, gfid, seid in [
+        ("SG_11111111", "GF_11111111", "SE_11111111"),
+        ("SG_22222222", "GF_22222222", "SE_11111111"),
+        ("SG_33333333", "GF_33333333", "SE_22222222"),
+        ("SG_44444444", "GF_22222222", "SE_22222222"),
+    ]:
+        entities.add_link(
+            "sequencing-experiment-genomic-files", kfid, gfid, seid
+        )
+
+    # GF_22222222 is included despite its contribution from BS_22222222.
+    # SE_22222222 isn't, since GF_33333333 isn't a descendant.
+    assert entities.hidden_descendants({"BS_11111111"}) == {
+        "biospecimen-diagnoses": {"BD_11111111"},
+        "biospecimen-genomic-files": {"BG_11111111", "BG_22222222"},
+        "genomic-files": {"GF_11111111", "GF_22222222"},
+        "sequencing-experiment-genomic-files": {
+            "SG_11111111",
+            "SG_22222222",
+            "SG_44444444",
+        },
+        "sequencing-experiments": {"SE_11111111"},
+    }
@@ -0,0 +1,68 @@
+import json
+import threading
+import time
+
+import requests
+
+from kf_update_dbgap_consent.metrics import Metrics, endpoint_key
+
+
+def test_endpoint_key():
+    assert (
+        endpoint_key("PATCH", "http://host/genomic-files/GF_ABCD1234")
+        == "PATCH /genomic-files/{kf_id}"
+    )
+    assert (
+        endpoint_key("GET", "http://host/biospecimens?study_id=SD_ABCD1234")
+        == "GET /biospecimens"
+    )
+
+
+def test_metrics(requests_mock, tmp_path):
+    metrics = Metrics()
+    with metrics.phase("rules"):
+        pass
+    with metrics.phase("rules"):
+        pass
+    with metrics.db_query("update biospecimens"):
+        pass
+    metrics.count("alerts", 3)
+
+    requests_mock.patch("http://host/biospecimens/BS_ABCD1234", json={})
+    requests_mock.patch(
+        "http://host/biospecimens/BS_ABCD5678", status_code=500, json={}
+    )
+    session = metrics.instrument(requests.Session())
+    session.patch("http://host/biospecimens/BS_ABCD1234", json={})
+    session.patch("http://host/biospecimens/BS_ABCD5678", json={})
+
+    path = tmp_path / "metrics.json"
+    metrics.write(path)
+    report = json.loads(path.read_text())
+    assert report["phases"]["rules"]["count"] == 2
+    assert report["db"]["update biospecimens"]["count"] == 1
+    assert report["counters"] == {"alerts": 3}
+    http = report["http"]["PATCH /biospecimens/{kf_id}"]
+    assert http["count"] == 2
+    assert http["status"] == {"200": 1, "500": 1}
+    assert sum(http["latency_histogram"].values()) == 2
+    assert "rules" in metrics.summary()
+
+
+def test_phase_cpu_is_per_thread():
+    metrics = Metrics()
+    done = threading.Event()
+
+    def spin():
+        while not done.is_set():
+            pass
+
+    thread = threading.Thread(target=spin)
+    thread.start()
+    try:
+        with metrics.phase("idle"):
+            time.sleep(0.3)
+    finally:
+        done.set()
+        thread.join()
+    assert metrics.phases["idle"]["cpu"] < 0.1
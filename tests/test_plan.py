@@ -0,0 +1,152 @@
+import sys
+
+import pytest
+
+from kf_update_dbgap_consent import stream
+from kf_update_dbgap_consent.app.cli import apply_cli, plan_cli
+from kf_update_dbgap_consent.plan import PlanWriter, patch_records, read_plan
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+result = {
+    "patches": {
+        "genomic-files": {"GF_11111111": {"acl": ["*"]}},
+        "biospecimens": {"BS_11111111": {"visible": False}},
+    },
+    "alerts": ["ALERT: something"],
+    "error": None,
+}
+
+
+@pytest.mark.parametrize("name", ["plan.ndjson", "plan.ndjson.gz"])
+def test_plan_file(tmp_path, name):
+    path = str(tmp_path / name)
+    with PlanWriter(path) as writer:
+        writer.write_study("SD_11111111", result, "phs999999.v1.p1")
+
+    studies = {}
+    records = list(patch_records(read_plan(path), studies))
+    # parents first
+    assert records == [
+        ("biospecimens", "BS_11111111", {"visible": False}),
+        ("genomic-files", "GF_11111111", {"acl": ["*"]}),
+    ]
+    assert studies["SD_11111111"]["accession"] == "phs999999.v1.p1"
+    assert studies["SD_11111111"]["patches"] == 2
+    assert studies["SD_11111111"]["alerts"] == ["ALERT: something"]
+
+
+def test_plan_then_apply(requests_mock, monkeypatch, tmp_path):
+    study = SyntheticStudy(n_genomic_files=200)
+    services = FakeServices(study)
+    services.install(requests_mock)
+    plan = str(tmp_path / "plan.ndjson.gz")
+    state_dir, cache_dir = str(tmp_path / "state"), str(tmp_path / "cache")
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "dbgapconsent-plan",
+            study.study_id,
+            "--server",
+            services.host,
+            "--plan",
+            plan,
+            "--cache_dir",
+            cache_dir,
+        ],
+    )
+    plan_cli()
+    assert not any(k.startswith("PATCH") for k in services.requests)
+    planned = [r for r in read_plan(plan) if r["type"] == "patch"]
+    assert planned
+
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "dbgapconsent-apply",
+            plan,
+            "--server",
+            services.host,
+            "--state_dir",
+            state_dir,
+            "--cache_dir",
+            cache_dir,
+        ],
+    )
+    apply_cli()
+    for r in planned:
+        entity = services.entities[r["endpoint"]][r["kf_id"]]
+        assert {k: entity[k] for k in r["patch"]} == r["patch"]
+    assert (tmp_path / "state" / f"{study.study_id}.json.gz").exists()
+
+
+def test_failed_streamed_study_is_not_applied(
+    requests_mock, monkeypatch, tmp_path
+):
+    study = SyntheticStudy(n_genomic_files=200, hidden_fraction=0.2)
+    services = FakeServices(study)
+    services.install(requests_mock)
+    plan = str(tmp_path / "plan.ndjson")
+    chunked_rules = stream.chunked_rules
+
+    def fail_after_first_chunk(*args, **kwargs):
+        chunks = chunked_rules(*args, **kwargs)
+        yield next(chunks)
+        raise Exception("Chunk failed")
+
+    monkeypatch.setattr(stream, "chunked_rules", fail_after_first_chunk)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "dbgapconsent-plan",
+            study.study_id,
+            "--server",
+            services.host,
+            "--plan",
+            plan,
+            "--stream",
+            "--chunk_size",
+            "50",
+        ],
+    )
+    with pytest.raises(SystemExit, match="Failed studies"):
+        plan_cli()
+    records = list(read_plan(plan))
+    # the patches computed before the failure are in the plan
+    assert {r["endpoint"] for r in records if r["type"] == "patch"} >= {
+        "biospecimens",
+        "genomic-files",
+    }
+    assert "Chunk failed" in records[-1]["error"]
+
+    monkeypatch.setattr(
+        sys, "argv", ["dbgapconsent-apply", plan, "--server", services.host]
+    )
+    with pytest.raises(SystemExit, match=study.study_id):
+        apply_cli()
+    assert not any(k.startswith("PATCH") for k in services.requests)
+
+
+@pytest.mark.parametrize(
+    "argv",
+    [
+        ["SD_11111111", "--all_studies"],
+        ["--all_studies", "--delta"],
+        ["--all_studies", "--stream", "--db_url", "x", "--rules_in_db"],
+    ],
+)
+def test_bad_arguments_fail_before_scraping(
+    requests_mock, monkeypatch, tmp_path, argv
+):
+    plan = str(tmp_path / "plan.ndjson")
+    monkeypatch.setattr(
+        sys, "argv", ["dbgapconsent-plan", "--plan", plan, *argv]
+    )
+    with pytest.raises(SystemExit) as e:
+        plan_cli()
+    assert e.value.code == 2
+    assert not requests_mock.called
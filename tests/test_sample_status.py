@@ -1,10 +1,17 @@
+import contextlib
+import io
 import json
+import threading
+import time
 from urllib.parse import parse_qs
 
 import pytest
 from d3b_utils.requests_retry import Session
 
+from kf_update_dbgap_consent import sample_status
 from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
 
 host = "http://localhost:5000"
 
@@ -78,7 +85,7 @@ def test_sample_status(requests_mock):
         f"{host}/genomic-files/GF_22222222", json={"controlled_access": None}
     )
     patches, alerts = ConsentProcessor(host).get_patches_for_study(study_id)
-    assert alerts == [
+    assert [str(a) for a in alerts] == [
         "ALERT: GF GF_22222222 is visible but has controlled_access set to null"
         " instead of True/False."
     ]
@@ -101,8 +108,8 @@ def test_sample_status(requests_mock):
         for endpoint, entities in expected_patches.items()
     }
     compare(patches, new_expected_patches)
-    assert (
-        data["biospecimens"]["BS_22222222"]["external_sample_id"] in alerts[0]
+    assert data["biospecimens"]["BS_22222222"]["external_sample_id"] in str(
+        alerts[0]
     )
 
     # An extra biospecimen: it should be hidden
@@ -125,3 +132,65 @@ def test_sample_status(requests_mock):
         "dbgap_consent_code": None,
     }
     compare(patches, new_expected_patches)
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_entities_load_while_release_is_found(
+    requests_mock, monkeypatch, stream
+):
+    study = SyntheticStudy(n_genomic_files=500, hidden_fraction=0.2)
+    services = FakeServices(study)
+    services.install(requests_mock)
+
+    def run(processor):
+        with contextlib.redirect_stdout(io.StringIO()):
+            if stream:
+                return list(processor.stream_patches_for_study(study.study_id))
+            return processor.get_patches_for_study(study.study_id)
+
+    expected = run(ConsentProcessor(services.host))
+
+    # finding the release waits for the entities to start loading, which
+    # would never happen if they were only loaded afterwards
+    loading = threading.Event()
+    processor = ConsentProcessor(services.host)
+    for name in ["get_study_entities", "spool_study_entities"]:
+
+        def started(*args, load=getattr(processor, name)):
+            loading.set()
+            return load(*args)
+
+        monkeypatch.setattr(processor, name, started)
+    get_latest_sample_status = sample_status.get_latest_sample_status
+
+    def find_release(*args, **kwargs):
+        assert loading.wait(10)
+        return get_latest_sample_status(*args, **kwargs)
+
+    monkeypatch.setattr(sample_status, "get_latest_sample_status", find_release)
+    assert run(processor) == expected
+
+
+def test_entity_load_finishes_when_release_fails(requests_mock, monkeypatch):
+    study = SyntheticStudy(n_genomic_files=100)
+    services = FakeServices(study)
+    services.install(requests_mock)
+    processor = ConsentProcessor(services.host)
+    started, finished = threading.Event(), threading.Event()
+
+    def load(study_id):
+        started.set()
+        time.sleep(0.2)
+        finished.set()
+
+    monkeypatch.setattr(processor, "get_study_entities", load)
+
+    def find_release(*args, **kwargs):
+        assert started.wait(10)
+        raise Exception("No released sample status")
+
+    monkeypatch.setattr(sample_status, "get_latest_sample_status", find_release)
+    with pytest.raises(Exception, match="No released"):
+        with contextlib.redirect_stdout(io.StringIO()):
+            processor.get_patches_for_study(study.study_id)
+    assert finished.is_set()
@@ -0,0 +1,71 @@
+from collections import Counter
+
+import pytest
+import requests
+
+from kf_update_dbgap_consent.entities import STUDY_ENDPOINTS
+from kf_update_dbgap_consent.scrape import (
+    Scraper,
+    format_after,
+    to_microseconds,
+)
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+
+def test_timestamps():
+    t = to_microseconds("2018-06-15T19:37:46.003078+00:00")
+    assert t == 1529091466003078
+    assert format_after(t) == "1529091466.003078"
+    assert format_after(to_microseconds("2018-06-15T19:37:46Z")) == (
+        "1529091466.000000"
+    )
+
+
+# many entities created at the same time, across page boundaries
+@pytest.mark.parametrize("burst", [1, 7, 9])
+def test_scrape(requests_mock, burst):
+    study = SyntheticStudy(n_genomic_files=2000)
+    services = FakeServices(study, burst=burst)
+    services.install(requests_mock)
+
+    seen = Counter()
+    counts = Scraper(requests.Session(), services.host, 4, limit=10).scrape(
+        STUDY_ENDPOINTS,
+        {"study_id": study.study_id},
+        lambda endpoint, e: seen.update([(endpoint, e["kf_id"])]),
+    )
+    assert max(seen.values()) == 1
+    for endpoint in STUDY_ENDPOINTS:
+        expected = set(study.entities.get(endpoint, {}))
+        assert {k for ep, k in seen if ep == endpoint} == expected
+        assert counts[endpoint] == len(expected)
+    # windows were split and fetched concurrently
+    pages = -(-len(study.entities["genomic-files"]) // 10)
+    assert services.requests["GET genomic-files"] > pages
+
+
+def test_scrape_checks_totals(requests_mock):
+    study = SyntheticStudy(n_genomic_files=100)
+    services = FakeServices(study, burst=20)
+    handle = services._handle
+
+    def one_more(request, context):
+        body = handle(request, context)
+        if "total" in body:
+            body["total"] += 1
+        return body
+
+    services._handle = one_more
+    services.install(requests_mock)
+    scraper = Scraper(requests.Session(), services.host, 2, limit=10)
+    filters = {"study_id": study.study_id}
+
+    # too many genomic files created at once to page past
+    with pytest.raises(Exception, match="can't page past"):
+        scraper.scrape(["genomic-files"], filters, lambda *e: None)
+
+    # a genomic file missing from the pages
+    scraper.limit = 100
+    with pytest.raises(Exception, match="but the dataservice reported 101"):
+        scraper.scrape(["genomic-files"], filters, lambda *e: None)
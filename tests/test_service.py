@@ -0,0 +1,116 @@
+import json
+import threading
+import time
+from urllib.request import Request, urlopen
+
+import pytest
+
+from kf_update_dbgap_consent.service import (
+    ConsentService,
+    LRUCache,
+    make_server,
+)
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+
+def test_lru_cache():
+    cache = LRUCache(5, weight=len)
+    cache.put("a", "aa")
+    cache.put("b", "bb")
+    assert cache.get("a") == "aa"
+    # evicts the least recently used
+    cache.put("c", "cc")
+    assert cache.get("b") is None
+    assert cache.get("a") == "aa"
+    # too big to cache at all
+    cache.put("d", "dddddd")
+    assert cache.get("d") is None
+    cache.invalidate("a")
+    assert cache.get("a") is None
+    assert cache.get("c") == "cc"
+
+    expiring = LRUCache(5, ttl=0)
+    expiring.put("a", 1)
+    assert expiring.get("a") is None
+
+
+def _request(url, method="GET", body=None):
+    data = None if body is None else json.dumps(body).encode("utf-8")
+    with urlopen(Request(url, data=data, method=method)) as resp:
+        return resp.status, resp.read()
+
+
+@pytest.fixture
+def service(requests_mock, tmp_path):
+    study = SyntheticStudy(n_genomic_files=200)
+    services = FakeServices(study)
+    services.install(requests_mock)
+    service = ConsentService(
+        services.host, state_dir=str(tmp_path / "state"), workers=2
+    )
+    server = make_server(service, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield study, services, service, (
+        f"http://127.0.0.1:{server.server_address[1]}"
+    )
+    server.shutdown()
+    server.server_close()
+    service.shutdown()
+
+
+def _run_job(url, body):
+    status, data = _request(f"{url}/jobs", "POST", body)
+    assert status == 202
+    job_id = json.loads(data)["job_id"]
+    for _ in range(500):
+        job = json.loads(_request(f"{url}/jobs/{job_id}")[1])
+        if job["status"] in {"done", "failed"}:
+            return job
+        time.sleep(0.01)
+    raise Exception("job didn't finish")
+
+
+def test_service(service, monkeypatch):
+    study, services, consent_service, url = service
+    assert json.loads(_request(f"{url}/health")[1]) == {"status": "ok"}
+
+    job = _run_job(url, {"study_id": study.study_id})
+    assert job["status"] == "done", job["error"]
+    assert job["patch_counts"]["biospecimens"] == 50
+    scraped = services.requests["GET biospecimens"]
+    dbgap = services.requests["dbgap"]
+
+    plan = _request(f"{url}/jobs/{job['job_id']}/plan")[1].decode()
+    records = [json.loads(line) for line in plan.splitlines()]
+    assert sum(r["type"] == "patch" for r in records) == sum(
+        job["patch_counts"].values()
+    )
+
+    # entities and samples come from the warm caches
+    job = _run_job(url, {"study_id": study.study_id, "apply": True})
+    assert job["status"] == "done", job["error"]
+    assert job["applied"]["applied"] == sum(job["patch_counts"].values())
+    assert services.requests["GET biospecimens"] == scraped
+    assert services.requests["dbgap"] == dbgap + 1
+
+    # applying invalidated the cached entities, and nothing is left to do
+    job = _run_job(url, {"study_id": study.study_id, "delta": True})
+    assert job["status"] == "done", job["error"]
+    assert job["patch_counts"] == {}
+
+    job = _run_job(url, {"study_id": "SD_NOTFOUND"})
+    assert job["status"] == "failed"
+    assert _request(f"{url}/cache", "DELETE")[0] == 200
+    assert len(json.loads(_request(f"{url}/jobs")[1])) == 4
+
+    # a job failing after its release was found
+    def fail(study_id):
+        raise Exception("Scrape failed")
+
+    monkeypatch.setattr(consent_service.processor, "load_study_entities", fail)
+    job = _run_job(url, {"study_id": study.study_id})
+    assert job["status"] == "failed"
+    # no job holds on to its samples
+    assert consent_service.processor.used_samples == {}
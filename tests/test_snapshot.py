@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from kf_update_dbgap_consent import db
+from kf_update_dbgap_consent.entities import STUDY_ENDPOINTS
+from kf_update_dbgap_consent.snapshot import StudySnapshot
+
+T0 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+class FakeDatabase:
+    """
+    Answers the study queries of db.refresh_snapshot from
+    {endpoint: {kf_id: (modified_at, row)}}
+    """
+
+    def __init__(self):
+        self.rows = {endpoint: {} for endpoint in STUDY_ENDPOINTS}
+        self.now = T0
+
+    def put(self, endpoint, row):
+        self.rows[endpoint][row["kf_id"]] = (self.now, row)
+
+    def connect(self, db_url):
+        return FakeConnection(self)
+
+
+class FakeConnection:
+    def __init__(self, database):
+        self.database = database
+
+    def set_session(self, **kwargs):
+        pass
+
+    def cursor(self, name=None, cursor_factory=None):
+        return FakeCursor(self.database)
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class FakeCursor:
+    def __init__(self, database):
+        self.database = database
+        self.results = []
+
+    def execute(self, query, params=None):
+        if query == "SELECT now()":
+            self.results = [(self.database.now,)]
+            return
+        endpoint = next(e for e, q in db.STUDY_QUERIES.items() if q in query)
+        rows = [
+            row
+            for modified_at, row in self.database.rows[endpoint].values()
+            if "modified_at >" not in query or modified_at > params["since"]
+        ]
+        if query.startswith("SELECT count(*)"):
+            self.results = [(len(rows),)]
+        else:
+            self.results = rows
+
+    def fetchone(self):
+        return self.results[0]
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _bs(i, visible=True):
+    return {
+        "kf_id": f"BS_{i:08d}",
+        "visible": visible,
+        "consent_type": None,
+        "dbgap_consent_code": None,
+        "external_sample_id": f"sample_{i}",
+        "external_aliquot_id": None,
+    }
+
+
+def _gf(i, acl):
+    return {
+        "kf_id": f"GF_{i:08d}",
+        "visible": True,
+        "controlled_access": True,
+        "acl": acl,
+    }
+
+
+def _link(i):
+    return {
+        "kf_id": f"BG_{i:08d}",
+        "visible": True,
+        "biospecimen_id": f"BS_{i:08d}",
+        "genomic_file_id": f"GF_{i:08d}",
+    }
+
+
+def _loaded(snapshot):
+    rows = {endpoint: {} for endpoint in STUDY_ENDPOINTS}
+    snapshot.load(
+        lambda endpoint, row: rows[endpoint].update({row["kf_id"]: row})
+    )
+    return rows
+
+
+def _expected(database):
+    return {
+        endpoint: {kfid: row for kfid, (_, row) in rows.items()}
+        for endpoint, rows in database.rows.items()
+    }
+
+
+@pytest.fixture
+def database(monkeypatch):
+    database = FakeDatabase()
+    for i in range(100):
+        database.put("biospecimens", _bs(i))
+        database.put("genomic-files", _gf(i, ["SD_1"]))
+        database.put("biospecimen-genomic-files", _link(i))
+    monkeypatch.setattr(db.psycopg2, "connect", database.connect)
+    return database
+
+
+def _refresh(path, database, full=False):
+    database.now += timedelta(hours=1)
+    with StudySnapshot(path, "SD_1") as snapshot:
+        read = db.refresh_snapshot("db", "SD_1", snapshot, full=full)
+        return read, _loaded(snapshot)
+
+
+def test_refresh_reads_only_changes(database, tmp_path):
+    read, rows = _refresh(tmp_path, database)
+    assert read["genomic-files"] == 100
+    assert rows == _expected(database)
+
+    # changed rows, and one entity linked in without being modified
+    database.put("genomic-files", _gf(5, ["SD_1", "phs1.c1"]))
+    database.put("biospecimens", _bs(6, visible=False))
+    database.rows["biospecimen-genomic-files"]["BG_00000100"] = (
+        T0,
+        _link(100),
+    )
+    database.now += timedelta(hours=1)
+    read, rows = _refresh(tmp_path, database)
+    assert read["genomic-files"] == 1
+    assert read["biospecimens"] == 1
+    assert read["biospecimen-genomic-files"] == 101
+    assert rows == _expected(database)
+    assert rows["genomic-files"]["GF_00000005"]["acl"] == ["SD_1", "phs1.c1"]
+
+    # deleted rows
+    del database.rows["genomic-files"]["GF_00000007"]
+    read, rows = _refresh(tmp_path, database)
+    assert read["genomic-files"] == 99
+    assert rows == _expected(database)
+
+    read, rows = _refresh(tmp_path, database)
+    assert sum(read.values()) == 0
+    read, rows = _refresh(tmp_path, database, full=True)
+    assert read["biospecimens"] == 100
+    assert rows == _expected(database)
+
+
+def test_uncommitted_changes_are_discarded(tmp_path):
+    with StudySnapshot(tmp_path, "SD_1") as snapshot:
+        snapshot.put("biospecimens", _bs(1))
+        snapshot.commit(T0, "queries")
+        snapshot.put("biospecimens", _bs(2))
+        snapshot.clear("genomic-files")
+    with StudySnapshot(tmp_path, "SD_1") as snapshot:
+        assert snapshot.taken_at("queries") == T0
+        assert snapshot.taken_at("other queries") is None
+        assert _loaded(snapshot)["biospecimens"] == {"BS_00000001": _bs(1)}
+    with StudySnapshot(tmp_path, "SD_2") as snapshot:
+        assert snapshot.taken_at("queries") is None
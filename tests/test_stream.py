@@ -0,0 +1,166 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from collections import defaultdict
+
+import pytest
+
+from kf_update_dbgap_consent import stream
+from kf_update_dbgap_consent.app.cli import cli
+from kf_update_dbgap_consent.batch import stream_studies, summarize
+from kf_update_dbgap_consent.plan import PlanWriter, read_plan
+from kf_update_dbgap_consent.sample_status import ConsentProcessor
+from tests.benchmarks.fake_services import FakeServices
+from tests.benchmarks.synthetic import SyntheticStudy
+
+STUDIES = [
+    {"multi_specimen_fraction": 0.5, "hidden_fraction": 0.2},
+    {
+        "null_access_fraction": 0.1,
+        "unmatched_fraction": 0.3,
+        "missing_samples": 20,
+    },
+]
+
+
+def assert_stream_matches(requests_mock, tmp_path, study):
+    services = FakeServices(study)
+    services.install(requests_mock)
+    processor = ConsentProcessor(services.host)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        patches, alerts = processor.get_patches_for_study(study.study_id)
+        chunks = list(
+            processor.stream_patches_for_study(
+                study.study_id, chunk_size=300, spool_dir=str(tmp_path)
+            )
+        )
+
+    assert len(chunks) > 5
+    streamed = defaultdict(dict)
+    streamed_alerts = []
+    for chunk_patches, chunk_alerts in chunks:
+        for endpoint, endpoint_patches in chunk_patches.items():
+            assert not streamed[endpoint].keys() & endpoint_patches.keys()
+            streamed[endpoint].update(endpoint_patches)
+        streamed_alerts.extend(chunk_alerts)
+    assert dict(streamed) == patches
+    assert sorted(map(str, streamed_alerts)) == sorted(map(str, alerts))
+    # the spool is removed
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("study_kwargs", STUDIES)
+def test_stream_matches_in_memory(requests_mock, tmp_path, study_kwargs):
+    study = SyntheticStudy(n_genomic_files=2000, seed=1, **study_kwargs)
+    assert_stream_matches(requests_mock, tmp_path, study)
+
+
+def test_stream_null_visibility(requests_mock, tmp_path):
+    # descendants with a null visible are already hidden
+    study = SyntheticStudy(n_genomic_files=2000, seed=1, unmatched_fraction=0.3)
+    for i, bsid in enumerate(study.entities["biospecimens"]):
+        study.entities["biospecimen-diagnoses"][f"BD_{bsid[3:]}"] = {
+            "biospecimen_id": bsid,
+            "diagnosis_id": f"DG_{bsid[3:]}",
+            "visible": None if i % 2 else True,
+        }
+    for i, se in enumerate(study.entities["sequencing-experiments"].values()):
+        if i % 2:
+            se["visible"] = None
+    assert_stream_matches(requests_mock, tmp_path, study)
+
+
+def test_stream_studies_to_plan(requests_mock, tmp_path):
+    study = SyntheticStudy(n_genomic_files=1000)
+    services = FakeServices(study)
+    services.install(requests_mock)
+    processor = ConsentProcessor(services.host)
+    plan_path = str(tmp_path / "plan.ndjson")
+
+    with PlanWriter(plan_path) as writer:
+
+        def write_chunk(study_id, patches, alerts):
+            accession = processor.used_samples[study_id][0]
+            writer.write_patches(study_id, patches, accession)
+
+        def write(study_id, result):
+            accession = processor.used_samples.pop(study_id, [None])[0]
+            writer.write_study(study_id, result, accession)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = stream_studies(
+                processor,
+                [study.study_id, "SD_MISSING0"],
+                write_chunk,
+                on_result=write,
+                chunk_size=100,
+            )
+
+    assert "not found" in results["SD_MISSING0"]["error"]
+    result = results[study.study_id]
+    assert result["error"] is None
+    assert result["patches"] == {}
+    assert result["patch_counts"]["genomic-files"] > 900
+
+    records = list(read_plan(plan_path))
+    assert records[-1]["type"] == "study"
+    assert records[-1]["patches"] == sum(result["patch_counts"].values())
+    assert [r["type"] for r in records].count("patch") == records[-1]["patches"]
+    assert summarize(results)["totals"]["patches"] == records[-1]["patches"]
+
+
+@pytest.mark.parametrize("fail", [False, True])
+def test_streamed_study_is_applied_once_done(
+    requests_mock, monkeypatch, tmp_path, fail
+):
+    study = SyntheticStudy(n_genomic_files=200, hidden_fraction=0.2)
+    services = FakeServices(study)
+    services.install(requests_mock)
+    expected, _ = ConsentProcessor(services.host).get_patches_for_study(
+        study.study_id
+    )
+    chunked_rules = stream.chunked_rules
+
+    def fail_after_first_chunk(*args, **kwargs):
+        chunks = chunked_rules(*args, **kwargs)
+        yield next(chunks)
+        raise Exception("Chunk failed")
+
+    if fail:
+        monkeypatch.setattr(stream, "chunked_rules", fail_after_first_chunk)
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        [
+            "dbgapconsent",
+            study.study_id,
+            "--server",
+            services.host,
+            "--stream",
+            "--chunk_size",
+            "50",
+        ],
+    )
+    with contextlib.redirect_stdout(io.StringIO()):
+        if fail:
+            with pytest.raises(SystemExit, match="Failed studies"):
+                cli()
+        else:
+            cli()
+
+    patched = sum(k.startswith("PATCH") for k in services.requests)
+    if fail:
+        # nothing from the chunks done before the failure was applied
+        assert patched == 0
+    else:
+        assert patched > 0
+        for endpoint, endpoint_patches in expected.items():
+            for kfid, patch in endpoint_patches.items():
+                entity = services.entities[endpoint][kfid]
+                assert {k: entity[k] for k in patch} == patch
+    # the spooled patches are removed
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,93 @@
+import random
+from urllib.parse import parse_qs, urlparse
+
+from kf_update_dbgap_consent.dbgap import DBGAP_SAMPLE_STATUS_URL
+from kf_update_dbgap_consent.watch import ReleaseWatcher
+
+host = "http://localhost:5000"
+study_id = "SD_00000000"
+
+
+class FakeDbgap:
+    """
+    dbGaP sample status headers with ETags for the newest version
+    """
+
+    def __init__(self):
+        self.versions = {"phs999999.v1.p1": "released"}
+        self.requests = []
+
+    def latest(self):
+        return sorted(self.versions)[-1]
+
+    def __call__(self, request, context):
+        query = parse_qs(urlparse(request.url).query)["study_id"][0]
+        self.requests.append(query)
+        if query == "phs999999":
+            accession = self.latest()
+            etag = f'"{accession}-{self.versions[accession]}"'
+            context.headers["ETag"] = etag
+            if request.headers.get("If-None-Match") == etag:
+                context.status_code = 304
+                return b""
+        else:
+            accession = [a for a in self.versions if a.startswith(query)][0]
+        return (
+            f'<DbGap><Study accession="{accession}"'
+            f' registration_status="{self.versions[accession]}">'
+            "<SampleList></SampleList></Study></DbGap>"
+        ).encode("utf-8")
+
+
+def test_watch(requests_mock, tmp_path):
+    dbgap = FakeDbgap()
+    requests_mock.get(DBGAP_SAMPLE_STATUS_URL, content=dbgap)
+    study = {"external_id": "phs999999", "data_access_authority": "dbGaP"}
+    study["version"] = None
+    requests_mock.get(
+        f"{host}/studies/{study_id}", json=lambda r, c: {"results": study}
+    )
+    triggered = []
+    state_file = str(tmp_path / "watch.json")
+
+    def watcher():
+        return ReleaseWatcher(
+            host,
+            state_file,
+            lambda *args: triggered.append(args),
+            interval=100,
+            rand=random.Random(0),
+        )
+
+    # the dataservice doesn't have the released version yet
+    assert watcher().poll([study_id], now=0) == [study_id]
+    assert triggered == [(study_id, "phs999999.v1.p1")]
+    # not due yet
+    assert watcher().poll([study_id], now=1) == []
+    # unchanged in dbGaP, and the run was already queued
+    assert watcher().poll([study_id], now=200) == []
+    assert dbgap.requests[-1] == "phs999999"
+
+    # the run finished
+    study["version"] = "v1.p1"
+    assert watcher().poll([study_id], now=400) == []
+
+    # a new version that isn't released yet
+    dbgap.versions["phs999999.v2.p1"] = "unreleased"
+    assert watcher().poll([study_id], now=600) == []
+    assert dbgap.requests[-2:] == ["phs999999", "phs999999.v1"]
+
+    # ...and then is
+    dbgap.versions["phs999999.v2.p1"] = "released"
+    assert watcher().poll([study_id], now=800) == [study_id]
+    assert triggered[-1] == (study_id, "phs999999.v2.p1")
+
+    # failing checks back off
+    requests_mock.get(f"{host}/studies/{study_id}", status_code=500)
+    w = watcher()
+    w.poll([study_id], now=1000)
+    first = w.state.study(study_id)["next_check"] - 1000
+    w.poll([study_id], now=2000)
+    second = w.state.study(study_id)["next_check"] - 2000
+    assert w.state.study(study_id)["failures"] == 2
+    assert second > first